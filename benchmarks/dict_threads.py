@@ -0,0 +1,66 @@
+# -*- coding: utf8 -*-
+"""
+Stress benchmark of DictBackend with concurrent writers and readers:
+checks history and secondary indexes stay consistent and prints the
+throughput for a growing number of threads.
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import json
+import os
+import threading
+import time
+
+os.environ.setdefault('LOGGING_LEVEL', 'WARNING')
+
+from jsonrepo.backends.memory import DictBackend  # noqa: E402
+
+KEYS = 16
+WRITES = 2000
+THREADS = [1, 2, 4, 8]
+
+
+def worker(backend, number, writes):
+    """ write records of a few keys and read them back """
+    for i in range(writes):
+        key = 'stress{}'.format((number + i) % KEYS)
+        sort_key = '{:06d}'.format(i)
+        backend.set(key, sort_key,
+                    json.dumps({'title': backend.prefixed(key),
+                                'content': number}))
+        backend.get(key, sort_key)
+        if i % 10 == 0:
+            backend.history(key)
+            backend.find('title', backend.prefixed(key))
+
+
+def check(backend):
+    """ every key has its sorted history and is found by its index """
+    for k in range(KEYS):
+        key = 'stress{}'.format(k)
+        sort_keys = backend.cache.get(backend.prefixed(key), [])
+        assert sort_keys == sorted(set(sort_keys)), key
+        found = backend.find('title', backend.prefixed(key))
+        assert found['count'] == len(sort_keys), key
+
+
+def main():
+    for threads in THREADS:
+        backend = DictBackend('stress{}'.format(threads), ['title'])
+        writes = WRITES // threads
+        workers = [threading.Thread(target=worker,
+                                    args=(backend, number, writes))
+                   for number in range(threads)]
+        start = time.time()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        duration = time.time() - start
+        check(backend)
+        print('{:>2} threads {:10.0f} ops/s'.format(
+            threads, threads * writes / duration))
+
+
+if __name__ == '__main__':
+    main()
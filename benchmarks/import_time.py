@@ -0,0 +1,45 @@
+# -*- coding: utf8 -*-
+"""
+Benchmark of the start up cost of a repository using the in process
+memory backend, measured in fresh interpreters.
+
+    python -m benchmarks.import_time
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import sys
+import json
+import subprocess
+
+REPEAT = 10
+
+SCRIPT = '''
+import os, sys, json
+os.environ.setdefault('LOGGING_LEVEL', 'WARNING')
+from timeit import default_timer
+start = default_timer()
+from jsonrepo.repository import Repository
+Repository('dict', 'import_time').storage
+duration = default_timer() - start
+print(json.dumps({
+    'duration': duration,
+    'modules': len(sys.modules),
+    'boto3': 'boto3' in sys.modules,
+    'redis': 'redis' in sys.modules
+}))
+'''
+
+
+def main():
+    runs = [json.loads(subprocess.check_output([sys.executable, '-c',
+                                                SCRIPT]).decode('utf-8'))
+            for _ in range(REPEAT)]
+    durations = sorted(run['duration'] for run in runs)
+    print('start up median {:.1f} ms, {} modules, boto3 imported: {}, '
+          'redis imported: {}'.format(durations[len(durations) // 2] * 1000,
+                                      runs[0]['modules'], runs[0]['boto3'],
+                                      runs[0]['redis']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# -*- coding: utf8 -*-
+"""
+Benchmark of RedisBackend history and find against a local redis-server:
+one GET per record versus a single MGET.
+`REDIS_HOST`, `REDIS_PORT` and `REDIS_DB` environment variables are used
+to reach the server.
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import json
+import timeit
+from jsonrepo.backends.redis import RedisBackend
+
+SIZE = 100
+REPEAT = 50
+
+
+def one_get_per_record(backend, key):
+    """ history as computed before with a GET per record """
+    return [backend.get(key, kid.decode('utf8'))
+            for kid in backend.redis_server.zrevrangebylex(
+                backend.prefixed(key), '+', '-', start=0, num=100)]
+
+
+def main():
+    backend = RedisBackend('benchmark', ['title'])
+    for i in range(SIZE):
+        backend.set('history', '{:06d}'.format(i),
+                    json.dumps({'title': 'benchmark', 'content': i}))
+    try:
+        for name, func in [
+                ('history - GET per record',
+                 lambda: one_get_per_record(backend, 'history')),
+                ('history - MGET',
+                 lambda: backend.history('history')),
+                ('find - MGET',
+                 lambda: backend.find('title', 'benchmark'))]:
+            duration = timeit.timeit(func, number=REPEAT) / REPEAT
+            print('{:<28} {:8.3f} ms'.format(name, duration * 1000))
+    finally:
+        backend.delete_many([('history', '{:06d}'.format(i))
+                             for i in range(SIZE)])
+
+
+if __name__ == '__main__':
+    main()
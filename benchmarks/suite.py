@@ -0,0 +1,227 @@
+# -*- coding: utf8 -*-
+"""
+Benchmark suite of repository operations across backends.
+
+    python -m benchmarks.suite --backends dict sqlite logfile redis \\
+        --sizes 100 1000 --indexes 0 2 --output results.json \\
+        --compare previous.json
+
+SQLite stores records in the `SQLITE_PATH` database file and log-structured
+files under the `LOGFILE_PATH` directory.
+Redis is reached through `REDIS_HOST`, `REDIS_PORT` and `REDIS_DB`
+environment variables. DynamoDB should be a local stand-in, such as
+DynamoDB Local, given by `AWS_ENDPOINT_URL_DYNAMODB`; tables are created
+and dropped by the suite.
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+from collections import namedtuple
+from timeit import default_timer
+
+os.environ.setdefault('LOGGING_LEVEL', 'WARNING')
+
+import jsonrepo  # noqa: E402
+from jsonrepo.record import NamedtupleRecord  # noqa: E402
+from jsonrepo.repository import Repository  # noqa: E402
+
+# number of primary keys the records are spread over
+KEYS = 10
+# number of distinct values of each secondary index
+INDEX_VALUES = 10
+# size of batches of bulk operations
+BATCH = 100
+# relative slowdown reported as a regression
+THRESHOLD = 0.2
+
+
+def record_class(indexes):
+    """ namedtuple record with the given number of indexed fields """
+    fields = ['content', 'date'] + ['index{}'.format(i)
+                                    for i in range(indexes)]
+    return type('BenchmarkRecord',
+                (namedtuple('BenchmarkRecord', fields), NamedtupleRecord),
+                {})
+
+
+def repository(backend, size, indexes):
+    """ singleton repository dedicated to a configuration """
+    klass = record_class(indexes)
+    prefix = 'benchmark-{}-{}-{}'.format(backend, size, indexes)
+    attributes = {
+        'klass': klass,
+        'key': 'key',
+        'sort_key': 'date',
+        'secondary_indexes': list(klass._fields[2:])
+    }
+    cls = type('BenchmarkRepository', (Repository,), attributes)
+    return cls(backend, prefix)
+
+
+def create_table(prefix, indexes):
+    """ DynamoDB table with a global secondary index per index """
+    import boto3
+    client = boto3.client('dynamodb')
+    attributes = [{'AttributeName': 'key', 'AttributeType': 'S'},
+                  {'AttributeName': 'date', 'AttributeType': 'S'}]
+    params = {}
+    if indexes:
+        params['GlobalSecondaryIndexes'] = [{
+            'IndexName': '{}-index'.format(index),
+            'KeySchema': [{'AttributeName': index, 'KeyType': 'HASH'}],
+            'Projection': {'ProjectionType': 'ALL'}
+        } for index in indexes]
+        attributes += [{'AttributeName': index, 'AttributeType': 'S'}
+                       for index in indexes]
+    client.create_table(
+        TableName=prefix,
+        KeySchema=[{'AttributeName': 'key', 'KeyType': 'HASH'},
+                   {'AttributeName': 'date', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=attributes,
+        BillingMode='PAY_PER_REQUEST',
+        **params)
+    client.get_waiter('table_exists').wait(TableName=prefix)
+    return client
+
+
+def percentile(durations, ratio):
+    """ percentile of sorted durations """
+    return durations[min(len(durations) - 1, int(len(durations) * ratio))]
+
+
+def timed(operation, calls):
+    """ runs calls and returns statistics of their durations """
+    durations = []
+    for call in calls:
+        start = default_timer()
+        call()
+        durations.append(default_timer() - start)
+    durations.sort()
+    total = sum(durations)
+    return {
+        'operation': operation,
+        'count': len(durations),
+        'total': total,
+        'mean': total / len(durations),
+        'p50': percentile(durations, 0.5),
+        'p99': percentile(durations, 0.99),
+        'ops_per_sec': len(durations) / total if total else None
+    }
+
+
+def workloads(repo, size, indexes):
+    """ runs every workload on repo, yielding their statistics """
+    klass = repo.klass
+    records = []
+    for i in range(size):
+        date = '2017-01-01T00:00:00.{:06d}'.format(i)
+        values = ['value{}'.format(i % INDEX_VALUES)
+                  for _ in range(indexes)]
+        records.append(('key{}'.format(i % KEYS), date,
+                        klass('content {}'.format(i) * 10, date, *values)))
+    keys = [(key, sort_key) for key, sort_key, _ in records]
+    batches = [records[i:i + BATCH] for i in range(0, size, BATCH)]
+    key_batches = [keys[i:i + BATCH] for i in range(0, size, BATCH)]
+    primary_keys = sorted(set(key for key, _ in keys))
+
+    yield timed('save', [lambda r=r: repo.save(*r) for r in records])
+    yield timed('get', [lambda k=k: repo.get(*k) for k in keys])
+    yield timed('latest', [lambda k=k: repo.latest(k) for k in primary_keys])
+    yield timed('history', [lambda k=k: repo.history(k)
+                            for k in primary_keys])
+    if indexes:
+        yield timed('find', [
+            lambda v=v: repo.find(repo.secondary_indexes[0],
+                                  'value{}'.format(v))
+            for v in range(INDEX_VALUES)])
+    yield timed('delete', [lambda k=k: repo.delete(*k) for k in keys])
+    yield timed('save_many', [lambda b=b: repo.save_many(b)
+                              for b in batches])
+    yield timed('get_many', [lambda b=b: repo.get_many(b)
+                             for b in key_batches])
+    yield timed('delete_many', [lambda b=b: repo.delete_many(b)
+                                for b in key_batches])
+
+
+def run(backends, sizes, index_counts):
+    """ runs the suite and returns its results """
+    results = []
+    for backend in backends:
+        for size in sizes:
+            for indexes in index_counts:
+                repo = repository(backend, size, indexes)
+                client = None
+                if backend == 'dynamodb':
+                    client = create_table(repo.prefix,
+                                          repo.secondary_indexes)
+                try:
+                    for stats in workloads(repo, size, indexes):
+                        stats.update({
+                            'backend': backend,
+                            'size': size,
+                            'indexes': indexes
+                        })
+                        results.append(stats)
+                        print('{backend:<9} {size:>7} {indexes:>2} '
+                              '{operation:<12} {mean:.6f}s '
+                              '(p99 {p99:.6f}s)'.format(**stats))
+                finally:
+                    if client is not None:
+                        client.delete_table(TableName=repo.prefix)
+    return results
+
+
+def compare(results, previous):
+    """ prints changes of mean latency against previous results """
+    reference = dict(((r['backend'], r['size'], r['indexes'],
+                       r['operation']), r)
+                     for r in previous['results'])
+    regressions = 0
+    for stats in results:
+        before = reference.get((stats['backend'], stats['size'],
+                                stats['indexes'], stats['operation']))
+        if before is None or not before['mean']:
+            continue
+        change = stats['mean'] / before['mean'] - 1
+        flag = ''
+        if change > THRESHOLD:
+            flag = ' REGRESSION'
+            regressions += 1
+        print('{backend:<9} {size:>7} {indexes:>2} {operation:<12} '
+              '{change:+.1%}{flag}'.format(change=change, flag=flag,
+                                           **stats))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--backends', nargs='+', default=['dict'],
+                        choices=['dict', 'sqlite', 'logfile', 'redis',
+                                 'dynamodb'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000])
+    parser.add_argument('--indexes', nargs='+', type=int, default=[0, 2])
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help='previous results to compare to')
+    args = parser.parse_args(argv)
+    results = run(args.backends, args.sizes, args.indexes)
+    with open(args.output, 'w') as output:
+        json.dump({
+            'jsonrepo': jsonrepo.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'results': results
+        }, output, indent=2)
+    if args.compare:
+        with open(args.compare) as previous:
+            return 1 if compare(results, json.load(previous)) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
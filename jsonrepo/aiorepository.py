@@ -0,0 +1,198 @@
+# -*- coding: utf8 -*-
+"""
+Asyncio repository for JSON serializable objects
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+from concurrent.futures import ThreadPoolExecutor
+from six import add_metaclass
+from singleton import Singleton
+from loggingmixin import LoggingMixin
+from awesomedecorators import memoized
+from jsonrepo.mixin import StorageMixin
+from jsonrepo.record import Record, LazyRecord, serialize_changes
+from jsonrepo.backends.aio import AsyncBackend, AsyncRedisBackend
+from jsonrepo.backends.instrumented import AsyncInstrumentedBackend
+
+
+@add_metaclass(Singleton)
+class AsyncRepository(StorageMixin, LoggingMixin):
+    """
+    Definition of an asyncio repository
+    """
+    klass = Record
+    key = 'key'
+    sort_key = 'date'
+    secondary_indexes = []
+    # indexes kept in order for find_range, instead of secondary_indexes
+    ordered_indexes = []
+    # maximum number of threads running calls of blocking backends
+    max_workers = 8
+    # wrapper of storage reporting operations to hooks
+    instrumented_backend = AsyncInstrumentedBackend
+
+    def __init__(self, backend, prefix):
+        self.prefix = prefix
+        self.backend = backend
+
+    @memoized
+    def storage(self):
+        """
+        Instantiates and returns an asyncio storage instance: native for
+        Redis, direct for in process memory and in a bounded thread pool
+        for blocking backends, buffered and cached ones included
+        """
+        if self.backend == 'redis' and not (self.cache_size or
+                                            self.buffer_size):
+            return AsyncRedisBackend.for_repository(self)
+        storage = self.wrap_storage(self.backend_storage())
+        if self.backend == 'dict' and not self.buffer_size:
+            return AsyncBackend(storage)
+        return AsyncBackend(storage, ThreadPoolExecutor(self.max_workers))
+
+    async def flush(self):
+        """
+        Writes the saves pending in the write-behind buffer, if any
+        """
+        if hasattr(self.storage, 'flush'):
+            await self.storage.flush()
+
+    async def close(self):
+        """
+        Stops the write-behind buffer, if any, after writing pending saves
+        """
+        if hasattr(self.storage, 'close'):
+            await self.storage.close()
+
+    async def get(self, key, sort_key, klass=None, **args):
+        """
+        Retrieves a context object
+        """
+        if klass is None:
+            klass = self.klass
+        record = await self.storage.get(key, sort_key)
+        if record is None:
+            return klass(**args)
+        return klass.from_json(record)
+
+    async def get_many(self, keys, klass=None, **args):
+        """
+        Retrieves context objects for a list of (key, sort_key) pairs
+        """
+        if klass is None:
+            klass = self.klass
+        return [klass(**args) if record is None else klass.from_json(record)
+                for record in await self.storage.get_many(keys)]
+
+    async def save(self, key, sort_key, _object, ttl=None):
+        """
+        Saves a context object, expiring after ttl seconds or the ttl of the
+        repository
+        """
+        value, document = _object.encode()
+        return await self.storage.set(key, sort_key, value, document,
+                                      **self.ttl_options(ttl))
+
+    async def save_many(self, items, ttl=None):
+        """
+        Saves context objects from a list of (key, sort_key, object) triples
+        """
+        encoded = [_object.encode() for _, _, _object in items]
+        return await self.storage.set_many(
+            [(key, sort_key, value)
+             for (key, sort_key, _), (value, _) in zip(items, encoded)],
+            documents=[document for _, document in encoded],
+            **self.ttl_options(ttl))
+
+    async def update(self, key, sort_key, **changes):
+        """
+        Sets fields of a stored record without saving it whole, indexes
+        being updated for changed fields only. Returns whether the record
+        exists.
+        """
+        return await self.storage.update(key, sort_key,
+                                         serialize_changes(changes))
+
+    async def delete(self, key, sort_key):
+        """
+        Deletes a context object
+        """
+        return await self.storage.delete(key, sort_key)
+
+    async def delete_many(self, keys):
+        """
+        Deletes context objects for a list of (key, sort_key) pairs
+        """
+        return await self.storage.delete_many(keys)
+
+    def decode(self, value, lazy=False):
+        """
+        Decodes a stored value into a record, or into a lazy proxy decoding
+        it on first access
+        """
+        if lazy:
+            return LazyRecord(self.klass, value)
+        return self.klass.from_json(value)
+
+    async def history(self, key, _from='-', _to='+', _desc=True,
+                      lazy=False):
+        """
+        Retrives the list of every record of a datetime range, read page by
+        page by backends; iter_history does not hold them all at once
+        """
+        return [self.decode(_object, lazy)
+                for _object in await self.storage.history(key, _from, _to,
+                                                          _desc)]
+
+    async def history_page(self, key, _from='-', _to='+', desc=True,
+                           page_size=100, cursor=None):
+        """
+        Retrieves a page of records according to a datetime range and the
+        opaque cursor of the next page, None after the last page
+        """
+        values, cursor = await self.storage.history_page(
+            key, _from, _to, desc, page_size, cursor)
+        return [self.klass.from_json(_object) for _object in values], cursor
+
+    async def iter_history(self, key, _from='-', _to='+', desc=True,
+                           page_size=100, cursor=None):
+        """
+        Iterates asynchronously over records according to a datetime range
+        """
+        while True:
+            values, cursor = await self.storage.history_page(
+                key, _from, _to, desc, page_size, cursor)
+            for _object in values:
+                yield self.klass.from_json(_object)
+            if cursor is None:
+                return
+
+    async def latest(self, key):
+        """
+        Get the most recent record for a specific key
+        """
+        return self.klass.from_json(await self.storage.latest(key))
+
+    async def find(self, index, value, lazy=False):
+        """
+        Find record according to the value of a secondary index
+        """
+        res = await self.storage.find(index, value)
+        return {
+            'count': res['count'],
+            'items': [self.decode(_object, lazy)
+                      for _object in res['items']]
+        }
+
+    async def find_range(self, index, lo=None, hi=None, limit=None,
+                         lazy=False):
+        """
+        Find records according to a range of an ordered index, lo and hi
+        being included and None meaning unbounded, in index order
+        """
+        res = await self.storage.find_range(index, lo, hi, limit)
+        return {
+            'count': res['count'],
+            'items': [self.decode(_object, lazy)
+                      for _object in res['items']]
+        }
@@ -4,13 +4,95 @@ Storage backend definition
 Author:   Romary Dupuis <romary@me.com>
 Copyright (C) 2017 Romary Dupuis
 """
+import json
+import base64
+from bisect import bisect_left, bisect_right
+from jsonrepo import codec
+
+
+def encode_cursor(position):
+    """ opaque cursor from a JSON serializable position """
+    return base64.urlsafe_b64encode(
+        json.dumps(position).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ position from an opaque cursor """
+    return json.loads(base64.urlsafe_b64decode(
+        cursor.encode('ascii')).decode('utf-8'))
+
+
+def is_number(value):
+    """ whether an ordered index value is ordered as a number """
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def ordered_value(value):
+    """
+    Sortable form of an ordered index value: numbers come before strings,
+    other values are not indexed and give None
+    """
+    if is_number(value):
+        return (0, value)
+    if isinstance(value, str):
+        return (1, value)
+    return None
+
+
+class _Highest(object):
+    """ greater than anything, bounds the entries of an index value """
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+
+HIGHEST = _Highest()
+
+
+def ordered_bounds(entries, lo, hi):
+    """
+    Start and end positions of entries between lo and hi, both included
+    and None meaning unbounded, entries being a sorted list of ordered
+    values followed by the key of their record
+    """
+    start = 0
+    if lo is not None:
+        start = bisect_left(entries, ordered_value(lo))
+    end = len(entries)
+    if hi is not None:
+        end = bisect_right(entries, ordered_value(hi) + (HIGHEST,))
+    return start, end
+
+
+def ttl_options(ttl):
+    """
+    Keyword arguments of set and set_many for a time to live in seconds,
+    none without one so that backends not supporting expiry keep working
+    """
+    if ttl is None:
+        return {}
+    return {'ttl': ttl}
 
 
 class Backend(object):
     """ Basic backend class """
-    def __init__(self, prefix, secondary_indexes):
+    # number of values read at once by history, page by page
+    history_page_size = 1000
+
+    def __init__(self, prefix, secondary_indexes, ordered_indexes=()):
         self._prefix = prefix
         self._secondary_indexes = secondary_indexes
+        self._ordered_indexes = ordered_indexes
+
+    @classmethod
+    def for_repository(cls, repository):
+        """ backend instance storing records of a repository """
+        if repository.ordered_indexes:
+            return cls(repository.prefix, repository.secondary_indexes,
+                       ordered_indexes=repository.ordered_indexes)
+        return cls(repository.prefix, repository.secondary_indexes)
 
     def prefixed(self, key):
         """ build a prefixed key """
@@ -19,14 +101,97 @@ class Backend(object):
     def get(self, key, sort_key):
         raise NotImplementedError
 
-    def set(self, key, sort_key, value):
+    def set(self, key, sort_key, value, document=None, ttl=None):
+        """
+        Set a value, document being its decoded form when available so that
+        secondary indexes are read without decoding the value again. The
+        value expires after ttl seconds, if any.
+        """
         raise NotImplementedError
 
     def delete(self, key, sort_key):
         raise NotImplementedError
 
+    def update(self, key, sort_key, changes):
+        """
+        Set fields of a stored value from a dict of changes, in the codec of
+        the value. Returns whether the value exists.
+        Backends able to patch values where they are stored should override
+        it, this reads the value and writes it back whole.
+        """
+        value = self.get(key, sort_key)
+        if value is None:
+            return False
+        document = codec.loads(value)
+        document.update(changes)
+        self.set(key, sort_key, codec.codec_of(value).dumps(document),
+                 document)
+        return True
+
     def history(self, key, _from='-', _to='+', _desc=True):
+        """
+        Get every value according to a sort key range, read page by page
+        with history_page unless backends read them at once
+        """
+        values = []
+        cursor = None
+        while True:
+            page, cursor = self.history_page(key, _from, _to, _desc,
+                                             self.history_page_size, cursor)
+            values.extend(page)
+            if cursor is None:
+                return values
+
+    def history_page(self, key, _from='-', _to='+', _desc=True, limit=100,
+                     cursor=None):
+        """
+        Get a page of at most limit values according to a sort key range,
+        starting at an opaque cursor returned by a previous page.
+        Returns values and the cursor of the next page, None at the end.
+        """
         raise NotImplementedError
 
     def find(self, index, value):
         raise NotImplementedError
+
+    def find_range(self, index, lo=None, hi=None, limit=None):
+        """
+        Find values whose ordered index is between lo and hi, both included
+        and None meaning unbounded, in index order and at most limit.
+        Numbers come before strings.
+        """
+        raise NotImplementedError
+
+    def scan(self, page_size=100, concurrency=1):
+        """
+        Iterates over pages of every value of the prefix, in no particular
+        order. Backends able to scan in parallel run concurrency scans at
+        once and yield pages as they arrive.
+        """
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """
+        Get values for a list of (key, sort_key) pairs, in the same order.
+        Backends able to batch requests should override it.
+        """
+        return [self.get(key, sort_key) for key, sort_key in keys]
+
+    def set_many(self, items, ttl=None, documents=None):
+        """
+        Set values for a list of (key, sort_key, value) triples, expiring
+        after ttl seconds if any, documents being their decoded forms when
+        available.
+        Backends able to batch requests should override it.
+        """
+        if documents is None:
+            documents = [None for _ in items]
+        return [self.set(key, sort_key, value, document, **ttl_options(ttl))
+                for (key, sort_key, value), document in zip(items, documents)]
+
+    def delete_many(self, keys):
+        """
+        Delete values for a list of (key, sort_key) pairs.
+        Backends able to batch requests should override it.
+        """
+        return [self.delete(key, sort_key) for key, sort_key in keys]
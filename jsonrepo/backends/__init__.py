@@ -1 +1,69 @@
-__all__ = ['dynamodb', 'redis', 'memory']
+# -*- coding: utf8 -*-
+"""
+Registry of storage backends, imported on first use
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import importlib
+
+__all__ = ['dynamodb', 'redis', 'memory', 'sqlite', 'logfile', 'sharded']
+
+# entry points group of third-party backends
+ENTRY_POINTS = 'jsonrepo.backends'
+
+# backend classes by name, or 'module:class' paths until first use
+BACKENDS = {
+    'dict': 'jsonrepo.backends.memory:DictBackend',
+    'redis': 'jsonrepo.backends.redis:RedisBackend',
+    'dynamodb': 'jsonrepo.backends.dynamodb:DynamoDBBackend',
+    'sqlite': 'jsonrepo.backends.sqlite:SQLiteBackend',
+    'logfile': 'jsonrepo.backends.logfile:LogFileBackend',
+    'sharded': 'jsonrepo.backends.sharded:ShardedBackend',
+}
+
+
+def register_backend(name, backend):
+    """
+    Registers a backend class, or its 'module:class' path, under a name
+    usable as the backend of repositories
+    """
+    BACKENDS[name] = backend
+
+
+def entry_point(name):
+    """ 'module:class' path of a backend declared by an entry point """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # Python < 3.8
+        import pkg_resources
+        for point in pkg_resources.iter_entry_points(ENTRY_POINTS, name):
+            return '{}:{}'.format(point.module_name, '.'.join(point.attrs))
+        return None
+    points = entry_points()
+    if hasattr(points, 'select'):
+        points = points.select(group=ENTRY_POINTS, name=name)
+    else:  # Python < 3.10
+        points = [point for point in points.get(ENTRY_POINTS, [])
+                  if point.name == name]
+    for point in points:
+        return point.value
+    return None
+
+
+def get_backend(name):
+    """
+    Backend class registered under name, importing it on first use.
+    Raises KeyError for unknown backends.
+    """
+    backend = BACKENDS.get(name)
+    if backend is None:
+        backend = entry_point(name)
+        if backend is None:
+            raise KeyError('Unknown storage backend {}'.format(name))
+    if not isinstance(backend, type):
+        module, _, attribute = backend.partition(':')
+        backend = importlib.import_module(module)
+        for part in attribute.split('.'):
+            backend = getattr(backend, part)
+        BACKENDS[name] = backend
+    return backend
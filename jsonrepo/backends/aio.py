@@ -0,0 +1,354 @@
+# -*- coding: utf8 -*-
+"""
+Asyncio implementations of storage backends
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import time
+import json
+import asyncio
+import functools
+import redis.asyncio
+from awesomedecorators import memoized
+from jsonrepo import codec, connections, metrics
+from jsonrepo.backend import encode_cursor
+from jsonrepo.backends.redis import RedisBackend
+try:
+    import contextvars
+except ImportError:  # Python < 3.7
+    contextvars = None
+
+# running loop of coroutines, the current loop before Python 3.7
+get_running_loop = getattr(asyncio, 'get_running_loop',
+                           asyncio.get_event_loop)
+
+
+class AsyncBackend(object):
+    """
+    Asyncio adapter of a synchronous backend. Calls are run in the given
+    executor, in the context of the caller for their round trips to be
+    measured, or directly when there is no executor as for in process
+    memory backends which never block.
+    """
+
+    def __init__(self, backend, executor=None):
+        self._backend = backend
+        self._executor = executor
+
+    def __getattr__(self, name):
+        if name == '_backend':
+            raise AttributeError(name)
+        func = getattr(self._backend, name)
+        if not callable(func):
+            return func
+
+        @functools.wraps(func)
+        async def call(*args, **kwargs):
+            if self._executor is None:
+                return func(*args, **kwargs)
+            if contextvars is not None:
+                return await get_running_loop().run_in_executor(
+                    self._executor, functools.partial(
+                        contextvars.copy_context().run, func, *args,
+                        **kwargs))
+            return await get_running_loop().run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs))
+        return call
+
+
+class CountingAsyncConnection(redis.asyncio.Connection):
+    """
+    Asyncio connection counting round trips of measured operations
+    """
+    async def send_packed_command(self, *args, **kwargs):
+        metrics.round_trip()
+        return await super(CountingAsyncConnection,
+                           self).send_packed_command(*args, **kwargs)
+
+
+class CountingAsyncUnixConnection(redis.asyncio.UnixDomainSocketConnection):
+    """
+    Asyncio unix socket connection counting round trips of measured
+    operations
+    """
+    async def send_packed_command(self, *args, **kwargs):
+        metrics.round_trip()
+        return await super(CountingAsyncUnixConnection,
+                           self).send_packed_command(*args, **kwargs)
+
+
+class AsyncRedisBackend(RedisBackend):
+    """
+    Backend based on Redis with redis.asyncio. Connections being bound to
+    an event loop, pools are not shared between backends.
+    """
+    @memoized
+    def redis_server(self):
+        return redis.asyncio.StrictRedis(
+            connection_pool=redis.asyncio.ConnectionPool(
+                **connections.redis_pool_options(
+                    self._endpoint, CountingAsyncConnection,
+                    CountingAsyncUnixConnection)))
+
+    async def exists(self, key):
+        return await self.redis_server.exists(self.prefixed(key))
+
+    async def keys(self, pattern):
+        return [key async for key in self.redis_server.scan_iter(pattern)]
+
+    async def get(self, key, sort_key):
+        self.logger.debug('Storage - get %s:%s:%s', self._prefix, key,
+                          sort_key)
+        value = await self.redis_server.get(
+            self.prefixed('{}:{}'.format(key, sort_key))
+        )
+        if value is not None:
+            return value.decode('utf-8')
+        return value
+
+    async def set(self, key, sort_key, value, document=None, ttl=None):
+        self.logger.debug('Storage - set value %s for %s:%s:%s', value,
+                          self._prefix, key, sort_key)
+        return (await self._write_many([(key, sort_key, value)],
+                                       [document], ttl))[0]
+
+    async def delete(self, key, sort_key):
+        self.logger.debug('Storage - delete %s:%s:%s', self._prefix, key,
+                          sort_key)
+        return (await self._write_many([(key, sort_key, None)]))[0]
+
+    async def update(self, key, sort_key, changes):
+        """
+        Patch a JSON value with a Lua script, see RedisBackend.update
+        """
+        self.logger.debug('Storage - update %s:%s:%s with %s', self._prefix,
+                          key, sort_key, changes)
+        keys = [self.prefixed('{}:{}'.format(key, sort_key)),
+                self.shadow_key(key, sort_key)]
+        indexed = self.indexed_fields(changes)
+        try:
+            if not indexed:
+                return bool(await self.patch_script(
+                    keys=keys, args=self.patch_args(changes),
+                    client=self.redis_server))
+            found = []
+
+            async def _update(pipe):
+                res = await self.patch_script(
+                    keys=keys, args=['read'] + indexed, client=pipe)
+                # 0 without value
+                found[:] = [bool(res)]
+                if res:
+                    pipe.multi()
+                    await self.patch_script(keys=keys,
+                                            args=self.patch_args(changes),
+                                            client=pipe)
+                    self._queue_patch_indexes(pipe, key, sort_key, changes,
+                                              indexed, res[1], res[2:])
+
+            await self.transaction(_update, *keys)
+            return found[0]
+        except redis.exceptions.ResponseError as error:
+            if 'jsonrepo:' not in str(error):
+                raise
+        return await self._update_value(key, sort_key, changes)
+
+    async def _update_value(self, key, sort_key, changes):
+        """
+        Read, patch and write back a value in a transaction, see
+        RedisBackend._update_value
+        """
+        watched = self.watched_keys([(key, sort_key)])
+        found = []
+
+        async def _update(pipe):
+            value, shadow = await pipe.mget(watched)
+            ttl = await pipe.pttl(watched[0])
+            found[:] = [value is not None]
+            if value is None:
+                return
+            value = value.decode('utf-8')
+            document = codec.loads(value)
+            document.update(changes)
+            pipe.multi()
+            self._queue_writes(
+                pipe, [(key, sort_key, codec.codec_of(value).dumps(document))],
+                [value], [document], [shadow],
+                ttl / 1000.0 if ttl > 0 else None)
+
+        await self.transaction(_update, *watched)
+        return found[0]
+
+    async def get_many(self, keys):
+        """ Get many values with a single MGET """
+        if not keys:
+            return []
+        self.logger.debug('Storage - get many (%s)', len(keys))
+        values = await self.redis_server.mget([
+            self.prefixed('{}:{}'.format(key, sort_key))
+            for key, sort_key in keys
+        ])
+        return [value.decode('utf-8') if value is not None else None
+                for value in values]
+
+    async def _write_many(self, items, documents=None, ttl=None):
+        """
+        Write (key, sort_key, value) triples in a single MULTI/EXEC
+        transaction, see RedisBackend._write_many
+        """
+        watched = self.watched_keys([(key, sort_key)
+                                     for key, sort_key, _ in items])
+        positions = []
+
+        async def _write(pipe):
+            prev_values = await pipe.mget(watched)
+            pipe.multi()
+            positions[:] = self._queue_writes(
+                pipe, items, prev_values[:len(items)], documents,
+                prev_values[len(items):], ttl)
+
+        res = await self.transaction(_write, *watched)
+        await self.evict_if_due()
+        return [res[position] for position in positions]
+
+    async def evict_if_due(self):
+        """ evicts expired values every eviction_interval seconds """
+        if time.time() < self._next_eviction:
+            return
+        self._next_eviction = time.time() + self.eviction_interval
+        await self.evict()
+
+    async def evict(self):
+        """
+        Deletes index entries of values expired by Redis, see
+        RedisBackend.evict
+        """
+        evicted = 0
+        while True:
+            members = await self.redis_server.zrangebyscore(
+                self.expiries, '-inf', time.time(), start=0,
+                num=self.eviction_batch_size)
+            keys = [tuple(json.loads(member)) for member in members]
+            watched = self.watched_keys(keys)
+            count = []
+
+            async def _evict(pipe):
+                values = await pipe.mget(watched)
+                pipe.multi()
+                count[:] = [self._queue_evictions(pipe, keys, values)]
+
+            if keys:
+                await self.transaction(_evict, *watched)
+                evicted += count[0]
+            if not count or not count[0] or \
+                    len(keys) < self.eviction_batch_size:
+                break
+        if evicted:
+            self.logger.debug('Storage - evicted %s values of %s', evicted,
+                              self._prefix)
+        return evicted
+
+    async def set_many(self, items, ttl=None, documents=None):
+        """ Set many values in a single transaction """
+        if not items:
+            return []
+        self.logger.debug('Storage - set many (%s)', len(items))
+        return await self._write_many(items, documents, ttl=ttl)
+
+    async def delete_many(self, keys):
+        """ Delete many values in a single transaction """
+        if not keys:
+            return []
+        self.logger.debug('Storage - delete many (%s)', len(keys))
+        return await self._write_many([(key, sort_key, None)
+                                       for key, sort_key in keys])
+
+    async def history(self, key, _from='-', _to='+', _desc=True):
+        """ every value of a sort key range, read page by page """
+        values = []
+        cursor = None
+        while True:
+            page, cursor = await self.history_page(
+                key, _from, _to, _desc, self.history_page_size, cursor)
+            values.extend(page)
+            if cursor is None:
+                return values
+
+    async def history_page(self, key, _from='-', _to='+', _desc=True,
+                           limit=100, cursor=None):
+        _from, _to = self.history_range(_from, _to, _desc, cursor)
+        if _desc:
+            kids = await self.redis_server.zrevrangebylex(
+                self.prefixed(key), _to, _from, start=0, num=limit)
+        else:
+            kids = await self.redis_server.zrangebylex(
+                self.prefixed(key), _from, _to, start=0, num=limit)
+        sort_keys = [kid.decode('utf8') for kid in kids]
+        values = await self.get_many([(key, sort_key)
+                                      for sort_key in sort_keys])
+        cursor = None
+        if len(sort_keys) == limit:
+            cursor = encode_cursor(sort_keys[-1])
+        # values deleted in between are skipped
+        return [value for value in values if value is not None], cursor
+
+    async def latest(self, key):
+        self.logger.debug('Storage - get latest for %s:%s', self._prefix,
+                          key)
+        cursor = None
+        while True:
+            # sort keys of expired values are skipped until evicted
+            values, cursor = await self.history_page(key, limit=1,
+                                                     cursor=cursor)
+            if values:
+                return values[0]
+            if cursor is None:
+                return None
+
+    async def transaction(self, func, *watchs, **params):
+        return await self.redis_server.transaction(func, *watchs, **params)
+
+    async def find_range(self, index, lo=None, hi=None, limit=None):
+        keys = []
+        for kind, name, _min, _max in self.ordered_ranges(index, lo, hi):
+            if limit is not None and len(keys) >= limit:
+                break
+            window = {}
+            if limit is not None:
+                window = {'start': 0, 'num': limit - len(keys)}
+            if kind == 'score':
+                members = await self.redis_server.zrangebyscore(
+                    name, _min, _max, **window)
+            else:
+                members = await self.redis_server.zrangebylex(
+                    name, _min, _max, **window)
+            keys.extend(self.ordered_keys(kind, members))
+        # values deleted in between are skipped
+        items = []
+        if keys:
+            items = [item.decode('utf-8')
+                     for item in await self.redis_server.mget(keys)
+                     if item is not None]
+        return {
+            'count': len(items),
+            'items': items
+        }
+
+    async def find(self, index, value):
+        if index in self._ordered_indexes:
+            return await self.find_range(index, value, value)
+        keys = await self.redis_server.smembers(
+            self.prefixed('secondary_indexes:{}:{}'.format(
+                index, value
+            ))
+        )
+        if not keys:
+            return {'count': 0, 'items': []}
+        # values deleted in between are skipped
+        items = [item.decode('utf-8')
+                 for item in await self.redis_server.mget(list(keys))
+                 if item is not None]
+        return {
+            'count': len(items),
+            'items': items
+        }
@@ -0,0 +1,247 @@
+# -*- coding: utf8 -*-
+"""
+Write-behind buffer wrapping any storage backend
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import os
+import atexit
+import threading
+from collections import OrderedDict
+from timeit import default_timer
+from loggingmixin import LoggingMixin
+from jsonrepo import codec
+from jsonrepo.backend import Backend, ttl_options
+
+# marks a pending deletion
+DELETED = object()
+
+
+class BufferedBackend(Backend, LoggingMixin):
+    """
+    Backend buffering writes to another backend: repeated writes of the
+    same (key, sort_key) coalesce and a background thread writes them in
+    batches once batch_size writes are pending or every interval seconds.
+    Writers wait while size writes are pending.
+    Values pending or being flushed are read from the buffer, other reads
+    flush the buffer first.
+    """
+
+    def __init__(self, backend, size=1000, interval=1.0, batch_size=100):
+        self._backend = backend
+        self._size = size
+        self._interval = interval
+        self._batch_size = batch_size
+        # pending writes waking the flushing thread up, a full buffer at most
+        self._threshold = min(size, batch_size)
+        # (key, sort_key) -> (value or DELETED, ttl, document)
+        self._pending = OrderedDict()
+        # writes of the flush in progress
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # a single flush at once so that writes reach the backend in order
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def __getattr__(self, name):
+        """ anything else is served by the wrapped backend """
+        if name == '_backend':
+            raise AttributeError(name)
+        return getattr(self._backend, name)
+
+    def _start(self):
+        """ starts the flushing thread, again in forked children """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run,
+                                            name='jsonrepo-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        failed = False
+        while True:
+            with self._lock:
+                if failed:
+                    # a failed flush is retried after interval seconds,
+                    # whatever the writers waiting for room
+                    retry_at = default_timer() + self._interval
+                    while not self._closed and default_timer() < retry_at:
+                        self._changed.wait(retry_at - default_timer())
+                elif not self._closed and \
+                        len(self._pending) < self._threshold:
+                    self._changed.wait(self._interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+                failed = False
+            except Exception:
+                failed = True
+                self.logger.error('Storage - write-behind flush failed',
+                                  exc_info=True)
+
+    def _write(self, items, ttl=None, documents=None):
+        """
+        buffers (key, sort_key, value) triples, DELETED for deletions,
+        expiring after ttl seconds once written, along with their documents
+        """
+        if documents is None:
+            documents = [None for _ in items]
+        with self._lock:
+            if self._closed:
+                raise ValueError('Write-behind buffer is closed')
+            self._start()
+            for (key, sort_key, value), document in zip(items, documents):
+                entry = (key, sort_key)
+                # backpressure: writers wait for the buffer to be flushed
+                while entry not in self._pending and \
+                        len(self._pending) >= self._size:
+                    self._changed.notify_all()
+                    self._changed.wait()
+                self._pending[entry] = (value, ttl, document)
+            if len(self._pending) >= self._threshold:
+                self._changed.notify_all()
+
+    def flush(self):
+        """
+        Writes pending values to the backend in batches. Values of a failed
+        flush are buffered again unless written meanwhile.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing = self._pending
+                self._pending = OrderedDict()
+                # writers waiting for room go on
+                self._changed.notify_all()
+            entries = list(self._flushing.items())
+            try:
+                for start in range(0, len(entries), self._batch_size):
+                    batch = entries[start:start + self._batch_size]
+                    # values of the same time to live are set at once
+                    sets = OrderedDict()
+                    for (key, sort_key), (value, ttl, document) in batch:
+                        if value is not DELETED:
+                            sets.setdefault(ttl, []).append(
+                                ((key, sort_key, value), document))
+                    deletes = [entry for entry, (value, _, _) in batch
+                               if value is DELETED]
+                    for ttl, writes in sets.items():
+                        self._backend.set_many(
+                            [item for item, _ in writes],
+                            documents=[document for _, document in writes],
+                            **ttl_options(ttl))
+                    if deletes:
+                        self._backend.delete_many(deletes)
+            except Exception:
+                with self._lock:
+                    for entry, value in self._flushing.items():
+                        self._pending.setdefault(entry, value)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+            self.logger.debug('Storage - flushed %s writes', len(entries))
+
+    def close(self):
+        """ stops the flushing thread and writes pending values """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._changed.notify_all()
+        self.flush()
+
+    def _buffered(self, key, sort_key):
+        """ value pending or being flushed, DELETED, or None """
+        with self._lock:
+            entry = (key, sort_key)
+            if entry in self._pending:
+                return self._pending[entry][0]
+            if entry in self._flushing:
+                return self._flushing[entry][0]
+            return None
+
+    def get(self, key, sort_key):
+        value = self._buffered(key, sort_key)
+        if value is None:
+            return self._backend.get(key, sort_key)
+        if value is DELETED:
+            return None
+        return value
+
+    def get_many(self, keys):
+        values = [self._buffered(key, sort_key) for key, sort_key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            fetched = self._backend.get_many([keys[i] for i in missing])
+            for i, value in zip(missing, fetched):
+                values[i] = value
+        return [None if value is DELETED else value for value in values]
+
+    def set(self, key, sort_key, value, document=None, ttl=None):
+        self._write([(key, sort_key, value)], ttl, [document])
+        return True
+
+    def update(self, key, sort_key, changes):
+        """ patches a pending value in the buffer, else in the backend """
+        entry = (key, sort_key)
+        with self._lock:
+            if entry in self._pending:
+                value, ttl, _ = self._pending[entry]
+                if value is DELETED:
+                    return False
+                document = codec.loads(value)
+                document.update(changes)
+                self._pending[entry] = (
+                    codec.codec_of(value).dumps(document), ttl, document)
+                return True
+            flushing = entry in self._flushing
+        if flushing:
+            # the backend is patched once the value is written
+            self.flush()
+        return self._backend.update(key, sort_key, changes)
+
+    def delete(self, key, sort_key):
+        self._write([(key, sort_key, DELETED)])
+        return True
+
+    def set_many(self, items, ttl=None, documents=None):
+        self._write(items, ttl, documents)
+        return [True for _ in items]
+
+    def delete_many(self, keys):
+        self._write([(key, sort_key, DELETED) for key, sort_key in keys])
+        return [True for _ in keys]
+
+    def history(self, key, _from='-', _to='+', _desc=True):
+        self.flush()
+        return self._backend.history(key, _from, _to, _desc)
+
+    def history_page(self, key, _from='-', _to='+', _desc=True, limit=100,
+                     cursor=None):
+        self.flush()
+        return self._backend.history_page(key, _from, _to, _desc, limit,
+                                          cursor)
+
+    def latest(self, key):
+        self.flush()
+        return self._backend.latest(key)
+
+    def find(self, index, value):
+        self.flush()
+        return self._backend.find(index, value)
+
+    def find_range(self, index, lo=None, hi=None, limit=None):
+        self.flush()
+        return self._backend.find_range(index, lo, hi, limit)
+
+    def scan(self, page_size=100, concurrency=1):
+        self.flush()
+        return self._backend.scan(page_size, concurrency)
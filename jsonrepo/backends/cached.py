@@ -0,0 +1,224 @@
+# -*- coding: utf8 -*-
+"""
+Read-through cache wrapping any storage backend
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import time
+import threading
+from collections import OrderedDict
+from loggingmixin import LoggingMixin
+from jsonrepo.backend import Backend, ttl_options
+
+# marks a key absent from the cache, None being a cached miss
+NOT_CACHED = object()
+
+
+class CachedBackend(Backend, LoggingMixin):
+    """
+    Backend caching get and latest results of another backend in a bounded
+    LRU, with an optional time to live per entry. Misses are cached too and
+    entries are invalidated on writes. Results read while their entry was
+    invalidated are not cached, invalidations being counted by stripes of
+    entries. Latest values of keys written with a time to live are not
+    cached until the last of these writes expires, the latest value
+    changing when a record expires.
+    """
+    # number of invalidation counters
+    stripes = 1024
+
+    def __init__(self, backend, size=1024, ttl=None):
+        self._backend = backend
+        self._size = size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._invalidations = [0] * self.stripes
+        # latest expiry time of the values written with a ttl per key
+        self._expiries = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name):
+        """ anything else is served by the wrapped backend """
+        if name == '_backend':
+            raise AttributeError(name)
+        return getattr(self._backend, name)
+
+    def stats(self):
+        """ cache counters """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries)
+        }
+
+    def clear(self):
+        """ empty the cache """
+        with self._lock:
+            self._entries.clear()
+
+    def _lookup(self, entry):
+        with self._lock:
+            cached = self._entries.pop(entry, None)
+            if cached is None:
+                self.misses += 1
+                return NOT_CACHED
+            value, expires = cached
+            if expires is not None and expires <= time.time():
+                self.misses += 1
+                return NOT_CACHED
+            # most recently used entries are at the end
+            self._entries[entry] = cached
+            self.hits += 1
+            return value
+
+    def _stripe(self, entry):
+        return hash(entry) % self.stripes
+
+    def _generation(self, entry):
+        """ invalidations of the stripe of an entry, before reading it """
+        with self._lock:
+            return self._invalidations[self._stripe(entry)]
+
+    def _store(self, entry, value, ttl=None, generation=None):
+        """
+        caches value, for ttl seconds at most when the value expires,
+        unless the entry was invalidated since generation
+        """
+        expires = None
+        ttls = [seconds for seconds in (self._ttl, ttl) if seconds is not None]
+        if ttls:
+            expires = time.time() + min(ttls)
+        with self._lock:
+            if generation is not None and \
+                    self._invalidations[self._stripe(entry)] != generation:
+                return
+            self._entries.pop(entry, None)
+            self._entries[entry] = (value, expires)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _invalidate(self, key, sort_key):
+        with self._lock:
+            for entry in (('get', key, sort_key), ('latest', key)):
+                self._entries.pop(entry, None)
+                self._invalidations[self._stripe(entry)] += 1
+
+    def get(self, key, sort_key):
+        entry = ('get', key, sort_key)
+        value = self._lookup(entry)
+        if value is NOT_CACHED:
+            generation = self._generation(entry)
+            value = self._backend.get(key, sort_key)
+            self._store(entry, value, generation=generation)
+        return value
+
+    def _expire(self, key, ttl):
+        """ notes values of key written with a ttl, before writing them """
+        now = time.time()
+        with self._lock:
+            if len(self._expiries) >= self._size:
+                for expired in [other for other, expires
+                                in self._expiries.items() if expires <= now]:
+                    del self._expiries[expired]
+            self._expiries[key] = max(self._expiries.get(key, now),
+                                      now + ttl)
+
+    def _expiring(self, key):
+        """ whether values of key written with a ttl may not have expired """
+        with self._lock:
+            expires = self._expiries.get(key)
+            if expires is not None and expires <= time.time():
+                del self._expiries[key]
+                expires = None
+            return expires is not None
+
+    def latest(self, key):
+        entry = ('latest', key)
+        value = self._lookup(entry)
+        if value is NOT_CACHED:
+            generation = self._generation(entry)
+            value = self._backend.latest(key)
+            if not self._expiring(key):
+                self._store(entry, value, generation=generation)
+        return value
+
+    def set(self, key, sort_key, value, document=None, ttl=None):
+        generation = self._generation(('get', key, sort_key))
+        if ttl is not None:
+            self._expire(key, ttl)
+        res = self._backend.set(key, sort_key, value, document,
+                                **ttl_options(ttl))
+        self._invalidate(key, sort_key)
+        if ttl is not None:
+            # the value is not served from the cache once expired, nor
+            # cached when another write invalidated it meanwhile
+            self._store(('get', key, sort_key), value, ttl, generation + 1)
+        return res
+
+    def update(self, key, sort_key, changes):
+        res = self._backend.update(key, sort_key, changes)
+        self._invalidate(key, sort_key)
+        return res
+
+    def delete(self, key, sort_key):
+        res = self._backend.delete(key, sort_key)
+        self._invalidate(key, sort_key)
+        return res
+
+    def history(self, key, _from='-', _to='+', _desc=True):
+        return self._backend.history(key, _from, _to, _desc)
+
+    def history_page(self, key, _from='-', _to='+', _desc=True, limit=100,
+                     cursor=None):
+        return self._backend.history_page(key, _from, _to, _desc, limit,
+                                          cursor)
+
+    def find(self, index, value):
+        return self._backend.find(index, value)
+
+    def find_range(self, index, lo=None, hi=None, limit=None):
+        return self._backend.find_range(index, lo, hi, limit)
+
+    def scan(self, page_size=100, concurrency=1):
+        return self._backend.scan(page_size, concurrency)
+
+    def get_many(self, keys):
+        values = [self._lookup(('get', key, sort_key))
+                  for key, sort_key in keys]
+        missing = [i for i, value in enumerate(values)
+                   if value is NOT_CACHED]
+        if missing:
+            generations = [self._generation(('get',) + tuple(keys[i]))
+                           for i in missing]
+            fetched = self._backend.get_many([keys[i] for i in missing])
+            for i, value, generation in zip(missing, fetched, generations):
+                self._store(('get',) + tuple(keys[i]), value,
+                            generation=generation)
+                values[i] = value
+        return values
+
+    def set_many(self, items, ttl=None, documents=None):
+        generations = [self._generation(('get', key, sort_key))
+                       for key, sort_key, _ in items]
+        if ttl is not None:
+            for key in set(key for key, _, _ in items):
+                self._expire(key, ttl)
+        res = self._backend.set_many(items, documents=documents,
+                                     **ttl_options(ttl))
+        for (key, sort_key, value), generation in zip(items, generations):
+            self._invalidate(key, sort_key)
+            if ttl is not None:
+                self._store(('get', key, sort_key), value, ttl,
+                            generation + 1)
+        return res
+
+    def delete_many(self, keys):
+        res = self._backend.delete_many(keys)
+        for key, sort_key in keys:
+            self._invalidate(key, sort_key)
+        return res
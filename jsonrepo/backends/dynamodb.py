@@ -1,30 +1,89 @@
-import json
-import boto3
+import math
+import time
+import queue
+import decimal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import boto3.session
 from boto3.dynamodb.conditions import Key
 from loggingmixin import LoggingMixin
-from awesomedecorators import memoized
-from jsonrepo.backend import Backend
+from jsonrepo import codec, connections, metrics
+from jsonrepo.backend import Backend, encode_cursor, decode_cursor, \
+    is_number
+
+
+def ordered_value(value):
+    """ DynamoDB form of an ordered index value, None if not ordered """
+    if is_number(value):
+        # floats are not accepted by boto3
+        return decimal.Decimal(str(value))
+    if isinstance(value, str) and value:
+        return value
+    return None
 
 
 class DynamoDBBackend(Backend, LoggingMixin):
     """
-    Backend based on DynamoDB
+    Backend based on DynamoDB. Each secondary index is a global secondary
+    index named `<index>-index` keyed by the index. Each ordered index is a
+    global secondary index named `<index>-range-index` keyed by the
+    partition_key attribute, holding the table name, and the index as sort
+    key, its values being either numbers or strings.
+    Values with a time to live hold their expiry time in the ttl_attribute
+    attribute, which the time to live of the table must be enabled on and
+    indexes must project. Expired items are skipped until DynamoDB deletes
+    them.
     """
 
     def __init__(self, prefix, key, sort_key,
-                 secondary_indexes):
+                 secondary_indexes, ordered_indexes=()):
         self._prefix = prefix
         self._key = key
         self._sort_key = sort_key
         self._secondary_indexes = secondary_indexes
+        self._ordered_indexes = ordered_indexes
+
+    # maximum number of keys in a BatchGetItem request
+    batch_get_size = 100
+    # maximum number of retries of unprocessed keys
+    max_retries = 8
+    # partition key of the global secondary indexes of ordered indexes
+    partition_key = 'partition'
+    # attribute holding the expiry time of items, in seconds since epoch
+    ttl_attribute = 'expires'
+
+    @classmethod
+    def for_repository(cls, repository):
+        return cls(repository.prefix, repository.key, repository.sort_key,
+                   repository.secondary_indexes,
+                   ordered_indexes=repository.ordered_indexes)
+
+    @staticmethod
+    def count_round_trip(**kwargs):
+        metrics.round_trip()
 
-    @memoized
+    @classmethod
+    def build_resource(cls, region, endpoint_url, config):
+        """ DynamoDB resource with its own session """
+        resource = boto3.session.Session().resource(
+            'dynamodb', region_name=region, endpoint_url=endpoint_url,
+            config=config)
+        # every HTTP request, retries included, is a round trip
+        resource.meta.client.meta.events.register(
+            'before-send.dynamodb', cls.count_round_trip)
+        return resource
+
+    @connections.per_process
+    def dynamodb_resource(self):
+        """ resource shared by backends of the same endpoint """
+        return connections.dynamodb_resource(self.build_resource)
+
+    @connections.per_process
     def dynamodb_server(self):
-        dynamodb = boto3.resource('dynamodb')
-        return dynamodb.Table(self._prefix)
+        return self.dynamodb_resource.Table(self._prefix)
 
-    def get(self, key, sort_key):
-        self.logger.debug('Storage - get {}'.format(self.prefixed(key)))
+    def primary_key(self, key, sort_key):
+        """ build the DynamoDB key of an item """
         query = {
             self._key: self.prefixed(key),
         }
@@ -32,85 +91,346 @@ class DynamoDBBackend(Backend, LoggingMixin):
             query.update({
                 self._sort_key: sort_key
             })
+        return query
+
+    def get(self, key, sort_key):
+        self.logger.debug('Storage - get %s:%s', self._prefix, key)
+        query = self.primary_key(key, sort_key)
         res = self.dynamodb_server.get_item(Key=query)
-        if 'Item' in res and 'value' in res['Item']:
+        if 'Item' in res and 'value' in res['Item'] and \
+                not self.expired(res['Item']):
             return res['Item']['value']
 
-    def set(self, key, sort_key, value):
-        self.logger.debug('Storage - set value {} for {}'
-                          .format(value,
-                                  self.prefixed(key)))
+    def expired(self, item):
+        """ whether an item has expired, DynamoDB deleting it later on """
+        expires = item.get(self.ttl_attribute)
+        return expires is not None and expires <= time.time()
+
+    def values(self, items):
+        """ values of items, skipping expired ones """
+        return [item['value'] for item in items
+                if 'value' in item and not self.expired(item)]
+
+    def item(self, key, sort_key, value, document=None, ttl=None):
+        """ build the DynamoDB item to store value """
         item = {
             self._key: self.prefixed(key),
             'value': value
         }
-        obj = json.loads(value)
+        if ttl is not None:
+            item[self.ttl_attribute] = int(math.ceil(time.time() + ttl))
+        obj = document
+        if obj is None:
+            obj = codec.loads(value)
         for index in self._secondary_indexes:
             if obj.get(index, None) not in ['', None]:
                 item.update({
                     index: obj[index]
                 })
+        if self._ordered_indexes:
+            item[self.partition_key] = self._prefix
+        for index in self._ordered_indexes:
+            value = ordered_value(obj.get(index))
+            if value is not None:
+                item[index] = value
         if sort_key is not None:
             item.update({
                 self._sort_key: sort_key
             })
-        return self.dynamodb_server.put_item(Item=item)
+        return item
+
+    def set(self, key, sort_key, value, document=None, ttl=None):
+        self.logger.debug('Storage - set value %s for %s:%s', value,
+                          self._prefix, key)
+        return self.dynamodb_server.put_item(
+            Item=self.item(key, sort_key, value, document, ttl))
+
+    def update(self, key, sort_key, changes):
+        """
+        Patch a value with UpdateItem, writing the value and the attributes
+        of changed indexes only, the expiry time being kept.
+        Values being stored whole in a single attribute, the value is read
+        first and written back whole on the condition that it did not
+        change meanwhile, retried otherwise. An update is thus a read and a
+        conditional write, more than a save: it spares the caller reading
+        the record and keeps concurrent updates from being lost, it does
+        not spare capacity units.
+        """
+        self.logger.debug('Storage - update %s:%s with %s', self._prefix,
+                          key, changes)
+        query = self.primary_key(key, sort_key)
+        conflict = self.dynamodb_server.meta.client.exceptions \
+            .ConditionalCheckFailedException
+        for attempt in range(self.max_retries + 1):
+            # only the value and its expiry time are needed
+            item = self.dynamodb_server.get_item(
+                Key=query, ProjectionExpression='#value, #expires',
+                ExpressionAttributeNames={
+                    '#value': 'value',
+                    '#expires': self.ttl_attribute}).get('Item')
+            if item is None or 'value' not in item or self.expired(item):
+                return False
+            value = item['value']
+            document = codec.loads(value)
+            document.update(changes)
+            names = {'#value': 'value'}
+            values = {':value': codec.codec_of(value).dumps(document),
+                      ':previous': value}
+            sets = ['#value = :value']
+            removes = []
+            for position, index in enumerate(
+                    [index for index in changes
+                     if index in self._secondary_indexes or
+                     index in self._ordered_indexes]):
+                name = '#index{}'.format(position)
+                names[name] = index
+                if index in self._ordered_indexes:
+                    index_value = ordered_value(changes[index])
+                    missing = index_value is None
+                else:
+                    index_value = changes[index]
+                    missing = index_value in ['', None]
+                if missing:
+                    removes.append(name)
+                else:
+                    values[':index{}'.format(position)] = index_value
+                    sets.append('{} = :index{}'.format(name, position))
+            expression = 'SET ' + ', '.join(sets)
+            if removes:
+                expression += ' REMOVE ' + ', '.join(removes)
+            try:
+                self.dynamodb_server.update_item(
+                    Key=query, UpdateExpression=expression,
+                    ConditionExpression='#value = :previous',
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues=values)
+                return True
+            except conflict:
+                if attempt == self.max_retries:
+                    raise
+                self.logger.debug('Storage - update %s:%s conflicted',
+                                  self._prefix, key)
 
     def delete(self, key, sort_key):
-        self.logger.debug('Storage - delete {}'.format(self.prefixed(key)))
-        query = {
-            self._key: self.prefixed(key),
-        }
-        if sort_key is not None:
-            query.update({
-                self._sort_key: sort_key
-            })
+        self.logger.debug('Storage - delete %s:%s', self._prefix, key)
+        query = self.primary_key(key, sort_key)
         return self.dynamodb_server.delete_item(Key=query)
 
-    def history(self, key, _from='-', _to='+', _desc=True):
-        if _from != '-':
-            response = self.dynamodb_server.query(
-                KeyConditionExpression=Key(self._key)
-                .eq(self.prefixed(key)) &
-                Key(self._sort_key)
-                .gt(_from),
-                Limit=100
-            )
-            return [item['value'] for item in response['Items']]
-        if _to != '+':
-            response = self.dynamodb_server.query(
-                KeyConditionExpression=Key(self._key)
-                .eq(self.prefixed(key)) &
-                Key(self._sort_key)
-                .lt(_to),
-                Limit=100,
-                ScanIndexForward=False
-            )
-            return [item['value'] for item in response['Items']]
-        return []
+    def item_id(self, item):
+        """ hashable identifier of an item from its primary key """
+        return (item[self._key], item.get(self._sort_key))
+
+    def get_many(self, keys):
+        """
+        Get many values with BatchGetItem, retrying unprocessed keys
+        """
+        self.logger.debug('Storage - get many (%s)', len(keys))
+        queries = [self.primary_key(key, sort_key) for key, sort_key in keys]
+        # a batch cannot hold the same key twice: each key is asked once
+        unique = list(dict((self.item_id(query), query)
+                           for query in queries).values())
+        values = {}
+        for start in range(0, len(unique), self.batch_get_size):
+            request = {
+                self._prefix: {
+                    'Keys': unique[start:start + self.batch_get_size]
+                }
+            }
+            retries = 0
+            while request:
+                res = self.dynamodb_resource.batch_get_item(
+                    RequestItems=request)
+                for item in res['Responses'].get(self._prefix, []):
+                    if not self.expired(item):
+                        values[self.item_id(item)] = item.get('value')
+                request = res.get('UnprocessedKeys')
+                if request:
+                    if retries >= self.max_retries:
+                        raise RuntimeError(
+                            'Storage - too many unprocessed keys on {}'
+                            .format(self._prefix))
+                    time.sleep(0.05 * 2 ** retries)
+                    retries += 1
+        return [values.get(self.item_id(query)) for query in queries]
+
+    def set_many(self, items, ttl=None, documents=None):
+        """
+        Set many values with a batch writer, unprocessed items are retried
+        by the batch writer itself
+        """
+        self.logger.debug('Storage - set many (%s)', len(items))
+        # a batch cannot hold the same item twice: the last value wins
+        if documents is None:
+            documents = [None for _ in items]
+        puts = {}
+        for (key, sort_key, value), document in zip(items, documents):
+            item = self.item(key, sort_key, value, document, ttl)
+            puts[self.item_id(item)] = item
+        with self.dynamodb_server.batch_writer() as batch:
+            for item in puts.values():
+                batch.put_item(Item=item)
+        return [True for _ in items]
+
+    def delete_many(self, keys):
+        """
+        Delete many values with a batch writer
+        """
+        self.logger.debug('Storage - delete many (%s)', len(keys))
+        deletes = {}
+        for key, sort_key in keys:
+            query = self.primary_key(key, sort_key)
+            deletes[self.item_id(query)] = query
+        with self.dynamodb_server.batch_writer() as batch:
+            for query in deletes.values():
+                batch.delete_item(Key=query)
+        return [True for _ in keys]
+
+    def history_page(self, key, _from='-', _to='+', _desc=True, limit=100,
+                     cursor=None):
+        condition = Key(self._key).eq(self.prefixed(key))
+        excluded = ()
+        if _from != '-' and _to != '+':
+            # between includes boundaries which are excluded from the range
+            condition &= Key(self._sort_key).between(_from, _to)
+            excluded = (_from, _to)
+        elif _from != '-':
+            condition &= Key(self._sort_key).gt(_from)
+        elif _to != '+':
+            condition &= Key(self._sort_key).lt(_to)
+        params = {
+            'KeyConditionExpression': condition,
+            'Limit': limit,
+            'ScanIndexForward': not _desc
+        }
+        if cursor is not None:
+            params['ExclusiveStartKey'] = decode_cursor(cursor)
+        response = self.dynamodb_server.query(**params)
+        cursor = None
+        if 'LastEvaluatedKey' in response:
+            cursor = encode_cursor(response['LastEvaluatedKey'])
+        return self.values([item for item in response['Items']
+                            if item[self._sort_key] not in excluded]), cursor
 
     def latest(self, key):
-        self.logger.debug('Storage - get latest for {}'.format(
-            self.prefixed(key)
-        ))
-        response = self.dynamodb_server.query(
-            KeyConditionExpression=Key(self._key)
-            .eq(self.prefixed(key)),
-            Limit=1,
-            ScanIndexForward=False
-        )
-        if len(response['Items']) > 0:
-            return response['Items'][0]['value']
-        else:
-            return None
+        self.logger.debug('Storage - get latest for %s:%s', self._prefix,
+                          key)
+        cursor = None
+        while True:
+            # expired items are skipped until deleted
+            values, cursor = self.history_page(key, limit=1, cursor=cursor)
+            if values:
+                return values[0]
+            if cursor is None:
+                return None
+
+    def scan_segment(self, pages, stop, page_size, segment, concurrency):
+        """
+        Puts in pages the values of a segment of a parallel Scan, page by
+        page, then None, or the error raised. Stops early once stop is set.
+        """
+        def put(page):
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        # unlike resources, clients can be shared by threads, the client of
+        # a resource deserializes items as the resource does
+        client = self.dynamodb_resource.meta.client
+        params = {
+            'TableName': self._prefix,
+            'Limit': page_size,
+            'ProjectionExpression': '#value, #expires',
+            'ExpressionAttributeNames': {'#value': 'value',
+                                         '#expires': self.ttl_attribute}
+        }
+        if concurrency > 1:
+            params.update({
+                'Segment': segment,
+                'TotalSegments': concurrency
+            })
+        try:
+            while not stop.is_set():
+                res = client.scan(**params)
+                if not put(self.values(res['Items'])):
+                    return
+                if 'LastEvaluatedKey' not in res:
+                    break
+                params['ExclusiveStartKey'] = res['LastEvaluatedKey']
+        except Exception as error:
+            put(error)
+            return
+        put(None)
+
+    def scan(self, page_size=100, concurrency=1):
+        """
+        Iterates over values of the table with a parallel Scan of
+        concurrency segments run by a pool of threads, pages being yielded
+        as they arrive
+        """
+        self.logger.debug('Storage - scan %s (%s segments)', self._prefix,
+                          concurrency)
+        pages = queue.Queue(maxsize=2 * concurrency)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for segment in range(concurrency):
+                executor.submit(self.scan_segment, pages, stop, page_size,
+                                segment, concurrency)
+            try:
+                running = concurrency
+                while running:
+                    page = pages.get()
+                    if page is None:
+                        running -= 1
+                    elif isinstance(page, Exception):
+                        raise page
+                    elif page:
+                        yield page
+            finally:
+                # segments still running give up once the scan is closed
+                stop.set()
+
+    def find_range(self, index, lo=None, hi=None, limit=None):
+        condition = Key(self.partition_key).eq(self._prefix)
+        if lo is not None and hi is not None:
+            condition &= Key(index).between(ordered_value(lo),
+                                            ordered_value(hi))
+        elif lo is not None:
+            condition &= Key(index).gte(ordered_value(lo))
+        elif hi is not None:
+            condition &= Key(index).lte(ordered_value(hi))
+        params = {
+            'KeyConditionExpression': condition,
+            'IndexName': '{}-range-index'.format(index)
+        }
+        items = []
+        while True:
+            if limit is not None:
+                params['Limit'] = limit - len(items)
+            res = self.dynamodb_server.query(**params)
+            items.extend(self.values(res['Items']))
+            if 'LastEvaluatedKey' not in res or \
+                    (limit is not None and len(items) >= limit):
+                break
+            params['ExclusiveStartKey'] = res['LastEvaluatedKey']
+        return {
+            'count': len(items),
+            'items': items
+        }
 
     def find(self, index, value):
+        if index in self._ordered_indexes:
+            return self.find_range(index, value, value)
         res = self.dynamodb_server.query(
             KeyConditionExpression=Key(index).eq(value),
             IndexName='{}-index'.format(index)
         )
-        self.logger.debug('{}'.format(res))
+        self.logger.debug('%s', res)
+        items = self.values(res['Items'])
         return {
-            'count': res['Count'],
-            'items': [item['value'] for item in res['Items']]
+            'count': len(items),
+            'items': items
         }
@@ -0,0 +1,226 @@
+# -*- coding: utf8 -*-
+"""
+Instrumentation of any storage backend
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+from jsonrepo.backend import Backend, ttl_options
+from jsonrepo.metrics import measure
+
+
+def values_size(values):
+    """ total length of values, None values being empty """
+    return sum(len(value) for value in values if value is not None)
+
+
+class InstrumentedBackend(Backend):
+    """
+    Backend reporting an Operation with latency, payload size, round trips
+    and result size of each call of another backend to hooks
+    """
+
+    def __init__(self, backend, hooks=None):
+        self._backend = backend
+        self.hooks = list(hooks or [])
+
+    def __getattr__(self, name):
+        """ anything else is served by the wrapped backend """
+        if name == '_backend':
+            raise AttributeError(name)
+        return getattr(self._backend, name)
+
+    def get(self, key, sort_key):
+        with measure('get', self.hooks) as operation:
+            value = self._backend.get(key, sort_key)
+            operation.payload_size = values_size([value])
+            operation.result_size = int(value is not None)
+            return value
+
+    def latest(self, key):
+        with measure('latest', self.hooks) as operation:
+            value = self._backend.latest(key)
+            operation.payload_size = values_size([value])
+            operation.result_size = int(value is not None)
+            return value
+
+    def set(self, key, sort_key, value, document=None, ttl=None):
+        with measure('set', self.hooks) as operation:
+            operation.payload_size = len(value)
+            operation.result_size = 1
+            return self._backend.set(key, sort_key, value, document,
+                                     **ttl_options(ttl))
+
+    def update(self, key, sort_key, changes):
+        with measure('update', self.hooks) as operation:
+            operation.result_size = 1
+            return self._backend.update(key, sort_key, changes)
+
+    def delete(self, key, sort_key):
+        with measure('delete', self.hooks) as operation:
+            operation.result_size = 1
+            return self._backend.delete(key, sort_key)
+
+    def history(self, key, _from='-', _to='+', _desc=True):
+        with measure('history', self.hooks) as operation:
+            values = self._backend.history(key, _from, _to, _desc)
+            operation.payload_size = values_size(values)
+            operation.result_size = len(values)
+            return values
+
+    def history_page(self, key, _from='-', _to='+', _desc=True, limit=100,
+                     cursor=None):
+        with measure('history_page', self.hooks) as operation:
+            values, cursor = self._backend.history_page(
+                key, _from, _to, _desc, limit, cursor)
+            operation.payload_size = values_size(values)
+            operation.result_size = len(values)
+            return values, cursor
+
+    def find(self, index, value):
+        with measure('find', self.hooks) as operation:
+            res = self._backend.find(index, value)
+            operation.payload_size = values_size(res['items'])
+            operation.result_size = len(res['items'])
+            return res
+
+    def find_range(self, index, lo=None, hi=None, limit=None):
+        with measure('find_range', self.hooks) as operation:
+            res = self._backend.find_range(index, lo, hi, limit)
+            operation.payload_size = values_size(res['items'])
+            operation.result_size = len(res['items'])
+            return res
+
+    def scan(self, page_size=100, concurrency=1):
+        """ pages are measured one by one as they arrive """
+        pages = iter(self._backend.scan(page_size, concurrency))
+        while True:
+            hooks = list(self.hooks)
+            with measure('scan', hooks) as operation:
+                values = next(pages, None)
+                if values is None:
+                    # the end of the scan is not a page, nor reported
+                    del hooks[:]
+                    return
+                operation.payload_size = values_size(values)
+                operation.result_size = len(values)
+            yield values
+
+    def get_many(self, keys):
+        with measure('get_many', self.hooks) as operation:
+            values = self._backend.get_many(keys)
+            operation.payload_size = values_size(values)
+            operation.result_size = len(
+                [value for value in values if value is not None])
+            return values
+
+    def set_many(self, items, ttl=None, documents=None):
+        with measure('set_many', self.hooks) as operation:
+            operation.payload_size = values_size(
+                [value for _, _, value in items])
+            operation.result_size = len(items)
+            return self._backend.set_many(items, documents=documents,
+                                          **ttl_options(ttl))
+
+    def delete_many(self, keys):
+        with measure('delete_many', self.hooks) as operation:
+            operation.result_size = len(keys)
+            return self._backend.delete_many(keys)
+
+
+class AsyncInstrumentedBackend(object):
+    """
+    Instrumentation of an asyncio backend, the latency of an Operation being
+    the time its call is awaited
+    """
+
+    def __init__(self, backend, hooks=None):
+        self._backend = backend
+        self.hooks = list(hooks or [])
+
+    def __getattr__(self, name):
+        """ anything else is served by the wrapped backend """
+        if name == '_backend':
+            raise AttributeError(name)
+        return getattr(self._backend, name)
+
+    async def get(self, key, sort_key):
+        with measure('get', self.hooks) as operation:
+            value = await self._backend.get(key, sort_key)
+            operation.payload_size = values_size([value])
+            operation.result_size = int(value is not None)
+            return value
+
+    async def latest(self, key):
+        with measure('latest', self.hooks) as operation:
+            value = await self._backend.latest(key)
+            operation.payload_size = values_size([value])
+            operation.result_size = int(value is not None)
+            return value
+
+    async def set(self, key, sort_key, value, document=None, ttl=None):
+        with measure('set', self.hooks) as operation:
+            operation.payload_size = len(value)
+            operation.result_size = 1
+            return await self._backend.set(key, sort_key, value, document,
+                                           **ttl_options(ttl))
+
+    async def update(self, key, sort_key, changes):
+        with measure('update', self.hooks) as operation:
+            operation.result_size = 1
+            return await self._backend.update(key, sort_key, changes)
+
+    async def delete(self, key, sort_key):
+        with measure('delete', self.hooks) as operation:
+            operation.result_size = 1
+            return await self._backend.delete(key, sort_key)
+
+    async def history(self, key, _from='-', _to='+', _desc=True):
+        with measure('history', self.hooks) as operation:
+            values = await self._backend.history(key, _from, _to, _desc)
+            operation.payload_size = values_size(values)
+            operation.result_size = len(values)
+            return values
+
+    async def history_page(self, key, _from='-', _to='+', _desc=True,
+                           limit=100, cursor=None):
+        with measure('history_page', self.hooks) as operation:
+            values, cursor = await self._backend.history_page(
+                key, _from, _to, _desc, limit, cursor)
+            operation.payload_size = values_size(values)
+            operation.result_size = len(values)
+            return values, cursor
+
+    async def find(self, index, value):
+        with measure('find', self.hooks) as operation:
+            res = await self._backend.find(index, value)
+            operation.payload_size = values_size(res['items'])
+            operation.result_size = len(res['items'])
+            return res
+
+    async def find_range(self, index, lo=None, hi=None, limit=None):
+        with measure('find_range', self.hooks) as operation:
+            res = await self._backend.find_range(index, lo, hi, limit)
+            operation.payload_size = values_size(res['items'])
+            operation.result_size = len(res['items'])
+            return res
+
+    async def get_many(self, keys):
+        with measure('get_many', self.hooks) as operation:
+            values = await self._backend.get_many(keys)
+            operation.payload_size = values_size(values)
+            operation.result_size = len(
+                [value for value in values if value is not None])
+            return values
+
+    async def set_many(self, items, ttl=None, documents=None):
+        with measure('set_many', self.hooks) as operation:
+            operation.payload_size = values_size(
+                [value for _, _, value in items])
+            operation.result_size = len(items)
+            return await self._backend.set_many(items, documents=documents,
+                                                **ttl_options(ttl))
+
+    async def delete_many(self, keys):
+        with measure('delete_many', self.hooks) as operation:
+            operation.result_size = len(keys)
+            return await self._backend.delete_many(keys)
@@ -0,0 +1,694 @@
+# -*- coding: utf8 -*-
+"""
+Append-only log-structured file implementation of storage backend
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import os
+import json
+import time
+import mmap
+import zlib
+import heapq
+import struct
+import atexit
+import itertools
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from loggingmixin import LoggingMixin
+from jsonrepo import codec, connections
+from jsonrepo.backend import Backend, encode_cursor, decode_cursor, \
+    ordered_value, ordered_bounds
+
+# crc32 of the rest of the entry, flags, lengths of key, sort key and value
+HEADER = struct.Struct('<IBHHI')
+# expiry time in seconds since epoch, following the header if flagged
+EXPIRY = struct.Struct('<d')
+# flags of an entry
+PUT = 1
+NO_SORT_KEY = 2
+EXPIRES = 4
+
+SNAPSHOT = 'index.snapshot'
+COMPACTING = 'compacting'
+
+
+def encode_entry(key, sort_key, value, expires=None):
+    """
+    Entry of a segment, a None value being a deletion, and the length of
+    its value ending the entry
+    """
+    flags = 0
+    if value is not None:
+        flags |= PUT
+    if sort_key is None:
+        flags |= NO_SORT_KEY
+    expiry = b''
+    if expires is not None:
+        flags |= EXPIRES
+        expiry = EXPIRY.pack(expires)
+    key = key.encode('utf-8')
+    sort_key = (sort_key or '').encode('utf-8')
+    value = (value or '').encode('utf-8')
+    body = HEADER.pack(0, flags, len(key), len(sort_key), len(value))[4:] \
+        + expiry + key + sort_key + value
+    return struct.pack('<I', zlib.crc32(body) & 0xffffffff) + body, \
+        len(value)
+
+
+class LogStore(LoggingMixin):
+    """
+    Segment files of a directory, written by appending entries. Values are
+    located by an in memory index of (key, sort_key) to their position in a
+    segment and read from memory mapped segments.
+    A location is a (segment, value offset, value length, entry length,
+    index values, expiry time) tuple. Expired values are hidden from reads
+    and removed from the index by the next writes.
+    """
+    # size from which the active segment is sealed and a new one started
+    segment_size = 64 * 1024 * 1024
+    # seconds between checks of the background compaction, None to disable
+    compaction_interval = 60.0
+    # ratio of dead bytes in sealed segments triggering a compaction
+    compaction_ratio = 0.5
+    # fsync segments on every write
+    fsync = False
+
+    def __init__(self, directory, secondary_indexes, ordered_indexes=()):
+        self.directory = directory
+        self.secondary_indexes = list(secondary_indexes)
+        self.ordered_indexes = list(ordered_indexes)
+        self.lock = threading.RLock()
+        self.compaction_lock = threading.Lock()
+        self.closed = threading.Event()
+        # (key, sort_key) -> location
+        self.index = {}
+        # key -> sorted sort keys
+        self.sort_keys = {}
+        # index -> index value -> ordered set of (key, sort_key)
+        self.postings = {}
+        # index -> sorted (rank, value, (key, sort_key)) entries
+        self.ordered = {}
+        # heap of (expiry time, counter, (key, sort_key)), entries of
+        # values written again being skipped once popped
+        self.expiries = []
+        self.counter = itertools.count()
+        # segment -> size and dead bytes
+        self.sizes = OrderedDict()
+        self.dead = {}
+        self.maps = {}
+        # forked children do not write the snapshot of their parent
+        self.pid = os.getpid()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.recover()
+        self.load()
+        self.file = open(self.path(self.active), 'ab')
+        self.thread = None
+        if self.compaction_interval:
+            self.thread = threading.Thread(target=self.compaction_loop,
+                                           name='jsonrepo-compaction')
+            self.thread.daemon = True
+            self.thread.start()
+        # the store stays writable at exit, for write-behind buffers
+        atexit.register(self.checkpoint)
+
+    def path(self, segment):
+        return os.path.join(self.directory, '{:08d}.log'.format(segment))
+
+    def segments(self):
+        """ numbers of segment files, in order """
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith('.log') and name[:-4].isdigit())
+
+    @property
+    def active(self):
+        return next(reversed(self.sizes))
+
+    def recover(self):
+        """ completes a compaction interrupted by a crash """
+        marker = os.path.join(self.directory, COMPACTING)
+        if os.path.exists(marker):
+            with open(marker) as handle:
+                target = int(handle.read())
+            compacted = self.path(target) + '.compact'
+            if os.path.exists(compacted):
+                os.replace(compacted, self.path(target))
+            for segment in self.segments():
+                if segment < target:
+                    os.remove(self.path(segment))
+            snapshot = os.path.join(self.directory, SNAPSHOT)
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+            os.remove(marker)
+        for name in os.listdir(self.directory):
+            if name.endswith('.compact'):
+                os.remove(os.path.join(self.directory, name))
+
+    def load(self):
+        """
+        Rebuilds the index from the snapshot, if still valid, and replays
+        the entries appended since, or replays every segment
+        """
+        segments = self.segments() or [1]
+        start = self.load_snapshot(segments)
+        if start is None:
+            start = (segments[0], 0)
+        for segment in segments:
+            if segment < start[0]:
+                continue
+            offset = start[1] if segment == start[0] else 0
+            self.sizes[segment] = self.replay(segment, offset)
+            self.dead.setdefault(segment, 0)
+
+    def load_snapshot(self, segments):
+        """
+        Loads the index snapshot and returns the segment and offset from
+        which entries are replayed, None when it does not match segments
+        """
+        try:
+            with open(os.path.join(self.directory, SNAPSHOT)) as handle:
+                snapshot = json.load(handle)
+        except (IOError, OSError, ValueError):
+            return None
+        if snapshot.get('secondary_indexes') != self.secondary_indexes or \
+                snapshot.get('ordered_indexes') != self.ordered_indexes:
+            return None
+        sizes = [(int(segment), size) for segment, size in snapshot['sizes']]
+        last, last_size = sizes[-1]
+        # sealed segments are unchanged and no segment appeared before last
+        if [segment for segment in segments if segment <= last] != \
+                [segment for segment, _ in sizes]:
+            return None
+        for segment, size in sizes[:-1]:
+            if os.path.getsize(self.path(segment)) != size:
+                return None
+        if os.path.getsize(self.path(last)) < last_size:
+            return None
+        for segment, size in sizes[:-1]:
+            self.sizes[segment] = size
+        self.dead.update((int(segment), size)
+                         for segment, size in snapshot['dead'])
+        for entry in snapshot['entries']:
+            # snapshots of former versions have no expiry time
+            key, sort_key, location = entry[0], entry[1], \
+                tuple(entry[2:7]) + (entry[7] if len(entry) > 7 else None,)
+            self.apply(key, sort_key, location, int(location[0]))
+        return last, last_size
+
+    def write_snapshot(self):
+        """ writes the index snapshot, holding the lock """
+        snapshot = {
+            'secondary_indexes': self.secondary_indexes,
+            'ordered_indexes': self.ordered_indexes,
+            'sizes': list(self.sizes.items()),
+            'dead': list(self.dead.items()),
+            'entries': [list(item) + list(location)
+                        for item, location in self.index.items()]
+        }
+        path = os.path.join(self.directory, SNAPSHOT)
+        with open(path + '.tmp', 'w') as handle:
+            json.dump(snapshot, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(path + '.tmp', path)
+
+    def replay(self, segment, offset):
+        """
+        Applies entries of a segment from offset and returns its size,
+        truncating an entry partially written by a crash
+        """
+        with open(self.path(segment), 'ab+') as handle:
+            handle.seek(0)
+            data = handle.read()
+            while offset + HEADER.size <= len(data):
+                crc, flags, key_length, sort_key_length, value_length = \
+                    HEADER.unpack_from(data, offset)
+                key_offset = offset + HEADER.size
+                expires = None
+                if flags & EXPIRES:
+                    key_offset += EXPIRY.size
+                    if key_offset > len(data):
+                        break
+                    expires, = EXPIRY.unpack_from(data, offset + HEADER.size)
+                value_offset = key_offset + key_length + sort_key_length
+                end = value_offset + value_length
+                if end > len(data) or \
+                        zlib.crc32(data[offset + 4:end]) & 0xffffffff != crc:
+                    break
+                key = data[key_offset:key_offset + key_length].decode('utf-8')
+                sort_key = None
+                if not flags & NO_SORT_KEY:
+                    sort_key = data[key_offset + key_length:
+                                    value_offset].decode('utf-8')
+                location = None
+                if flags & PUT:
+                    location = (segment, value_offset, value_length,
+                                end - offset, self.index_values(
+                                    data[value_offset:end].decode('utf-8')),
+                                expires)
+                self.dead.setdefault(segment, 0)
+                self.apply(key, sort_key, location, segment, end - offset)
+                offset = end
+            if offset < len(data):
+                handle.truncate(offset)
+        return offset
+
+    def index_values(self, value, document=None):
+        """ secondary and ordered index values of a value """
+        indexes = self.secondary_indexes + self.ordered_indexes
+        if not indexes:
+            return None
+        if document is None:
+            document = codec.loads(value)
+        return dict((index, document[index])
+                    for index in indexes if index in document)
+
+    def unindex(self, item, values):
+        """ removes item from postings and ordered indexes """
+        for index, value in (values or {}).items():
+            if index in self.secondary_indexes:
+                postings = self.postings[index]
+                postings[value].pop(item, None)
+                if not postings[value]:
+                    del postings[value]
+            if index in self.ordered_indexes and \
+                    ordered_value(value) is not None:
+                entries = self.ordered[index]
+                del entries[bisect_left(entries,
+                                        ordered_value(value) + (item,))]
+
+    def reindex(self, item, values):
+        """ adds item to postings and ordered indexes """
+        for index, value in (values or {}).items():
+            if index in self.secondary_indexes:
+                self.postings.setdefault(index, {}).setdefault(
+                    value, OrderedDict())[item] = True
+            if index in self.ordered_indexes and \
+                    ordered_value(value) is not None:
+                insort(self.ordered.setdefault(index, []),
+                       ordered_value(value) + (item,))
+
+    def apply(self, key, sort_key, location, segment, entry_length=0):
+        """
+        Updates the index, sort keys and indexes of (key, sort_key) to a
+        new location, None for a deletion written in segment, accounting
+        dead bytes
+        """
+        item = (key, sort_key)
+        previous = self.index.pop(item, None)
+        if previous is not None:
+            self.dead[previous[0]] = \
+                self.dead.get(previous[0], 0) + previous[3]
+            self.unindex(item, previous[4])
+        if location is None:
+            # a deletion is dead as soon as it is written
+            self.dead[segment] = self.dead.get(segment, 0) + entry_length
+            if sort_key is not None and previous is not None:
+                sort_keys = self.sort_keys[key]
+                del sort_keys[bisect_left(sort_keys, sort_key)]
+                if not sort_keys:
+                    del self.sort_keys[key]
+            return previous is not None
+        self.index[item] = location
+        self.reindex(item, location[4])
+        if location[5] is not None:
+            heapq.heappush(self.expiries,
+                           (location[5], next(self.counter), item))
+        if sort_key is not None and previous is None:
+            sort_keys = self.sort_keys.setdefault(key, [])
+            sort_keys.insert(bisect_left(sort_keys, sort_key), sort_key)
+        return True
+
+    def mapped(self, segment, end):
+        """ memory map of a segment covering end, holding the lock """
+        mapping = self.maps.get(segment)
+        if mapping is None or len(mapping) < end:
+            with open(self.path(segment), 'rb') as handle:
+                mapping = self.maps[segment] = mmap.mmap(
+                    handle.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapping
+
+    def read(self, segment, offset, length):
+        """ bytes of a segment, as a view of its memory map """
+        with self.lock:
+            mapping = self.mapped(segment, offset + length)
+        return memoryview(mapping)[offset:offset + length]
+
+    @staticmethod
+    def expired(location):
+        """ whether the value of a location has expired """
+        return location[5] is not None and location[5] <= time.time()
+
+    def evict(self):
+        """
+        Removes expired values from the index, holding the lock, and
+        returns how many. Their entries are dropped by compactions.
+        """
+        evicted = 0
+        now = time.time()
+        while self.expiries and self.expiries[0][0] <= now:
+            expires, _, item = heapq.heappop(self.expiries)
+            location = self.index.get(item)
+            # values written again or deleted meanwhile are left
+            if location is not None and location[5] == expires:
+                self.apply(item[0], item[1], None, location[0])
+                evicted += 1
+        return evicted
+
+    def get(self, key, sort_key):
+        """ value decoded from a view of the memory map of its segment """
+        # the lock keeps the segment from being compacted in between
+        with self.lock:
+            location = self.index.get((key, sort_key))
+            if location is None or self.expired(location):
+                return None
+            segment, offset, length = location[:3]
+            mapping = self.mapped(segment, offset + length)
+        with memoryview(mapping)[offset:offset + length] as view:
+            return str(view, 'utf-8')
+
+    def update(self, key, sort_key, changes):
+        """
+        Patches a value and appends it under the lock, its expiry time
+        being kept. Returns whether the value exists.
+        """
+        with self.lock:
+            location = self.index.get((key, sort_key))
+            value = self.get(key, sort_key)
+            if value is None:
+                return False
+            document = codec.loads(value)
+            document.update(changes)
+            ttl = None
+            if location[5] is not None:
+                ttl = location[5] - time.time()
+            self.write_many([(key, sort_key,
+                              codec.codec_of(value).dumps(document),
+                              document)], ttl)
+        return True
+
+    def write_many(self, entries, ttl=None):
+        """
+        Appends (key, sort_key, value, document) entries, a None value being
+        a deletion, values expiring after ttl seconds if any, and returns
+        whether each entry changed the store
+        """
+        results = []
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            if self.closed.is_set():
+                raise ValueError('Log store of {} is closed'.format(
+                    self.directory))
+            self.evict()
+            segment = self.active
+            offset = self.sizes[segment]
+            chunks = []
+            for key, sort_key, value, document in entries:
+                if value is None and (key, sort_key) not in self.index:
+                    results.append(False)
+                    continue
+                entry, length = encode_entry(key, sort_key, value, expires)
+                chunks.append(entry)
+                location = None
+                if value is not None:
+                    location = (segment, offset + len(entry) - length,
+                                length, len(entry),
+                                self.index_values(value, document), expires)
+                results.append(self.apply(key, sort_key, location, segment,
+                                          len(entry)))
+                offset += len(entry)
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.sizes[segment] = offset
+            if offset >= self.segment_size:
+                self.roll()
+        return results
+
+    def roll(self):
+        """ seals the active segment and starts a new one """
+        self.file.close()
+        segment = self.active + 1
+        self.sizes[segment] = 0
+        self.dead[segment] = 0
+        self.file = open(self.path(segment), 'ab')
+        self.write_snapshot()
+
+    def garbage(self):
+        """ ratio of dead bytes in sealed segments """
+        with self.lock:
+            sealed = list(self.sizes)[:-1]
+            size = sum(self.sizes[segment] for segment in sealed)
+            if not size:
+                return 0.0
+            return float(sum(self.dead[segment]
+                             for segment in sealed)) / size
+
+    def compact(self):
+        """
+        Rewrites sealed segments into the last of them with their live
+        entries only. Entries are copied without holding the lock, writes
+        go on in the active segment meanwhile.
+        Returns whether segments were compacted.
+        """
+        with self.compaction_lock:
+            with self.lock:
+                sealed = list(self.sizes)[:-1]
+                if not sealed:
+                    return False
+                live = sorted((location, item)
+                              for item, location in self.index.items()
+                              if location[0] in self.sizes and
+                              location[0] != self.active)
+            target = sealed[-1]
+            compacted = {}
+            offset = 0
+            with open(self.path(target) + '.compact', 'wb') as handle:
+                for location, item in live:
+                    segment, value_offset, value_length, entry_length, \
+                        values, expires = location
+                    start = value_offset + value_length - entry_length
+                    with self.read(segment, start, entry_length) as view:
+                        handle.write(view)
+                    compacted[item] = (location, (
+                        target, offset + value_offset - start, value_length,
+                        entry_length, values, expires))
+                    offset += entry_length
+                handle.flush()
+                os.fsync(handle.fileno())
+            with self.lock:
+                marker = os.path.join(self.directory, COMPACTING)
+                with open(marker, 'w') as handle:
+                    handle.write(str(target))
+                    handle.flush()
+                    os.fsync(handle.fileno())
+                os.replace(self.path(target) + '.compact', self.path(target))
+                for segment in sealed:
+                    self.maps.pop(segment, None)
+                    del self.sizes[segment]
+                    del self.dead[segment]
+                    if segment != target:
+                        os.remove(self.path(segment))
+                self.sizes[target] = offset
+                self.sizes.move_to_end(target, last=False)
+                self.dead[target] = 0
+                for item, (previous, location) in compacted.items():
+                    if self.index.get(item) == previous:
+                        self.index[item] = location
+                    else:
+                        # overwritten or deleted in between
+                        self.dead[target] += location[3]
+                os.remove(marker)
+                self.write_snapshot()
+            self.logger.info('Storage - compacted %s segments of %s',
+                             len(sealed), self.directory)
+            return True
+
+    def compaction_loop(self):
+        while not self.closed.wait(self.compaction_interval):
+            try:
+                if self.garbage() >= self.compaction_ratio:
+                    self.compact()
+            except Exception:
+                self.logger.error('Storage - compaction of %s failed',
+                                  self.directory, exc_info=True)
+
+    def checkpoint(self):
+        """ writes the index snapshot of an open store """
+        with self.lock:
+            if not self.closed.is_set() and self.pid == os.getpid():
+                self.file.flush()
+                self.write_snapshot()
+
+    def close(self):
+        """ stops compaction and writes the index snapshot """
+        with self.lock:
+            if self.closed.is_set() or self.pid != os.getpid():
+                return
+            self.closed.set()
+            self.file.close()
+            self.write_snapshot()
+            self.maps.clear()
+
+
+class LogFileBackend(Backend, LoggingMixin):
+    """
+    Backend appending records to segment files of a directory per prefix,
+    under the `LOGFILE_PATH` environment variable directory, along with the
+    expiry time of records with a time to live. Backends of the
+    same directory share its store within a process, a directory must be
+    written by a single process.
+    """
+    def __init__(self, prefix, secondary_indexes, path=None,
+                 ordered_indexes=()):
+        super(LogFileBackend, self).__init__(prefix, secondary_indexes,
+                                             ordered_indexes)
+        self._directory = os.path.join(
+            path or connections.setting('LOGFILE_PATH', 'jsonrepo-logs'),
+            prefix)
+
+    @connections.per_process
+    def store(self):
+        return connections.shared(
+            'logfile', self._directory,
+            lambda: LogStore(self._directory, self._secondary_indexes,
+                             self._ordered_indexes))
+
+    def get(self, key, sort_key):
+        self.logger.debug('Storage - get %s:%s:%s', self._prefix, key,
+                          sort_key)
+        return self.store.get('{}'.format(key), self.sort_key(sort_key))
+
+    @staticmethod
+    def sort_key(sort_key):
+        return '{}'.format(sort_key) if sort_key is not None else None
+
+    def set(self, key, sort_key, value, document=None, ttl=None):
+        self.logger.debug('Storage - set value %s for %s:%s:%s', value,
+                          self._prefix, key, sort_key)
+        return self.store.write_many([('{}'.format(key),
+                                       self.sort_key(sort_key), value,
+                                       document)], ttl)[0]
+
+    def update(self, key, sort_key, changes):
+        self.logger.debug('Storage - update %s:%s:%s with %s', self._prefix,
+                          key, sort_key, changes)
+        return self.store.update('{}'.format(key), self.sort_key(sort_key),
+                                 changes)
+
+    def delete(self, key, sort_key):
+        self.logger.debug('Storage - delete %s:%s:%s', self._prefix, key,
+                          sort_key)
+        return self.store.write_many([('{}'.format(key),
+                                       self.sort_key(sort_key), None,
+                                       None)])[0]
+
+    def set_many(self, items, ttl=None, documents=None):
+        """ Append many values at once """
+        self.logger.debug('Storage - set many (%s)', len(items))
+        if documents is None:
+            documents = [None for _ in items]
+        return self.store.write_many([('{}'.format(key),
+                                       self.sort_key(sort_key), value,
+                                       document)
+                                      for (key, sort_key, value), document
+                                      in zip(items, documents)], ttl)
+
+    def delete_many(self, keys):
+        """ Append many deletions at once """
+        self.logger.debug('Storage - delete many (%s)', len(keys))
+        return self.store.write_many([('{}'.format(key),
+                                       self.sort_key(sort_key), None, None)
+                                      for key, sort_key in keys])
+
+    def values(self, key, sort_keys):
+        """ values of sort keys, skipping values deleted in between """
+        values = [self.store.get(key, kid) for kid in sort_keys]
+        return [value for value in values if value is not None]
+
+    def history(self, key, _from='-', _to='+', _desc=True):
+        values, _ = self.history_page(key, _from, _to, _desc, limit=None)
+        return values
+
+    def history_page(self, key, _from='-', _to='+', _desc=True, limit=100,
+                     cursor=None):
+        key = '{}'.format(key)
+        if cursor is not None:
+            cursor = decode_cursor(cursor)
+        with self.store.lock:
+            sort_keys = self.store.sort_keys.get(key, [])
+            # range boundaries by binary search: _from excluded, _to included
+            start = 0 if _from == '-' else bisect_right(sort_keys, _from)
+            end = (len(sort_keys) if _to == '+'
+                   else bisect_right(sort_keys, _to))
+            # the cursor is the last sort key of the previous page
+            if cursor is not None:
+                if _desc:
+                    end = min(end, bisect_left(sort_keys, cursor))
+                else:
+                    start = max(start, bisect_right(sort_keys, cursor))
+            if limit is None:
+                res = sort_keys[start:end][::-1 if _desc else 1]
+            elif _desc:
+                res = sort_keys[max(start, end - limit):end][::-1]
+            else:
+                res = sort_keys[start:min(end, start + limit)]
+        cursor = None
+        if res and limit is not None and end - start > limit:
+            cursor = encode_cursor(res[-1])
+        return self.values(key, res), cursor
+
+    def latest(self, key):
+        self.logger.debug('Storage - get latest for %s:%s', self._prefix,
+                          key)
+        key = '{}'.format(key)
+        with self.store.lock:
+            sort_keys = self.store.sort_keys.get(key, [])
+            # expired values are skipped until evicted
+            for sort_key in reversed(sort_keys):
+                if not self.store.expired(self.store.index[(key, sort_key)]):
+                    return self.store.get(key, sort_key)
+        return None
+
+    def scan(self, page_size=100, concurrency=1):
+        """ Iterates over values of the store, concurrency is ignored """
+        with self.store.lock:
+            items = list(self.store.index)
+        for start in range(0, len(items), page_size):
+            values = [self.store.get(key, sort_key)
+                      for key, sort_key in items[start:start + page_size]]
+            # values deleted in between are skipped
+            values = [value for value in values if value is not None]
+            if values:
+                yield values
+
+    def find(self, index, value):
+        if index in self._ordered_indexes:
+            return self.find_range(index, value, value)
+        with self.store.lock:
+            items = list(self.store.postings.get(index, {}).get(value, ()))
+        # values deleted in between are skipped
+        res = [self.store.get(key, sort_key) for key, sort_key in items]
+        res = [item for item in res if item is not None]
+        return {
+            'count': len(res),
+            'items': res
+        }
+
+    def find_range(self, index, lo=None, hi=None, limit=None):
+        with self.store.lock:
+            entries = self.store.ordered.get(index, [])
+            start, end = ordered_bounds(entries, lo, hi)
+            if limit is not None:
+                end = min(end, start + limit)
+            items = [item for _, _, item in entries[start:end]]
+        # values deleted in between are skipped
+        res = [self.store.get(key, sort_key) for key, sort_key in items]
+        res = [item for item in res if item is not None]
+        return {
+            'count': len(res),
+            'items': res
+        }
@@ -4,30 +4,110 @@ In process memory implementation of storage backend
 Author:   Romary Dupuis <romary@me.com>
 Copyright (C) 2017 Romary Dupuis
 """
-import json
+import time
+import heapq
+import threading
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right, insort
 from loggingmixin import LoggingMixin
 from awesomedecorators import memoized
-from jsonrepo.backend import Backend
+from jsonrepo import codec
+from jsonrepo.backend import Backend, encode_cursor, decode_cursor, \
+    ordered_value, ordered_bounds
 
 CACHE = {}
+# writers of a primary key hold one of these locks, picked by its hash
+LOCKS = [threading.Lock() for _ in range(64)]
+# secondary indexes are updated and read holding this lock
+INDEX_LOCK = threading.Lock()
+# expiry heaps and times are updated holding this lock
+EXPIRY_LOCK = threading.Lock()
 
 
 class DictBackend(Backend, LoggingMixin):
     """
-    Backend based on in process memory
+    Backend based on in process memory. Writes are serialized per primary
+    key with striped locks and secondary indexes have their own lock, reads
+    of values never wait for a lock.
+    Expired values are hidden from reads and deleted by the next writes.
     """
     @memoized
     def cache(self):
         """ In memory storage as a dictionary """
         return CACHE
 
+    def lock(self, key):
+        """ lock of a primary key """
+        return LOCKS[hash(self.prefixed(key)) % len(LOCKS)]
+
     def get(self, key, sort_key):
         """ Get an element in dictionary """
         key = self.prefixed('{}:{}'.format(key, sort_key))
-        self.logger.debug('Storage - get {}'.format(key))
-        if key not in self.cache.keys():
+        self.logger.debug('Storage - get %s', key)
+        value = self.cache.get(key)
+        if value is not None and self.expired(key):
             return None
-        return self.cache[key]
+        return value
+
+    @memoized
+    def expiry(self):
+        """
+        Expiry of values of the prefix: a heap of (time, value key, key,
+        sort_key) entries and expiry times by value key, entries of values
+        written again being skipped once popped
+        """
+        return self.cache.setdefault('expiry', {}).setdefault(
+            self._prefix, {'heap': [], 'at': {}})
+
+    def expired(self, key):
+        """ whether the value of a value key has expired """
+        at = self.expiry['at'].get(key)
+        return at is not None and at <= time.time()
+
+    def live(self, keys):
+        """ values of value keys, skipping deleted and expired ones """
+        values = [(key, self.cache.get(key)) for key in keys]
+        return [value for key, value in values
+                if value is not None and not self.expired(key)]
+
+    def expire(self, key, primary_key, sort_key, ttl):
+        """ sets or clears the expiry of a value key, its lock being held """
+        at = self.expiry['at']
+        if ttl is None and key not in at:
+            return
+        with EXPIRY_LOCK:
+            if ttl is None:
+                del at[key]
+            else:
+                at[key] = time.time() + ttl
+                heapq.heappush(self.expiry['heap'],
+                               (at[key], key, primary_key, sort_key))
+
+    def evict(self):
+        """ deletes expired values, returns how many """
+        heap = self.expiry['heap']
+        now = time.time()
+        try:
+            if heap[0][0] > now:
+                return 0
+        except IndexError:
+            return 0
+        due = []
+        with EXPIRY_LOCK:
+            while heap and heap[0][0] <= now:
+                due.append(heapq.heappop(heap))
+        evicted = 0
+        for at, key, primary_key, sort_key in due:
+            with self.lock(primary_key):
+                # values written again or deleted meanwhile are left
+                if self.expiry['at'].get(key) != at:
+                    continue
+                self._delete(primary_key, sort_key)
+                evicted += 1
+        if evicted:
+            self.logger.debug('Storage - evicted %s values of %s', evicted,
+                              self._prefix)
+        return evicted
 
     def init_secondary_indexes(self):
         if 'secondary_indexes' not in self.cache:
@@ -39,85 +119,240 @@ class DictBackend(Backend, LoggingMixin):
         if index not in self.cache['secondary_indexes']:
             self.cache['secondary_indexes'][index] = {}
 
-    def set(self, key, sort_key, value):
-        primary_key = key
-        key = self.prefixed('{}:{}'.format(key, sort_key))
-        self.logger.debug('Storage - set value {} for {}'.format(value, key))
-        if (self.prefixed(primary_key) not in self.cache.keys() and
-           sort_key is not None):
-            self.cache[self.prefixed(primary_key)] = []
-        if sort_key is not None:
-            self.cache[self.prefixed(primary_key)].append(sort_key)
-            self.cache[self.prefixed(primary_key)] = sorted(
-                self.cache[self.prefixed(primary_key)])
-        p_value = {}
-        if key in self.cache.keys():
-            p_value = json.loads(self.cache[key])
+    @memoized
+    def ordered(self):
+        """
+        Ordered indexes of the prefix as sorted lists of (rank, value, key)
+        entries, see jsonrepo.backend.ordered_value
+        """
+        return self.cache.setdefault('ordered_indexes', {}).setdefault(
+            self._prefix, {})
+
+    def index_update(self, key, prev_obj, obj):
+        """
+        Update secondary indexes of key from its previous decoded value to
+        its new one. Postings are ordered dicts used as ordered sets.
+        """
+        with INDEX_LOCK:
+            self._index_update(key, prev_obj, obj)
+
+    def _index_update(self, key, prev_obj, obj):
         for index in self._secondary_indexes:
-            if index in p_value.keys():
-                self.cache['secondary_indexes'][index][p_value[index]].remove(
-                    key)
-            obj = json.loads(value)
-            if index in obj.keys():
+            prev_index_value = prev_obj.get(index)
+            index_value = obj.get(index)
+            if (index in prev_obj and index in obj and
+               prev_index_value == index_value):
+                continue
+            if index in prev_obj:
+                postings = self.cache['secondary_indexes'][index]
+                postings[prev_index_value].pop(key, None)
+                if not postings[prev_index_value]:
+                    del postings[prev_index_value]
+            if index in obj:
                 self.init_secondary_indexes()
                 self.init_secondary_index(index)
-                if obj[index] not in self.cache['secondary_indexes'][index]:
-                    self.cache['secondary_indexes'][index][obj[index]] = [
-                        key]
-                else:
-                    self.cache['secondary_indexes'][index][obj[index]].append(
-                        key)
-        self.cache[key] = value
-        return self.cache[key] is value
+                postings = self.cache['secondary_indexes'][index]
+                if index_value not in postings:
+                    postings[index_value] = OrderedDict()
+                postings[index_value][key] = True
+        for index in self._ordered_indexes:
+            prev_value = ordered_value(prev_obj.get(index))
+            value = ordered_value(obj.get(index))
+            if prev_value == value:
+                continue
+            entries = self.ordered.setdefault(index, [])
+            if prev_value is not None:
+                position = bisect_left(entries, prev_value + (key,))
+                if (position < len(entries) and
+                   entries[position] == prev_value + (key,)):
+                    del entries[position]
+            if value is not None:
+                insort(entries, value + (key,))
 
-    def delete(self, key, sort_key):
+    def set(self, key, sort_key, value, document=None, ttl=None):
+        primary_key = key
+        key = self.prefixed('{}:{}'.format(key, sort_key))
+        self.logger.debug('Storage - set value %s for %s', value, key)
+        if (self._secondary_indexes or self._ordered_indexes) and \
+                document is None:
+            document = codec.loads(value)
+        with self.lock(primary_key):
+            if sort_key is not None:
+                # sort keys are kept sorted, inserted by binary search
+                sort_keys = self.cache.setdefault(
+                    self.prefixed(primary_key), [])
+                position = bisect_left(sort_keys, sort_key)
+                if (position == len(sort_keys) or
+                   sort_keys[position] != sort_key):
+                    sort_keys.insert(position, sort_key)
+            if self._secondary_indexes or self._ordered_indexes:
+                # previous and new values are decoded once
+                prev_obj = {}
+                if key in self.cache:
+                    prev_obj = codec.loads(self.cache[key])
+                self.index_update(key, prev_obj, document)
+            self.cache[key] = value
+            self.expire(key, primary_key, sort_key, ttl)
+            res = self.cache[key] is value
+        self.evict()
+        return res
+
+    def update(self, key, sort_key, changes):
+        """
+        Patch a value in place, its expiry being kept, and indexes of its
+        changed fields only
+        """
         primary_key = key
         key = self.prefixed('{}:{}'.format(key, sort_key))
+        self.logger.debug('Storage - update %s with %s', key, changes)
+        with self.lock(primary_key):
+            value = self.cache.get(key)
+            if value is None or self.expired(key):
+                return False
+            document = codec.loads(value)
+            indexed = [field for field in changes
+                       if field in self._secondary_indexes or
+                       field in self._ordered_indexes]
+            if indexed:
+                self.index_update(
+                    key, dict((field, document[field]) for field in indexed
+                              if field in document),
+                    dict((field, changes[field]) for field in indexed))
+            document.update(changes)
+            self.cache[key] = codec.codec_of(value).dumps(document)
+            return True
+
+    def delete(self, key, sort_key):
         """ Delete an element in dictionary """
-        self.logger.debug('Storage - delete {}'.format(key))
+        self.logger.debug('Storage - delete %s:%s:%s', self._prefix, key,
+                          sort_key)
+        with self.lock(key):
+            res = self._delete(key, sort_key)
+        self.evict()
+        return res
+
+    def _delete(self, primary_key, sort_key):
+        """ deletes a value, the lock of its primary key being held """
+        key = self.prefixed('{}:{}'.format(primary_key, sort_key))
         if sort_key is not None:
-            self.cache[self.prefixed(primary_key)].remove(sort_key)
-        for index in self._secondary_indexes:
-            obj = json.loads(self.cache[key])
-            if index in obj.keys():
-                self.cache['secondary_indexes'][index][obj[index]].remove(
-                    key)
+            sort_keys = self.cache[self.prefixed(primary_key)]
+            position = bisect_left(sort_keys, sort_key)
+            if (position < len(sort_keys) and
+               sort_keys[position] == sort_key):
+                del sort_keys[position]
+            if not sort_keys:
+                del self.cache[self.prefixed(primary_key)]
+        if self._secondary_indexes or self._ordered_indexes:
+            self.index_update(key, codec.loads(self.cache[key]), {})
         del(self.cache[key])
+        self.expire(key, primary_key, sort_key, None)
         return True
 
+    def values(self, key, sort_keys):
+        """
+        values of sort keys, skipping values deleted in between or expired
+        """
+        values = [self.get(key, kid) for kid in sort_keys]
+        return [value for value in values if value is not None]
+
     def history(self, key, _from='-', _to='+', _desc=True):
-        if _from == '-':
-            _from = ''
-        res = []
-        if self.prefixed(key) in self.cache:
-            for k in self.cache[self.prefixed(key)]:
-                if k > _from:
-                    if _to != '+':
-                        if k > _to:
-                            break
-                    res.append(k)
+        sort_keys = self.cache.get(self.prefixed(key))
+        if not sort_keys:
+            return []
+        with self.lock(key):
+            # range boundaries by binary search: _from excluded, _to included
+            start = 0 if _from == '-' else bisect_right(sort_keys, _from)
+            end = (len(sort_keys) if _to == '+'
+                   else bisect_right(sort_keys, _to))
+            res = sort_keys[start:end]
+        if _desc:
+            res.reverse()
+        return self.values(key, res)
+
+    def history_page(self, key, _from='-', _to='+', _desc=True, limit=100,
+                     cursor=None):
+        sort_keys = self.cache.get(self.prefixed(key))
+        if not sort_keys:
+            return [], None
+        if cursor is not None:
+            cursor = decode_cursor(cursor)
+        with self.lock(key):
+            start = 0 if _from == '-' else bisect_right(sort_keys, _from)
+            end = (len(sort_keys) if _to == '+'
+                   else bisect_right(sort_keys, _to))
+            # the cursor is the last sort key of the previous page
+            if cursor is not None:
+                if _desc:
+                    end = min(end, bisect_left(sort_keys, cursor))
+                else:
+                    start = max(start, bisect_right(sort_keys, cursor))
             if _desc:
-                return [self.get(key, kid) for kid in res][::-1]
-        return [self.get(key, kid) for kid in res]
+                res = sort_keys[max(start, end - limit):end][::-1]
+            else:
+                res = sort_keys[start:min(end, start + limit)]
+        cursor = None
+        if res and end - start > limit:
+            cursor = encode_cursor(res[-1])
+        return self.values(key, res), cursor
 
     def latest(self, key):
-        self.logger.debug('Storage - get latest for {}'.format(
-            self.prefixed(key)
-        ))
-        if self.prefixed(key) not in self.cache:
-            return None
-        if len(self.cache[self.prefixed(key)]) == 0:
-            return None
-        return self.get(key, self.cache[self.prefixed(key)][-1])
+        self.logger.debug('Storage - get latest for %s:%s', self._prefix,
+                          key)
+        sort_keys = self.cache.get(self.prefixed(key))
+        try:
+            # expired values are skipped until evicted
+            position = len(sort_keys) - 1
+            while position >= 0:
+                value = self.get(key, sort_keys[position])
+                if value is not None:
+                    return value
+                position -= 1
+        except (TypeError, IndexError):  # no sort keys
+            pass
+        return None
+
+    def scan(self, page_size=100, concurrency=1):
+        """ Iterates over values of the prefix, concurrency is ignored """
+        prefix = self.prefixed('')
+        page = []
+        # values are strings, sort keys lists and secondary indexes dicts
+        for key, value in list(self.cache.items()):
+            if key.startswith(prefix) and isinstance(value, str) and \
+                    not self.expired(key):
+                page.append(value)
+                if len(page) == page_size:
+                    yield page
+                    page = []
+        if page:
+            yield page
 
     def find(self, index, value):
-        if ('secondary_indexes' in self.cache and
-           index in self.cache['secondary_indexes'] and
-           value in self.cache['secondary_indexes'][index]):
-            res = [self.cache[item]
-                   for item in self.cache['secondary_indexes'][index][value]]
-            return {
-                'count': len(res),
-                'items': res
-            }
-        return {'count': 0, 'items': []}
+        if index in self._ordered_indexes:
+            return self.find_range(index, value, value)
+        with INDEX_LOCK:
+            if ('secondary_indexes' in self.cache and
+               index in self.cache['secondary_indexes'] and
+               value in self.cache['secondary_indexes'][index]):
+                keys = list(self.cache['secondary_indexes'][index][value])
+            else:
+                keys = []
+        # values deleted in between or expired are skipped
+        res = self.live(keys)
+        return {
+            'count': len(res),
+            'items': res
+        }
+
+    def find_range(self, index, lo=None, hi=None, limit=None):
+        with INDEX_LOCK:
+            entries = self.ordered.get(index, [])
+            start, end = ordered_bounds(entries, lo, hi)
+            if limit is not None:
+                end = min(end, start + limit)
+            keys = [key for _, _, key in entries[start:end]]
+        # values deleted in between or expired are skipped
+        res = self.live(keys)
+        return {
+            'count': len(res),
+            'items': res
+        }
@@ -4,34 +4,210 @@ Redis implementation of storage backend
 Author:   Romary Dupuis <romary@me.com>
 Copyright (C) 2017 Romary Dupuis
 """
-import os
 import json
+import time
 import redis
 from loggingmixin import LoggingMixin
 from awesomedecorators import memoized
-from jsonrepo.backend import Backend
+from jsonrepo import codec, connections, metrics
+from jsonrepo.backend import Backend, encode_cursor, decode_cursor, \
+    is_number
+
+
+# Patches top-level fields of the JSON object stored at KEYS[1] without
+# decoding it: members are located by scanning the value, the text of
+# changed ones is replaced and new ones are appended, other members being
+# left as they are. ARGV[1] is 'read' to return 1, the value of the shadow
+# key KEYS[2] and the text of the fields ARGV[2..], or 'write' to set fields
+# from ARGV[2..] pairs of name and JSON text, keeping the time to live.
+# Returns 0 when there is no value.
+PATCH_SCRIPT = """
+local doc = redis.call('GET', KEYS[1])
+if not doc then
+    return 0
+end
+local function invalid()
+    return error('jsonrepo: value is not a JSON object')
+end
+local function skip(p)
+    return string.find(doc, '%S', p) or invalid()
+end
+local function string_end(p)
+    local q = p + 1
+    while true do
+        local c = string.find(doc, '["\\\\]', q)
+        if not c then
+            invalid()
+        end
+        if string.sub(doc, c, c) == '"' then
+            return c + 1
+        end
+        q = c + 2
+    end
+end
+local function value_end(p)
+    local c = string.sub(doc, p, p)
+    if c == '"' then
+        return string_end(p)
+    end
+    if c ~= '{' and c ~= '[' then
+        return string.find(doc, '[,}%s]', p) or invalid()
+    end
+    local depth = 0
+    local q = p
+    while true do
+        local n = string.find(doc, '[%[%]{}"]', q) or invalid()
+        local ch = string.sub(doc, n, n)
+        if ch == '"' then
+            q = string_end(n)
+        else
+            if ch == '{' or ch == '[' then
+                depth = depth + 1
+            else
+                depth = depth - 1
+            end
+            q = n + 1
+            if depth == 0 then
+                return q
+            end
+        end
+    end
+end
+local p = skip(1)
+if string.sub(doc, p, p) ~= '{' then
+    invalid()
+end
+local members = {}
+local count = 0
+local close
+p = skip(p + 1)
+while not close do
+    if string.sub(doc, p, p) == '}' then
+        close = p
+    else
+        if string.sub(doc, p, p) ~= '"' then
+            invalid()
+        end
+        local name_end = string_end(p)
+        local name = string.sub(doc, p + 1, name_end - 2)
+        if string.find(name, '\\\\', 1, true) then
+            name = cjson.decode(string.sub(doc, p, name_end - 1))
+        end
+        p = skip(name_end)
+        p = skip(p + 1)
+        local stop = value_end(p)
+        members[name] = {p, stop - 1}
+        count = count + 1
+        p = skip(stop)
+        if string.sub(doc, p, p) == ',' then
+            p = skip(p + 1)
+        end
+    end
+end
+if ARGV[1] == 'read' then
+    local res = {1, redis.call('GET', KEYS[2])}
+    for i = 2, #ARGV do
+        local span = members[ARGV[i]]
+        res[i + 1] = span and string.sub(doc, span[1], span[2]) or false
+    end
+    return res
+end
+local replaced = {}
+local added = {}
+for i = 2, #ARGV, 2 do
+    local span = members[ARGV[i]]
+    if span then
+        table.insert(replaced, {span[1], span[2], ARGV[i + 1]})
+    else
+        table.insert(added, cjson.encode(ARGV[i]) .. ': ' .. ARGV[i + 1])
+    end
+end
+table.sort(replaced, function(a, b) return a[1] < b[1] end)
+local parts = {}
+local position = 1
+for _, span in ipairs(replaced) do
+    table.insert(parts, string.sub(doc, position, span[1] - 1))
+    table.insert(parts, span[3])
+    position = span[2] + 1
+end
+table.insert(parts, string.sub(doc, position, close - 1))
+if #added > 0 then
+    if count > 0 then
+        table.insert(parts, ', ')
+    end
+    table.insert(parts, table.concat(added, ', '))
+end
+table.insert(parts, string.sub(doc, close))
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl > 0 then
+    redis.call('SET', KEYS[1], table.concat(parts), 'PX', ttl)
+else
+    redis.call('SET', KEYS[1], table.concat(parts))
+end
+return 1
+"""
+
+
+class CountingConnection(redis.Connection):
+    """
+    Connection counting round trips of measured operations
+    """
+    def send_packed_command(self, *args, **kwargs):
+        metrics.round_trip()
+        return super(CountingConnection, self).send_packed_command(
+            *args, **kwargs)
+
+
+class CountingUnixConnection(redis.UnixDomainSocketConnection):
+    """
+    Unix socket connection counting round trips of measured operations
+    """
+    def send_packed_command(self, *args, **kwargs):
+        metrics.round_trip()
+        return super(CountingUnixConnection, self).send_packed_command(
+            *args, **kwargs)
 
 
 class RedisBackend(Backend, LoggingMixin):
     """
-    Backend based on Redis
+    Backend based on Redis. The server defaults to the one defined by
+    environment variables, see jsonrepo.connections.redis_endpoint
+    Values with a time to live expire in Redis, their index entries being
+    kept in a shadow key until writes evict them.
     """
-    @memoized
+    # seconds between evictions of expired values run by writes
+    eviction_interval = 60.0
+    # expired values evicted in a single transaction
+    eviction_batch_size = 100
+
+    def __init__(self, prefix, secondary_indexes, host=None, port=None,
+                 db=None, unix_socket_path=None, ordered_indexes=()):
+        super(RedisBackend, self).__init__(prefix, secondary_indexes,
+                                           ordered_indexes)
+        self._endpoint = connections.redis_endpoint(host, port, db,
+                                                    unix_socket_path)
+        self._next_eviction = time.time() + self.eviction_interval
+
+    def redis_pool(self):
+        """ connection pool shared by backends of the same server """
+        return redis.ConnectionPool(**connections.redis_pool_options(
+            self._endpoint, CountingConnection, CountingUnixConnection))
+
+    @connections.per_process
     def redis_server(self):
-        return redis.StrictRedis(host=os.environ.get('REDIS_HOST', '127.0.0.1'),
-                                 port=os.environ.get('REDIS_PORT', 6379),
-                                 db=os.environ.get('REDIS_DB', 0))
+        return redis.StrictRedis(connection_pool=connections.shared(
+            'redis', self._endpoint, self.redis_pool))
 
     def exists(self, key):
         return self.redis_server.exists(self.prefixed(key))
 
     def keys(self, pattern):
-        return self.redis_server.keys(pattern)
+        """ keys matching pattern, iterated with SCAN not to block redis """
+        return list(self.redis_server.scan_iter(pattern))
 
     def get(self, key, sort_key):
-        self.logger.debug('Storage - get {}'.format(
-            self.prefixed('{}:{}'.format(key, sort_key))
-        ))
+        self.logger.debug('Storage - get %s:%s:%s', self._prefix, key,
+                          sort_key)
         value = self.redis_server.get(
             self.prefixed('{}:{}'.format(key, sort_key))
         )
@@ -39,100 +215,511 @@ class RedisBackend(Backend, LoggingMixin):
             return value.decode('utf-8')
         return value
 
-    def set(self, key, sort_key, value):
-        self.logger.debug('Storage - set value {} for {}'
-                          .format(value,
-                                  self.prefixed(
-                                      '{}:{}'.format(key, sort_key)
-                                  )))
-        if sort_key is not None:
-            self.redis_server.zadd(self.prefixed(key), 0.0, sort_key)
-        prev_value = self.get(key, sort_key)
-        prev_obj = None
-        if prev_value is not None:
-            prev_obj = json.loads(prev_value)
+    def set(self, key, sort_key, value, document=None, ttl=None):
+        self.logger.debug('Storage - set value %s for %s:%s:%s', value,
+                          self._prefix, key, sort_key)
+        return self._write_many([(key, sort_key, value)], [document],
+                                ttl)[0]
+
+    def delete(self, key, sort_key):
+        self.logger.debug('Storage - delete %s:%s:%s', self._prefix, key,
+                          sort_key)
+        return self._write_many([(key, sort_key, None)])[0]
+
+    @connections.per_process
+    def patch_script(self):
+        """ script patching JSON values where they are stored """
+        return self.redis_server.register_script(PATCH_SCRIPT)
+
+    @staticmethod
+    def patch_args(changes):
+        """ arguments of the patch script writing changes """
+        args = ['write']
+        for field, value in changes.items():
+            args.extend([field, json.dumps(value)])
+        return args
+
+    def indexed_fields(self, changes):
+        """ changed fields which are secondary or ordered indexes """
+        return [field for field in changes
+                if field in self._secondary_indexes or
+                field in self._ordered_indexes]
+
+    def _queue_patch_indexes(self, pipe, key, sort_key, changes, indexed,
+                             shadow, texts):
+        """
+        Queue in a MULTI pipe the index updates of a patch from the text of
+        its indexed fields before, along with the shadow of the value
+        """
+        prev_obj = dict((field, json.loads(text))
+                        for field, text in zip(indexed, texts)
+                        if text is not None)
+        obj = dict((field, changes[field]) for field in indexed)
+        self._index_update(pipe, key, sort_key, json.dumps(prev_obj), None,
+                           obj)
+        if shadow is not None:
+            document = json.loads(shadow)
+            document.update(obj)
+            pipe.set(self.shadow_key(key, sort_key),
+                     json.dumps(document, default=str))
+
+    def update(self, key, sort_key, changes):
+        """
+        Patch a JSON value with a Lua script, its time to live being kept.
+        When indexed fields change, their previous text is read by the
+        script under WATCH so that indexes are updated in the same
+        transaction as the patch. Values of other codecs are read and
+        written back.
+        """
+        self.logger.debug('Storage - update %s:%s:%s with %s', self._prefix,
+                          key, sort_key, changes)
+        keys = [self.prefixed('{}:{}'.format(key, sort_key)),
+                self.shadow_key(key, sort_key)]
+        indexed = self.indexed_fields(changes)
+        try:
+            if not indexed:
+                return bool(self.patch_script(
+                    keys=keys, args=self.patch_args(changes),
+                    client=self.redis_server))
+            found = []
+
+            def _update(pipe):
+                res = self.patch_script(keys=keys, args=['read'] + indexed,
+                                        client=pipe)
+                # 0 without value
+                found[:] = [bool(res)]
+                if res:
+                    pipe.multi()
+                    self.patch_script(keys=keys,
+                                      args=self.patch_args(changes),
+                                      client=pipe)
+                    self._queue_patch_indexes(pipe, key, sort_key, changes,
+                                              indexed, res[1], res[2:])
+
+            self.transaction(_update, *keys)
+            return found[0]
+        except redis.ResponseError as error:
+            if 'jsonrepo:' not in str(error):
+                raise
+        return self._update_value(key, sort_key, changes)
+
+    def _update_value(self, key, sort_key, changes):
+        """
+        Read, patch and write back a value in a transaction, its time to
+        live being kept
+        """
+        watched = self.watched_keys([(key, sort_key)])
+        found = []
+
+        def _update(pipe):
+            value, shadow = pipe.mget(watched)
+            ttl = pipe.pttl(watched[0])
+            found[:] = [value is not None]
+            if value is None:
+                return
+            value = value.decode('utf-8')
+            document = codec.loads(value)
+            document.update(changes)
+            pipe.multi()
+            self._queue_writes(
+                pipe, [(key, sort_key, codec.codec_of(value).dumps(document))],
+                [value], [document], [shadow],
+                ttl / 1000.0 if ttl > 0 else None)
+
+        self.transaction(_update, *watched)
+        return found[0]
+
+    def get_many(self, keys):
+        """ Get many values with a single MGET """
+        if not keys:
+            return []
+        self.logger.debug('Storage - get many (%s)', len(keys))
+        values = self.redis_server.mget([
+            self.prefixed('{}:{}'.format(key, sort_key))
+            for key, sort_key in keys
+        ])
+        return [value.decode('utf-8') if value is not None else None
+                for value in values]
+
+    def _index_update(self, pipe, key, sort_key, prev_value, value,
+                      document=None):
+        """
+        Queue in pipe the secondary indexes changes from prev_value to value
+        """
+        if not self._secondary_indexes and not self._ordered_indexes:
+            return
+        if isinstance(prev_value, bytes):
+            prev_value = prev_value.decode('utf-8')
+        prev_obj = codec.loads(prev_value) if prev_value is not None else {}
+        obj = document
+        if obj is None:
+            obj = codec.loads(value) if value is not None else {}
         for sec_index in self._secondary_indexes:
-            if (prev_obj is not None and
-               sec_index in prev_obj.keys()):
-                self.redis_server.srem(
+            if sec_index in prev_obj.keys():
+                pipe.srem(
                     self.prefixed('secondary_indexes:{}:{}'.format(
                         sec_index, prev_obj[sec_index]
                     )),
                     self.prefixed('{}:{}'.format(key, sort_key))
                 )
-            obj = json.loads(value)
             if sec_index in obj.keys():
-                self.redis_server.sadd(
+                pipe.sadd(
                     self.prefixed('secondary_indexes:{}:{}'.format(
                         sec_index, obj[sec_index]
                     )),
                     self.prefixed('{}:{}'.format(key, sort_key))
                 )
-        return self.redis_server.set(self.prefixed(
-            '{}:{}'.format(key, sort_key)), value)
+        value_key = self.prefixed('{}:{}'.format(key, sort_key))
+        for index in self._ordered_indexes:
+            prev_entry = self.ordered_entry(index, prev_obj.get(index),
+                                            value_key)
+            entry = self.ordered_entry(index, obj.get(index), value_key)
+            if prev_entry == entry:
+                continue
+            if prev_entry is not None:
+                pipe.zrem(prev_entry[0], prev_entry[1])
+            if entry is not None:
+                pipe.zadd(entry[0], {entry[1]: entry[2]})
 
-    def delete(self, key, sort_key):
-        self.logger.debug('Storage - delete {}'.format(self.prefixed(
-            '{}:{}'.format(key, sort_key))))
-        if sort_key is not None:
-            self.redis_server.zrem(self.prefixed(key), sort_key)
-        prev_value = self.get(key, sort_key)
-        prev_obj = None
-        if prev_value is not None:
-            prev_obj = json.loads(prev_value)
-        for sec_index in self._secondary_indexes:
-            if (prev_obj is not None and
-                    sec_index in prev_obj.keys()):
-                self.redis_server.srem(
-                    self.prefixed('secondary_indexes:{}:{}'.format(
-                        sec_index, prev_obj[sec_index]
-                    )),
-                    self.prefixed('{}:{}'.format(key, sort_key))
-                )
-        return self.redis_server.delete(self.prefixed(
-            '{}:{}'.format(key, sort_key)))
+    def ordered_entry(self, index, value, value_key):
+        """
+        (sorted set, member, score) of a value of an ordered index: numbers
+        are scores of the value keys, strings are ranged lexicographically
+        in members made of the value and the value key. None for values
+        which are not ordered.
+        """
+        if is_number(value):
+            return (self.prefixed('ordered_indexes:{}'.format(index)),
+                    value_key, value)
+        if isinstance(value, str):
+            return (self.prefixed('ordered_indexes:{}:lex'.format(index)),
+                    '{}\x00{}'.format(value, value_key), 0)
+        return None
+
+    def ordered_ranges(self, index, lo, hi):
+        """
+        Arguments of the ZRANGEBYSCORE and ZRANGEBYLEX commands of a range,
+        numbers coming before strings
+        """
+        ranges = []
+        if not isinstance(lo, str):
+            ranges.append(('score',
+                           self.prefixed('ordered_indexes:{}'.format(index)),
+                           '-inf' if lo is None else lo,
+                           hi if is_number(hi) else '+inf'))
+        if not is_number(hi):
+            # members of hi are hi, a null character and their value key
+            ranges.append(('lex',
+                           self.prefixed('ordered_indexes:{}:lex'.format(
+                               index)),
+                           '[{}'.format(lo) if isinstance(lo, str) else '-',
+                           '+' if hi is None else '({}\x01'.format(hi)))
+        return ranges
+
+    @staticmethod
+    def ordered_keys(kind, members):
+        """ value keys of the members of an ordered index """
+        if kind == 'lex':
+            return [member.split(b'\x00', 1)[1] for member in members]
+        return members
+
+    @memoized
+    def expiries(self):
+        """ sorted set of values with a time to live, scored by expiry """
+        return 'expiries:{}'.format(self._prefix)
+
+    def shadow_key(self, key, sort_key):
+        """
+        key of the index values of a value with a time to live, out of the
+        prefix not to be scanned
+        """
+        return 'expiries:{}'.format(self.prefixed('{}:{}'.format(
+            key, sort_key)))
+
+    def shadow(self, value, document=None):
+        """ index values of a value, indexes being updated once it expired """
+        obj = document
+        if obj is None:
+            obj = codec.loads(value)
+        return json.dumps(dict(
+            (index, obj[index])
+            for index in list(self._secondary_indexes) +
+            list(self._ordered_indexes)
+            if index in obj), default=str)
+
+    def _queue_writes(self, pipe, items, prev_values, documents=None,
+                      prev_shadows=None, ttl=None):
+        """
+        Queue in a MULTI pipe the writes of (key, sort_key, value) triples,
+        a None value meaning a deletion, along with sorted sets and secondary
+        indexes updates, values expiring after ttl seconds if any.
+        prev_shadows are the index values of values which may have expired.
+        Returns positions of SET or DEL results.
+        """
+        if documents is None:
+            documents = [None for _ in items]
+        if prev_shadows is None:
+            prev_shadows = [None for _ in items]
+        positions = []
+        # an item may be written several times in the same transaction
+        written = {}
+        for (key, sort_key, value), prev_value, prev_shadow, document in zip(
+                items, prev_values, prev_shadows, documents):
+            value_key = self.prefixed('{}:{}'.format(key, sort_key))
+            prev_value, prev_shadow = written.get(
+                value_key, (prev_value, prev_shadow))
+            shadow = None
+            if value is not None and ttl is not None:
+                shadow = self.shadow(value, document)
+            written[value_key] = (value, shadow)
+            if sort_key is not None:
+                if value is None:
+                    pipe.zrem(self.prefixed(key), sort_key)
+                else:
+                    pipe.zadd(self.prefixed(key), {sort_key: 0.0})
+            # index entries of an expired value are those of its shadow
+            self._index_update(pipe, key, sort_key,
+                               prev_value if prev_value is not None
+                               else prev_shadow, value, document)
+            if value is None:
+                pipe.delete(value_key)
+            elif ttl is None:
+                pipe.set(value_key, value)
+            else:
+                pipe.set(value_key, value, px=int(ttl * 1000))
+            positions.append(len(pipe) - 1)
+            member = json.dumps([key, sort_key])
+            if shadow is not None:
+                pipe.set(self.shadow_key(key, sort_key), shadow)
+                pipe.zadd(self.expiries, {member: time.time() + ttl})
+            elif prev_shadow is not None:
+                pipe.delete(self.shadow_key(key, sort_key))
+                pipe.zrem(self.expiries, member)
+        return positions
+
+    def watched_keys(self, keys):
+        """
+        value keys and shadow keys of (key, sort_key) pairs, watched by
+        writes
+        """
+        return ([self.prefixed('{}:{}'.format(key, sort_key))
+                 for key, sort_key in keys] +
+                [self.shadow_key(key, sort_key) for key, sort_key in keys])
+
+    def _write_many(self, items, documents=None, ttl=None):
+        """
+        Write (key, sort_key, value) triples, a None value meaning a
+        deletion. Values and their shadows are watched and previous values
+        read at once, then sorted sets, secondary indexes and values are
+        updated in a single MULTI/EXEC transaction, retried if a concurrent
+        writer touched one of the values in between.
+        Returns the result of the SET or DEL command of each item.
+        """
+        watched = self.watched_keys([(key, sort_key)
+                                     for key, sort_key, _ in items])
+        positions = []
+
+        def _write(pipe):
+            prev_values = pipe.mget(watched)
+            pipe.multi()
+            positions[:] = self._queue_writes(
+                pipe, items, prev_values[:len(items)], documents,
+                prev_values[len(items):], ttl)
 
-    def history(self, key, _from='-', _to='+', _desc=True):
+        res = self.transaction(_write, *watched)
+        self.evict_if_due()
+        return [res[position] for position in positions]
+
+    def evict_if_due(self):
+        """ evicts expired values every eviction_interval seconds """
+        if time.time() < self._next_eviction:
+            return
+        self._next_eviction = time.time() + self.eviction_interval
+        self.evict()
+
+    def _queue_evictions(self, pipe, keys, values):
+        """
+        Queue in a MULTI pipe the eviction of (key, sort_key) pairs whose
+        value expired, values being those of their watched keys. Values
+        still there expire soon, clocks of Redis and clients may differ.
+        Returns the number of values evicted.
+        """
+        prev_values, prev_shadows = values[:len(keys)], values[len(keys):]
+        expired = [(key, sort_key, None, shadow)
+                   for (key, sort_key), value, shadow in zip(
+                       keys, prev_values, prev_shadows)
+                   if value is None]
+        self._queue_writes(pipe, [item[:3] for item in expired],
+                           [None for _ in expired], None,
+                           [item[3] for item in expired])
+        for key, sort_key, _, shadow in expired:
+            if shadow is None:
+                # deleted meanwhile
+                pipe.zrem(self.expiries, json.dumps([key, sort_key]))
+        return len(expired)
+
+    def evict(self):
+        """
+        Deletes sort keys, secondary index entries and shadows of values
+        expired by Redis, a batch at once. Returns the number of values
+        evicted.
+        """
+        evicted = 0
+        while True:
+            members = self.redis_server.zrangebyscore(
+                self.expiries, '-inf', time.time(), start=0,
+                num=self.eviction_batch_size)
+            keys = [tuple(json.loads(member)) for member in members]
+            watched = self.watched_keys(keys)
+            count = []
+
+            def _evict(pipe):
+                values = pipe.mget(watched)
+                pipe.multi()
+                count[:] = [self._queue_evictions(pipe, keys, values)]
+
+            if keys:
+                self.transaction(_evict, *watched)
+                evicted += count[0]
+            if not count or not count[0] or \
+                    len(keys) < self.eviction_batch_size:
+                break
+        if evicted:
+            self.logger.debug('Storage - evicted %s values of %s', evicted,
+                              self._prefix)
+        return evicted
+
+    def set_many(self, items, ttl=None, documents=None):
+        """ Set many values in a single transaction """
+        if not items:
+            return []
+        self.logger.debug('Storage - set many (%s)', len(items))
+        return self._write_many(items, documents, ttl=ttl)
+
+    def delete_many(self, keys):
+        """ Delete many values in a single transaction """
+        if not keys:
+            return []
+        self.logger.debug('Storage - delete many (%s)', len(keys))
+        return self._write_many([(key, sort_key, None)
+                                 for key, sort_key in keys])
+
+    def history_range(self, _from, _to, _desc, cursor):
+        """
+        Lexicographical range of a history page, the cursor being the last
+        sort key of the previous page
+        """
+        if cursor is not None:
+            if _desc:
+                _to = decode_cursor(cursor)
+            else:
+                _from = decode_cursor(cursor)
         if _from != '-':
             _from = '({}'.format(_from)
         if _to != '+':
             _to = '({}'.format(_to)
-        res = [self.get(key, kid.decode('utf8'))
-               for kid in self.redis_server.zrevrangebylex(
-                   self.prefixed(key),
-                   _to, _from,
-                   start=0, num=100)]
-        if not _desc:
-            return res[::-1]
-        return res
+        return _from, _to
 
-    def latest(self, key):
-        self.logger.debug('Storage - get latest for {}'.format(
-            self.prefixed(key)
-        ))
-        res = self.redis_server.zrevrangebylex(
-            self.prefixed(key),
-            '+', '-',
-            start=0, num=1
-        )
-        if len(res) > 0:
-            return self.get(key, res[0].decode('utf8'))
+    def history_page(self, key, _from='-', _to='+', _desc=True, limit=100,
+                     cursor=None):
+        _from, _to = self.history_range(_from, _to, _desc, cursor)
+        if _desc:
+            kids = self.redis_server.zrevrangebylex(
+                self.prefixed(key), _to, _from, start=0, num=limit)
         else:
-            return None
+            kids = self.redis_server.zrangebylex(
+                self.prefixed(key), _from, _to, start=0, num=limit)
+        sort_keys = [kid.decode('utf8') for kid in kids]
+        values = self.get_many([(key, sort_key) for sort_key in sort_keys])
+        cursor = None
+        if len(sort_keys) == limit:
+            cursor = encode_cursor(sort_keys[-1])
+        # values deleted in between are skipped
+        return [value for value in values if value is not None], cursor
+
+    def latest(self, key):
+        self.logger.debug('Storage - get latest for %s:%s', self._prefix,
+                          key)
+        cursor = None
+        while True:
+            # sort keys of expired values are skipped until evicted
+            values, cursor = self.history_page(key, limit=1, cursor=cursor)
+            if values:
+                return values[0]
+            if cursor is None:
+                return None
+
+    def scan(self, page_size=100, concurrency=1):
+        """
+        Iterates over values of the prefix with SCAN, each page of keys
+        being read with a single MGET. Pages left empty, of sorted sets or
+        values deleted meanwhile, are skipped. A SCAN cursor cannot be
+        split, concurrency is ignored.
+        """
+        keys = []
+        for key in self.redis_server.scan_iter(self.prefixed('*'),
+                                               count=page_size):
+            keys.append(key)
+            if len(keys) == page_size:
+                values = self._scan_page(keys)
+                if values:
+                    yield values
+                keys = []
+        if keys:
+            values = self._scan_page(keys)
+            if values:
+                yield values
+
+    def _scan_page(self, keys):
+        # sorted sets and secondary index sets are read as None by MGET
+        return [value.decode('utf-8')
+                for value in self.redis_server.mget(keys)
+                if value is not None]
 
     def transaction(self, func, *watchs, **params):
         return self.redis_server.transaction(func, *watchs, **params)
 
+    def find_range(self, index, lo=None, hi=None, limit=None):
+        keys = []
+        for kind, name, _min, _max in self.ordered_ranges(index, lo, hi):
+            if limit is not None and len(keys) >= limit:
+                break
+            window = {}
+            if limit is not None:
+                window = {'start': 0, 'num': limit - len(keys)}
+            if kind == 'score':
+                members = self.redis_server.zrangebyscore(name, _min, _max,
+                                                          **window)
+            else:
+                members = self.redis_server.zrangebylex(name, _min, _max,
+                                                        **window)
+            keys.extend(self.ordered_keys(kind, members))
+        # values deleted in between are skipped
+        items = []
+        if keys:
+            items = [item.decode('utf-8')
+                     for item in self.redis_server.mget(keys)
+                     if item is not None]
+        return {
+            'count': len(items),
+            'items': items
+        }
+
     def find(self, index, value):
+        if index in self._ordered_indexes:
+            return self.find_range(index, value, value)
         keys = self.redis_server.smembers(
             self.prefixed('secondary_indexes:{}:{}'.format(
                 index, value
             ))
         )
-        if keys is not None:
-            return {
-                'count': len(keys),
-                'items': [self.redis_server.get(key.decode('utf-8'))
-                          for key in keys]
-            }
-        return {'count': 0, 'items': []}
+        if not keys:
+            return {'count': 0, 'items': []}
+        # values deleted in between are skipped
+        items = [item.decode('utf-8')
+                 for item in self.redis_server.mget(list(keys))
+                 if item is not None]
+        return {
+            'count': len(items),
+            'items': items
+        }
@@ -0,0 +1,258 @@
+# -*- coding: utf8 -*-
+"""
+Consistent hash sharding of records over several Redis nodes
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import math
+import heapq
+import hashlib
+import itertools
+from bisect import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from loggingmixin import LoggingMixin
+from jsonrepo import codec, connections
+from jsonrepo.backend import Backend, ordered_value, ttl_options
+from jsonrepo.backends.redis import RedisBackend
+
+
+def ring_hash(value):
+    """ position of a value on the ring """
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def redis_node(node):
+    """
+    RedisBackend arguments of a node given as `host:port`, `host:port/db`
+    or the path of a unix socket
+    """
+    if node.startswith('/'):
+        return {'unix_socket_path': node}
+    node, _, db = node.partition('/')
+    host, _, port = node.partition(':')
+    return {'host': host, 'port': int(port) if port else None,
+            'db': int(db) if db else None}
+
+
+class ShardedBackend(Backend, LoggingMixin):
+    """
+    Backend spreading primary keys over Redis nodes by consistent hashing,
+    nodes default to the comma separated `REDIS_NODES` environment
+    variable. The sort keys, values and index entries of a primary key are
+    stored on its node, lookups by index are run on every node in parallel
+    and merged.
+    """
+    # points of each node on the ring
+    replicas = 128
+    # threads running requests to nodes in parallel
+    max_workers = 16
+
+    def __init__(self, prefix, secondary_indexes, nodes=None,
+                 ordered_indexes=()):
+        super(ShardedBackend, self).__init__(prefix, secondary_indexes,
+                                             ordered_indexes)
+        if nodes is None:
+            nodes = connections.setting('REDIS_NODES', '127.0.0.1:6379')
+            nodes = [node.strip() for node in nodes.split(',')]
+        self.shards = OrderedDict()
+        self._ring = []
+        self._owners = []
+        for node in nodes:
+            self.shards[node] = self.shard(node)
+        self.build_ring()
+
+    def shard(self, node):
+        """ backend storing the records of a node """
+        return RedisBackend(self._prefix, self._secondary_indexes,
+                            ordered_indexes=self._ordered_indexes,
+                            **redis_node(node))
+
+    def build_ring(self):
+        """ sorted points of the nodes and their owners """
+        points = sorted((ring_hash('{}#{}'.format(node, replica)), node)
+                        for node in self.shards
+                        for replica in range(self.replicas))
+        self._ring = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node(self, key):
+        """ node owning a primary key """
+        position = bisect(self._ring, ring_hash('{}'.format(key)))
+        return self._owners[position % len(self._owners)]
+
+    def route(self, key):
+        """ backend owning a primary key """
+        return self.shards[self.node(key)]
+
+    @connections.per_process
+    def executor(self):
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def fan_out(self, func):
+        """ results of func called on every shard in parallel """
+        return list(self.executor.map(func, list(self.shards.values())))
+
+    def group(self, items):
+        """ positions of items by node, items starting with a key """
+        groups = OrderedDict()
+        for position, item in enumerate(items):
+            groups.setdefault(self.node(item[0]), []).append(position)
+        return groups
+
+    def dispatch(self, method, items, documents=None, **options):
+        """
+        Results of a bulk method called once per node with its items, and
+        their documents if any, in the order of items
+        """
+        groups = self.group(items)
+
+        def call(node):
+            kwargs = dict(options)
+            if documents is not None:
+                kwargs['documents'] = [documents[position]
+                                       for position in groups[node]]
+            return getattr(self.shards[node], method)(
+                [items[position] for position in groups[node]], **kwargs)
+
+        results = [None for _ in items]
+        for node, res in zip(groups,
+                             self.executor.map(call, list(groups))):
+            for position, result in zip(groups[node], res):
+                results[position] = result
+        return results
+
+    def get(self, key, sort_key):
+        return self.route(key).get(key, sort_key)
+
+    def set(self, key, sort_key, value, document=None, ttl=None):
+        return self.route(key).set(key, sort_key, value, document, ttl)
+
+    def delete(self, key, sort_key):
+        return self.route(key).delete(key, sort_key)
+
+    def update(self, key, sort_key, changes):
+        return self.route(key).update(key, sort_key, changes)
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return self.dispatch('get_many', keys)
+
+    def set_many(self, items, ttl=None, documents=None):
+        if not items:
+            return []
+        return self.dispatch('set_many', items, documents,
+                             **ttl_options(ttl))
+
+    def delete_many(self, keys):
+        if not keys:
+            return []
+        return self.dispatch('delete_many', keys)
+
+    def history(self, key, _from='-', _to='+', _desc=True):
+        return self.route(key).history(key, _from, _to, _desc)
+
+    def history_page(self, key, _from='-', _to='+', _desc=True, limit=100,
+                     cursor=None):
+        return self.route(key).history_page(key, _from, _to, _desc, limit,
+                                            cursor)
+
+    def latest(self, key):
+        return self.route(key).latest(key)
+
+    def find(self, index, value):
+        results = self.fan_out(lambda shard: shard.find(index, value))
+        items = [item for res in results for item in res['items']]
+        return {
+            'count': len(items),
+            'items': items
+        }
+
+    def find_range(self, index, lo=None, hi=None, limit=None):
+        results = self.fan_out(
+            lambda shard: shard.find_range(index, lo, hi, limit))
+        # values of each node are in index order
+        items = list(itertools.islice(heapq.merge(
+            *[res['items'] for res in results],
+            key=lambda item: ordered_value(codec.loads(item).get(index))),
+            limit))
+        return {
+            'count': len(items),
+            'items': items
+        }
+
+    def scan(self, page_size=100, concurrency=1):
+        for shard in list(self.shards.values()):
+            for page in shard.scan(page_size, concurrency):
+                yield page
+
+    def evict(self):
+        """ evicts expired values of every node """
+        return sum(self.fan_out(lambda shard: shard.evict()))
+
+    def primary_keys(self, shard):
+        """ primary keys stored by a shard, with their sort keys """
+        prefix = shard.prefixed('')
+        ordered = shard.prefixed('ordered_indexes:')
+        for name in shard.redis_server.scan_iter(prefix + '*',
+                                                 _type='ZSET'):
+            name = name.decode('utf-8')
+            if name.startswith(ordered):
+                continue
+            yield name[len(prefix):], [
+                sort_key.decode('utf-8') for sort_key in
+                shard.redis_server.zrange(name, 0, -1)]
+
+    def rebalance(self):
+        """
+        Moves records stored by a node which does not own their primary key
+        anymore to their owner, returns the number of records moved.
+        Records being moved may be missed by reads.
+        """
+        moved = 0
+        for node, shard in list(self.shards.items()):
+            for key, sort_keys in list(self.primary_keys(shard)):
+                owner = self.node(key)
+                if owner == node or not sort_keys:
+                    continue
+                keys = [(key, sort_key) for sort_key in sort_keys]
+                values = shard.get_many(keys)
+                # values keep what is left of their time to live
+                pipe = shard.redis_server.pipeline(transaction=False)
+                for sort_key in sort_keys:
+                    pipe.pttl(shard.prefixed('{}:{}'.format(key, sort_key)))
+                groups = OrderedDict()
+                for sort_key, value, pttl in zip(sort_keys, values,
+                                                 pipe.execute()):
+                    if value is not None:
+                        ttl = int(math.ceil(pttl / 1000.0)) if pttl > 0 \
+                            else None
+                        groups.setdefault(ttl, []).append(
+                            (key, sort_key, value))
+                for ttl, items in groups.items():
+                    self.shards[owner].set_many(items, **ttl_options(ttl))
+                    moved += len(items)
+                # sort keys of expired values are dropped as well
+                shard.delete_many(keys)
+        self.logger.info('Storage - rebalanced %s records of %s', moved,
+                         self._prefix)
+        return moved
+
+    def add_node(self, node):
+        """ adds a node and moves the records it owns to it """
+        self.shards[node] = self.shard(node)
+        self.build_ring()
+        return self.rebalance()
+
+    def remove_node(self, node):
+        """ moves the records of a node to the other nodes and removes it """
+        shard = self.shards[node]
+        del self.shards[node]
+        self.build_ring()
+        # the removed node is rebalanced like any other node
+        self.shards[node] = shard
+        try:
+            return self.rebalance()
+        finally:
+            del self.shards[node]
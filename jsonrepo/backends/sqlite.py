@@ -0,0 +1,410 @@
+# -*- coding: utf8 -*-
+"""
+SQLite implementation of storage backend
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from awesomedecorators import memoized
+from loggingmixin import LoggingMixin
+from jsonrepo import codec, connections
+from jsonrepo.backend import Backend, encode_cursor, decode_cursor, \
+    ordered_value
+
+
+def quote(name):
+    """ quoted SQL identifier """
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def index_value(value):
+    """
+    value of a secondary index column, JSON for structured values and
+    booleans which would match 1 and 0 otherwise
+    """
+    if value is None or (isinstance(value, (str, int, float)) and
+                         not isinstance(value, bool)):
+        return value
+    return json.dumps(value, sort_keys=True)
+
+
+class SQLiteBackend(Backend, LoggingMixin):
+    """
+    Backend based on a SQLite database in WAL mode, the file defaults to
+    the `SQLITE_PATH` environment variable. Records of a prefix are stored
+    in a table whose primary key is (key, sort_key), each secondary or
+    ordered index being a column with its own SQL index, ranged for
+    find_range. Every thread uses its own
+    connection whose statements are prepared once and cached.
+    Records with a time to live hold their expiry time in the expires
+    column, expired records are skipped by reads and deleted by writes.
+    """
+    # maximum number of (key, sort_key) pairs in a single SELECT
+    batch_get_size = 400
+    # size of the prepared statements cache of connections
+    cached_statements = 64
+    # seconds to wait for the lock of a concurrent writer
+    timeout = 30.0
+    # seconds between deletions of expired records by writes
+    eviction_interval = 60.0
+    # condition on records which have not expired, given the time
+    live = '(expires IS NULL OR expires > ?)'
+
+    def __init__(self, prefix, secondary_indexes, path=None,
+                 ordered_indexes=()):
+        super(SQLiteBackend, self).__init__(prefix, secondary_indexes,
+                                            ordered_indexes)
+        self._path = path or connections.setting('SQLITE_PATH',
+                                                 'jsonrepo.sqlite3')
+        self._evicted_at = 0.0
+
+    @memoized
+    def table(self):
+        return quote(self._prefix)
+
+    @memoized
+    def indexes(self):
+        """ secondary and ordered indexes """
+        return list(self._secondary_indexes) + [
+            index for index in self._ordered_indexes
+            if index not in self._secondary_indexes]
+
+    @memoized
+    def columns(self):
+        """ quoted columns of indexes """
+        return [quote('index_{}'.format(index)) for index in self.indexes]
+
+    @memoized
+    def statements(self):
+        """ SQL statements, built once """
+        table = self.table
+        columns = ''.join(', {}'.format(column) for column in self.columns)
+        return {
+            'get': 'SELECT value FROM {} WHERE key = ? AND sort_key = ? '
+                   'AND {}'.format(table, self.live),
+            'set': 'INSERT OR REPLACE INTO {} (key, sort_key, value, '
+                   'expires{}) VALUES (?, ?, ?, ?{})'.format(
+                       table, columns, ', ?' * len(self.columns)),
+            'delete': 'DELETE FROM {} WHERE key = ? AND sort_key = ?'
+                      .format(table),
+            'latest': 'SELECT value FROM {} WHERE key = ? AND sort_key > \'\' '
+                      'AND {} ORDER BY sort_key DESC LIMIT 1'.format(
+                          table, self.live),
+            'evict': 'DELETE FROM {} WHERE expires <= ?'.format(table),
+            'update': 'SELECT value, expires FROM {} WHERE key = ? AND '
+                      'sort_key = ? AND {}'.format(table, self.live),
+        }
+
+    def create_schema(self, connection):
+        """ table, secondary index columns and their SQL indexes """
+        with self.transaction(connection):
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS {} (key TEXT NOT NULL, '
+                'sort_key TEXT NOT NULL, value TEXT NOT NULL, '
+                'PRIMARY KEY (key, sort_key)) WITHOUT ROWID'.format(
+                    self.table))
+            existing = set(quote(row[1]) for row in connection.execute(
+                'PRAGMA table_info({})'.format(self.table)))
+            if quote('expires') not in existing:
+                connection.execute('ALTER TABLE {} ADD COLUMN expires REAL'
+                                   .format(self.table))
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS {} ON {} (expires)'.format(
+                    quote('{}__expires'.format(self._prefix)), self.table))
+            for index, column in zip(self.indexes, self.columns):
+                if column not in existing:
+                    connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                        self.table, column))
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                        quote('{}_{}'.format(self._prefix, index)),
+                        self.table, column))
+
+    def connect(self):
+        """ connection in autocommit mode, transactions being explicit """
+        connection = sqlite3.connect(
+            self._path, timeout=self.timeout, isolation_level=None,
+            cached_statements=self.cached_statements)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        self.create_schema(connection)
+        return connection
+
+    @connections.per_process
+    def local(self):
+        """ connections of threads """
+        return threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+        return connection
+
+    @contextmanager
+    def transaction(self, connection=None):
+        """
+        Runs the block in a write transaction, rolled back on errors
+        """
+        if connection is None:
+            connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def row(self, key, sort_key, value, document=None, ttl=None):
+        """ parameters of the set statement """
+        params = [key, sort_key if sort_key is not None else '', value,
+                  time.time() + ttl if ttl is not None else None]
+        if self.indexes:
+            obj = document
+            if obj is None:
+                obj = codec.loads(value)
+            params.extend(self.column_value(index, obj.get(index))
+                          for index in self.indexes)
+        return params
+
+    def column_value(self, index, value):
+        """
+        value of the column of an index, NULL for values of ordered indexes
+        which are neither numbers nor strings as they are not ordered
+        """
+        if index in self._ordered_indexes and ordered_value(value) is None:
+            return None
+        return index_value(value)
+
+    def get(self, key, sort_key):
+        self.logger.debug('Storage - get %s:%s:%s', self._prefix, key,
+                          sort_key)
+        row = self.connection.execute(
+            self.statements['get'],
+            (key, sort_key if sort_key is not None else '',
+             time.time())).fetchone()
+        if row is not None:
+            return row[0]
+        return None
+
+    def set(self, key, sort_key, value, document=None, ttl=None):
+        self.logger.debug('Storage - set value %s for %s:%s:%s', value,
+                          self._prefix, key, sort_key)
+        params = self.row(key, sort_key, value, document, ttl)
+        with self.transaction() as connection:
+            connection.execute(self.statements['set'], params)
+            self.evict_if_due(connection)
+        return True
+
+    def update(self, key, sort_key, changes):
+        """
+        Read, patch and write back a value in a single write transaction,
+        its expiry time being kept
+        """
+        self.logger.debug('Storage - update %s:%s:%s with %s', self._prefix,
+                          key, sort_key, changes)
+        with self.transaction() as connection:
+            row = connection.execute(
+                self.statements['update'],
+                (key, sort_key if sort_key is not None else '',
+                 time.time())).fetchone()
+            if row is None:
+                return False
+            value, expires = row
+            document = codec.loads(value)
+            document.update(changes)
+            params = self.row(key, sort_key,
+                              codec.codec_of(value).dumps(document), document)
+            params[3] = expires
+            connection.execute(self.statements['set'], params)
+            self.evict_if_due(connection)
+        return True
+
+    def evict_if_due(self, connection):
+        """
+        Deletes expired records in the transaction of a write, once every
+        eviction_interval seconds
+        """
+        now = time.time()
+        if now - self._evicted_at >= self.eviction_interval:
+            self._evicted_at = now
+            self.evict(connection)
+
+    def evict(self, connection=None):
+        """ deletes expired records, returns how many """
+        if connection is None:
+            with self.transaction() as connection:
+                return self.evict(connection)
+        evicted = connection.execute(self.statements['evict'],
+                                     (time.time(),)).rowcount
+        if evicted:
+            self.logger.debug('Storage - evicted %s values of %s', evicted,
+                              self._prefix)
+        return evicted
+
+    def delete(self, key, sort_key):
+        self.logger.debug('Storage - delete %s:%s:%s', self._prefix, key,
+                          sort_key)
+        return self.delete_many([(key, sort_key)])[0]
+
+    def get_many(self, keys):
+        """ Get many values with a SELECT per batch of keys """
+        if not keys:
+            return []
+        self.logger.debug('Storage - get many (%s)', len(keys))
+        keys = [(key, sort_key if sort_key is not None else '')
+                for key, sort_key in keys]
+        values = {}
+        now = time.time()
+        for start in range(0, len(keys), self.batch_get_size):
+            batch = keys[start:start + self.batch_get_size]
+            params = [param for pair in batch for param in pair] + [now]
+            values.update(((key, sort_key), value)
+                          for key, sort_key, value in self.connection.execute(
+                              'SELECT key, sort_key, value FROM {} WHERE '
+                              '(key, sort_key) IN (VALUES {}) AND {}'.format(
+                                  self.table,
+                                  ', '.join(['(?, ?)'] * len(batch)),
+                                  self.live),
+                              params))
+        return [values.get(pair) for pair in keys]
+
+    def set_many(self, items, ttl=None, documents=None):
+        """ Set many values in a single transaction """
+        if not items:
+            return []
+        self.logger.debug('Storage - set many (%s)', len(items))
+        if documents is None:
+            documents = [None for _ in items]
+        rows = [self.row(key, sort_key, value, document, ttl)
+                for (key, sort_key, value), document in zip(items, documents)]
+        with self.transaction() as connection:
+            connection.executemany(self.statements['set'], rows)
+            self.evict_if_due(connection)
+        return [True for _ in items]
+
+    def delete_many(self, keys):
+        """ Delete many values in a single transaction """
+        if not keys:
+            return []
+        self.logger.debug('Storage - delete many (%s)', len(keys))
+        with self.transaction() as connection:
+            res = [connection.execute(
+                self.statements['delete'],
+                (key, sort_key if sort_key is not None else '')).rowcount > 0
+                for key, sort_key in keys]
+            self.evict_if_due(connection)
+            return res
+
+    def history_query(self, _from, _to, _desc, cursor=None):
+        """
+        Statement and parameters of a sort key range, _from excluded and
+        _to included, records without sort key being left out. The cursor is
+        the last sort key of a previous page.
+        """
+        query = 'SELECT sort_key, value FROM {} WHERE key = ? AND ' \
+                'sort_key > ? AND {}'.format(self.table, self.live)
+        params = [_from if _from != '-' else '', time.time()]
+        if _to != '+':
+            query += ' AND sort_key <= ?'
+            params.append(_to)
+        if cursor is not None:
+            query += ' AND sort_key {} ?'.format('<' if _desc else '>')
+            params.append(cursor)
+        query += ' ORDER BY sort_key {}'.format('DESC' if _desc else 'ASC')
+        return query, params
+
+    def history(self, key, _from='-', _to='+', _desc=True):
+        query, params = self.history_query(_from, _to, _desc)
+        return [value for _, value in self.connection.execute(
+            query, [key] + params)]
+
+    def history_page(self, key, _from='-', _to='+', _desc=True, limit=100,
+                     cursor=None):
+        if cursor is not None:
+            cursor = decode_cursor(cursor)
+        query, params = self.history_query(_from, _to, _desc, cursor)
+        # one more row tells whether a next page exists
+        rows = self.connection.execute(query + ' LIMIT ?',
+                                       [key] + params + [limit + 1])
+        rows = rows.fetchall()
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = encode_cursor(rows[-1][0])
+        return [value for _, value in rows], cursor
+
+    def latest(self, key):
+        self.logger.debug('Storage - get latest for %s:%s', self._prefix,
+                          key)
+        row = self.connection.execute(self.statements['latest'],
+                                      (key, time.time())).fetchone()
+        if row is not None:
+            return row[0]
+        return None
+
+    def scan(self, page_size=100, concurrency=1):
+        """
+        Iterates over values of the table in primary key order, a query per
+        page starting after the last key of the previous one so that no read
+        transaction is held in between. Concurrency is ignored.
+        """
+        query = 'SELECT key, sort_key, value, {} FROM {} {}' \
+                'ORDER BY key, sort_key LIMIT ?'
+        rows = self.connection.execute(
+            query.format(self.live, self.table, ''),
+            (time.time(), page_size)).fetchall()
+        while rows:
+            # expired values are skipped but still move the cursor on
+            page = [value for _, _, value, live in rows if live]
+            if page:
+                yield page
+            if len(rows) < page_size:
+                return
+            rows = self.connection.execute(
+                query.format(self.live, self.table,
+                             'WHERE (key, sort_key) > (?, ?) '),
+                (time.time(), rows[-1][0], rows[-1][1],
+                 page_size)).fetchall()
+
+    def find_range(self, index, lo=None, hi=None, limit=None):
+        if index not in self._ordered_indexes:
+            return {'count': 0, 'items': []}
+        column = quote('index_{}'.format(index))
+        # numbers are ordered before strings by SQLite too
+        query = 'SELECT value FROM {} WHERE {} IS NOT NULL AND {}'.format(
+            self.table, column, self.live)
+        params = [time.time()]
+        if lo is not None:
+            query += ' AND {} >= ?'.format(column)
+            params.append(self.column_value(index, lo))
+        if hi is not None:
+            query += ' AND {} <= ?'.format(column)
+            params.append(self.column_value(index, hi))
+        query += ' ORDER BY {}'.format(column)
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        items = [item for item, in self.connection.execute(query, params)]
+        return {
+            'count': len(items),
+            'items': items
+        }
+
+    def find(self, index, value):
+        if index not in self.indexes:
+            return {'count': 0, 'items': []}
+        items = [item for item, in self.connection.execute(
+            'SELECT value FROM {} WHERE {} = ? AND {}'.format(
+                self.table, quote('index_{}'.format(index)), self.live),
+            (self.column_value(index, value), time.time()))]
+        return {
+            'count': len(items),
+            'items': items
+        }
@@ -0,0 +1,214 @@
+# -*- coding: utf8 -*-
+"""
+Serialization codecs of records
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import zlib
+import json
+import base64
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# stored values starting with TAG are '#<codec name>:<payload>', other
+# values are plain JSON which can never start with TAG
+TAG = '#'
+
+
+class Codec(object):
+    """
+    Definition of a serialization codec. Codecs producing JSON are stored
+    untagged, others are tagged with their name so that values written with
+    different codecs can be read side by side.
+    """
+    name = None
+    tagged = True
+
+    def encode(self, obj):
+        """ serializes obj into a string payload """
+        raise NotImplementedError
+
+    def decode(self, payload):
+        """ deserializes a string payload """
+        raise NotImplementedError
+
+    def dumps(self, obj):
+        """ serializes obj into a stored value """
+        if self.tagged:
+            return '{}{}:{}'.format(TAG, self.name, self.encode(obj))
+        return self.encode(obj)
+
+    def loads(self, value):
+        """ deserializes a stored value, whatever its codec """
+        return loads(value, self)
+
+    def codec_of(self, payload):
+        """ codec writing values like payload, itself by default """
+        return self
+
+
+class JSONCodec(Codec):
+    """ Standard library JSON codec """
+    name = 'json'
+    tagged = False
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class OrJSONCodec(Codec):
+    """ orjson codec, producing plain JSON faster """
+    name = 'orjson'
+    tagged = False
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('orjson is required by OrJSONCodec')
+
+    def encode(self, obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def decode(self, payload):
+        return orjson.loads(payload)
+
+
+class MsgpackCodec(Codec):
+    """
+    MessagePack codec. Values are stored as text by every backend, so the
+    binary payload is base64 encoded.
+    """
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('msgpack is required by MsgpackCodec')
+
+    def encode(self, obj):
+        return base64.b64encode(
+            msgpack.packb(obj, use_bin_type=True)).decode('ascii')
+
+    def decode(self, payload):
+        return msgpack.unpackb(base64.b64decode(payload), raw=False)
+
+
+# codecs of zlib preset dictionaries by dictionary id
+DICTIONARIES = {}
+
+
+class ZlibCodec(Codec):
+    """
+    Compression of the values of another codec, JSON by default, from
+    threshold characters on. Compressed values are tagged with the id of
+    their zlib preset dictionary, if any, and base64 encoded. Values that
+    would not shrink are stored as is.
+    Codecs register their dictionary when created, values compressed with
+    a former dictionary are read once a codec of it has been created.
+    """
+    name = 'zlib'
+
+    def __init__(self, codec=None, dictionary=None, threshold=128, level=6):
+        self.codec = codec or JSON
+        self.dictionary = dictionary
+        self.threshold = threshold
+        self.level = level
+        self.dictionary_id = ''
+        if dictionary:
+            # the adler32 checksum zlib itself identifies dictionaries with
+            self.dictionary_id = '{:08x}'.format(zlib.adler32(dictionary))
+            DICTIONARIES.setdefault(self.dictionary_id, self)
+
+    def compress(self, value):
+        """ payload of a value of the compressed codec """
+        if self.dictionary:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(self.level)
+        data = compressor.compress(value.encode('utf-8')) + compressor.flush()
+        return '{}:{}'.format(self.dictionary_id,
+                              base64.b64encode(data).decode('ascii'))
+
+    def encode(self, obj):
+        return self.compress(self.codec.dumps(obj))
+
+    def decode(self, payload):
+        dictionary_id, payload = payload.split(':', 1)
+        if dictionary_id:
+            if dictionary_id not in DICTIONARIES:
+                raise ValueError('Unknown zlib dictionary {}'.format(
+                    dictionary_id))
+            decompressor = zlib.decompressobj(
+                zdict=DICTIONARIES[dictionary_id].dictionary)
+        else:
+            decompressor = zlib.decompressobj()
+        value = decompressor.decompress(base64.b64decode(payload)) + \
+            decompressor.flush()
+        return loads(value.decode('utf-8'))
+
+    def dumps(self, obj):
+        value = self.codec.dumps(obj)
+        if len(value) < self.threshold:
+            return value
+        compressed = '{}{}:{}'.format(TAG, self.name, self.compress(value))
+        if len(compressed) >= len(value):
+            return value
+        return compressed
+
+    def codec_of(self, payload):
+        """ codec of the dictionary of payload """
+        return DICTIONARIES.get(payload.split(':', 1)[0], self)
+
+
+# codecs by name, instantiated on first use
+CODECS = {
+    'json': JSONCodec,
+    'orjson': OrJSONCodec,
+    'msgpack': MsgpackCodec,
+    'zlib': ZlibCodec
+}
+JSON = JSONCodec()
+
+
+def register_codec(codec):
+    """ makes a codec class or instance available by its name """
+    CODECS[codec.name] = codec
+    return codec
+
+
+def get_codec(name):
+    """ codec instance from its name """
+    codec = CODECS[name]
+    if isinstance(codec, type):
+        codec = CODECS[name] = codec()
+    return codec
+
+
+def codec_of(value):
+    """ codec of a stored value, JSON for plain JSON values """
+    if value.startswith(TAG):
+        name, payload = value[len(TAG):].split(':', 1)
+        return get_codec(name).codec_of(payload)
+    return JSON
+
+
+def loads(value, codec=None):
+    """
+    Deserializes a stored value: tagged values are decoded by the codec
+    they name, plain JSON values by codec when it produces JSON.
+    """
+    if value.startswith(TAG):
+        name, payload = value[len(TAG):].split(':', 1)
+        return get_codec(name).decode(payload)
+    if codec is None or codec.tagged:
+        codec = JSON
+    return codec.decode(value)
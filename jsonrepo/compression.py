@@ -0,0 +1,132 @@
+# -*- coding: utf8 -*-
+"""
+Training of zlib preset dictionaries and compression reports of a sample
+of the records of a repository.
+
+    python -m jsonrepo.compression --backend redis --prefix messages \\
+        --sample 1000 --output messages.zdict
+
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import re
+import sys
+import argparse
+from collections import Counter
+from jsonrepo import codec
+
+# members of JSON objects up to their separator, and their keys alone
+MEMBERS = re.compile(r'"(?:[^"\\]|\\.)*"\s*:\s*'
+                     r'(?:"(?:[^"\\]|\\.)*"|[^,{}\[\]"]*)\s*[,}\]]?')
+KEYS = re.compile(r'"(?:[^"\\]|\\.)*"\s*:\s*')
+# largest preset dictionary zlib makes use of, the size of its window
+DICTIONARY_SIZE = 32768
+
+
+def train_dictionary(texts, size=DICTIONARY_SIZE):
+    """
+    zlib preset dictionary of at most size bytes from a sample of texts,
+    made of the pieces found in most texts weighted by their length. The
+    most valuable pieces come last, zlib encoding nearer matches shorter.
+    """
+    counts = Counter()
+    for text in texts:
+        counts.update(set(MEMBERS.findall(text)) | set(KEYS.findall(text)))
+    # pieces of a single text are not worth it
+    minimum = 2 if len(texts) > 1 else 1
+    pieces = sorted((count * len(piece), piece)
+                    for piece, count in counts.items() if count >= minimum)
+    chosen = []
+    total = 0
+    for _, piece in reversed(pieces):
+        piece = piece.encode('utf-8')
+        if total + len(piece) > size:
+            continue
+        chosen.append(piece)
+        total += len(piece)
+    return b''.join(reversed(chosen))
+
+
+def sample(repository, size=1000, page_size=100):
+    """ stored values of the first size records scanned in a repository """
+    values = []
+    for page in repository.storage.scan(page_size):
+        values.extend(page[:size - len(values)])
+        if len(values) >= size:
+            break
+    return values
+
+
+def texts(values, zlib_codec):
+    """ stored values as written by the codec compressed by zlib_codec """
+    return [zlib_codec.codec.dumps(codec.loads(value)) for value in values]
+
+
+def report(values, zlib_codec):
+    """
+    Sizes of stored values written by zlib_codec: number of records, size
+    without compression, stored size, number of compressed values and
+    compression ratio
+    """
+    size = 0
+    stored_size = 0
+    compressed = 0
+    tag = '{}{}:'.format(codec.TAG, zlib_codec.name)
+    for value in values:
+        document = codec.loads(value)
+        stored = zlib_codec.dumps(document)
+        size += len(zlib_codec.codec.dumps(document))
+        stored_size += len(stored)
+        compressed += int(stored.startswith(tag))
+    return {
+        'records': len(values),
+        'size': size,
+        'stored_size': stored_size,
+        'compressed': compressed,
+        'ratio': size / float(stored_size) if stored_size else 1.0
+    }
+
+
+def main(argv=None):
+    # imported here so that importing the module spares the repository
+    from jsonrepo.repository import Repository
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--backend', default='redis')
+    parser.add_argument('--prefix', required=True)
+    parser.add_argument('--key', default='key')
+    parser.add_argument('--sort-key', default='date')
+    parser.add_argument('--sample', type=int, default=1000,
+                        help='records sampled, half of them to train on')
+    parser.add_argument('--dictionary-size', type=int,
+                        default=DICTIONARY_SIZE)
+    parser.add_argument('--threshold', type=int, default=128)
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--output', help='file to save the dictionary to')
+    args = parser.parse_args(argv)
+    repository = Repository(args.backend, args.prefix)
+    repository.key = args.key
+    repository.sort_key = args.sort_key
+    values = sample(repository, args.sample)
+    # the dictionary is measured on records it was not trained on
+    training, measured = values[:len(values) // 2], values[len(values) // 2:]
+    plain = codec.ZlibCodec(threshold=args.threshold, level=args.level)
+    dictionary = train_dictionary(texts(training, plain),
+                                  args.dictionary_size)
+    trained = codec.ZlibCodec(dictionary=dictionary,
+                              threshold=args.threshold, level=args.level)
+    print('{} records, {} to train a dictionary of {} bytes'.format(
+        len(values), len(training), len(dictionary)))
+    for name, zlib_codec in [('zlib', plain), ('dictionary', trained)]:
+        print('{name:<10} {records:>7} records {size:>10} -> '
+              '{stored_size:>10} characters, {compressed} compressed, '
+              'ratio {ratio:.2f}'.format(name=name,
+                                         **report(measured, zlib_codec)))
+    if args.output:
+        with open(args.output, 'wb') as output:
+            output.write(dictionary)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
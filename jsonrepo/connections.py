@@ -0,0 +1,133 @@
+# -*- coding: utf8 -*-
+"""
+Process wide registry of connection pools to storage servers
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import os
+import threading
+from functools import wraps
+
+_lock = threading.Lock()
+_connections = {}
+# incremented on reset so that connections are rebuilt in forked children
+_generation = 0
+
+
+def shared(kind, endpoint, factory):
+    """
+    Connection object of a kind to an endpoint, built once per process by
+    factory
+    """
+    key = (kind, endpoint)
+    connection = _connections.get(key)
+    if connection is None:
+        with _lock:
+            connection = _connections.get(key)
+            if connection is None:
+                connection = _connections[key] = factory()
+    return connection
+
+
+def reset():
+    """
+    Forgets every connection, sockets of a parent process cannot be shared
+    with its forked children
+    """
+    global _lock, _generation
+    _lock = threading.Lock()
+    _connections.clear()
+    _generation += 1
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset)
+
+
+def per_process(fget):
+    """
+    Return a property attribute that only calls its getter on first access,
+    like memoized, and again after connections are reset
+    """
+    attr_name = '_{0}'.format(fget.__name__)
+
+    @wraps(fget)
+    def fget_per_process(self):
+        cached = getattr(self, attr_name, None)
+        if cached is None or cached[0] != _generation:
+            cached = (_generation, fget(self))
+            setattr(self, attr_name, cached)
+        return cached[1]
+
+    return property(fget_per_process)
+
+
+def setting(name, default=None, cast=str):
+    """ setting from the environment """
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return cast(value)
+
+
+def flag(value):
+    """ boolean setting """
+    return value.lower() in ('1', 'yes', 'true', 'on')
+
+
+def redis_endpoint(host=None, port=None, db=None, unix_socket_path=None):
+    """
+    Redis endpoint from arguments, defaulting to `REDIS_HOST`, `REDIS_PORT`,
+    `REDIS_DB` and `REDIS_SOCKET` for a unix socket path
+    """
+    db = int(db if db is not None else setting('REDIS_DB', 0))
+    if host is None and port is None:
+        unix_socket_path = unix_socket_path or setting('REDIS_SOCKET')
+    if unix_socket_path:
+        return ('unix', unix_socket_path, db)
+    return ('tcp',
+            host or setting('REDIS_HOST', '127.0.0.1'),
+            int(port or setting('REDIS_PORT', 6379)),
+            db)
+
+
+def redis_pool_options(endpoint, connection_class=None,
+                       unix_connection_class=None):
+    """
+    Connection pool options of a Redis endpoint: `REDIS_MAX_CONNECTIONS`
+    and `REDIS_SOCKET_KEEPALIVE` settings apply to every pool
+    """
+    options = {
+        'max_connections': setting('REDIS_MAX_CONNECTIONS', None, int)
+    }
+    if endpoint[0] == 'unix':
+        options.update({'path': endpoint[1], 'db': endpoint[2]})
+        if unix_connection_class is not None:
+            options['connection_class'] = unix_connection_class
+        return options
+    options.update({
+        'host': endpoint[1],
+        'port': endpoint[2],
+        'db': endpoint[3],
+        'socket_keepalive': setting('REDIS_SOCKET_KEEPALIVE', False, flag)
+    })
+    if connection_class is not None:
+        options['connection_class'] = connection_class
+    return options
+
+
+def dynamodb_resource(factory, region=None, endpoint_url=None):
+    """
+    DynamoDB resource shared per region and endpoint, built by factory
+    with botocore options: `DYNAMODB_MAX_POOL_CONNECTIONS` and
+    `DYNAMODB_TCP_KEEPALIVE` settings
+    """
+    import botocore.config
+    region = region or setting('AWS_DEFAULT_REGION')
+    endpoint_url = endpoint_url or setting('AWS_ENDPOINT_URL_DYNAMODB')
+    config = botocore.config.Config(
+        max_pool_connections=setting('DYNAMODB_MAX_POOL_CONNECTIONS', 10,
+                                     int),
+        tcp_keepalive=setting('DYNAMODB_TCP_KEEPALIVE', False, flag))
+    return shared('dynamodb', (region, endpoint_url),
+                  lambda: factory(region, endpoint_url, config))
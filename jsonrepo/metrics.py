@@ -0,0 +1,101 @@
+# -*- coding: utf8 -*-
+"""
+Per operation metrics of storage backends
+Author:   Romary Dupuis <romary@me.com>
+Copyright (C) 2017 Romary Dupuis
+"""
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+try:
+    import contextvars
+except ImportError:  # Python < 3.7
+    contextvars = None
+
+
+class LocalVar(object):
+    """
+    Thread local fallback of a context variable where contextvars is not
+    available, the value being the one of the current thread
+    """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self.default)
+
+    def set(self, value):
+        """ sets value, returns the previous value as token """
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+
+# operation being measured in the current thread or asyncio task, or in
+# the current thread only without contextvars
+if contextvars is not None:
+    _operation = contextvars.ContextVar('operation', default=None)
+else:
+    _operation = LocalVar('operation')
+
+
+class Operation(object):
+    """
+    Measures of a storage operation reported to hooks:
+    latency in seconds, payload_size as the length of values written or
+    read, round_trips to the storage server and result_size as the number
+    of values returned or written.
+    """
+    __slots__ = ('name', 'latency', 'payload_size', 'round_trips',
+                 'result_size', 'error')
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = 0.0
+        self.payload_size = 0
+        self.round_trips = 0
+        self.result_size = 0
+        self.error = None
+
+    def __repr__(self):
+        return ('Operation({}, latency={:.6f}, payload_size={}, '
+                'round_trips={}, result_size={})'.format(
+                    self.name, self.latency, self.payload_size,
+                    self.round_trips, self.result_size))
+
+
+def round_trip(count=1):
+    """
+    Counts round trips to a storage server for the operation measured in
+    the current context, if any
+    """
+    operation = _operation.get()
+    if operation is not None:
+        operation.round_trips += count
+
+
+@contextmanager
+def measure(name, hooks):
+    """
+    Measures the operation run in the block and reports it to hooks,
+    failed operations are reported with their exception as error
+    """
+    operation = Operation(name)
+    token = _operation.set(operation)
+    start = default_timer()
+    try:
+        yield operation
+    except Exception as error:
+        operation.error = error
+        raise
+    finally:
+        operation.latency = default_timer() - start
+        _operation.reset(token)
+        for hook in hooks:
+            hook(operation)
@@ -4,24 +4,114 @@ Storage Mixin
 Author:   Romary Dupuis <romary@me.com>
 Copyright (C) 2017 Romary Dupuis
 """
+from contextlib import contextmanager
 from awesomedecorators import memoized
-from jsonrepo.backends.redis import RedisBackend
-from jsonrepo.backends.memory import DictBackend
-from jsonrepo.backends.dynamodb import DynamoDBBackend
+from jsonrepo.backend import ttl_options
+from jsonrepo.backends import get_backend
+from jsonrepo.backends.buffered import BufferedBackend
+from jsonrepo.backends.cached import CachedBackend
+from jsonrepo.backends.instrumented import InstrumentedBackend
 
 
 class StorageMixin(object):
     """
     Mix in storage capacity with singleton
     """
+    # size of the read-through cache, no cache when 0
+    cache_size = 0
+    # time to live of cache entries in seconds, None for no expiry
+    cache_ttl = None
+    # maximum number of writes pending in the write-behind buffer, no
+    # buffer when 0
+    buffer_size = 0
+    # seconds between flushes of the write-behind buffer
+    buffer_interval = 1.0
+    # number of pending writes flushed at once
+    buffer_batch_size = 100
+    # seconds saved records live, None for no expiry
+    ttl = None
+    # wrapper of storage reporting operations to hooks
+    instrumented_backend = InstrumentedBackend
+
     @memoized
     def storage(self):
         """
-        Instantiates and returns a storage instance
+        Instantiates and returns a storage instance, buffered and cached if
+        required
+        """
+        return self.wrap_storage(self.backend_storage())
+
+    def wrap_storage(self, storage):
+        """
+        Wraps a storage instance in the write-behind buffer and the cache
+        if required
+        """
+        if self.buffer_size:
+            storage = BufferedBackend(storage, self.buffer_size,
+                                      self.buffer_interval,
+                                      self.buffer_batch_size)
+        if self.cache_size:
+            storage = CachedBackend(storage, self.cache_size, self.cache_ttl)
+        return storage
+
+    def ttl_options(self, ttl=None):
+        """
+        Keyword arguments of storage writes expiring after ttl seconds,
+        defaulting to the ttl of the repository
+        """
+        return ttl_options(ttl if ttl is not None else self.ttl)
+
+    def flush(self):
+        """
+        Writes the saves pending in the write-behind buffer, if any
+        """
+        if hasattr(self.storage, 'flush'):
+            self.storage.flush()
+
+    def close(self):
+        """
+        Stops the write-behind buffer, if any, after writing pending saves
+        """
+        if hasattr(self.storage, 'close'):
+            self.storage.close()
+
+    def add_hook(self, hook):
+        """
+        Registers a callable called with the jsonrepo.metrics.Operation
+        measured for each storage operation. Storage is instrumented only
+        once a hook is registered.
+        """
+        storage = self.storage
+        if not isinstance(storage, self.instrumented_backend):
+            # replaces the memoized storage
+            storage = self._storage = self.instrumented_backend(storage)
+        storage.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """
+        Unregisters a hook
+        """
+        self.storage.hooks.remove(hook)
+
+    @contextmanager
+    def measure(self):
+        """
+        Collects the operations measured in the block
+        """
+        operations = []
+        hook = operations.append
+        self.add_hook(hook)
+        try:
+            yield operations
+        finally:
+            self.remove_hook(hook)
+
+    def backend_storage(self):
+        """
+        Instantiates and returns the backend storage instance
         """
-        if self.backend == 'redis':
-            return RedisBackend(self.prefix, self.secondary_indexes)
-        if self.backend == 'dynamodb':
-            return DynamoDBBackend(self.prefix, self.key, self.sort_key,
-                                   self.secondary_indexes)
-        return DictBackend(self.prefix, self.secondary_indexes)
+        try:
+            backend = get_backend(self.backend)
+        except KeyError:
+            backend = get_backend('dict')
+        return backend.for_repository(self)
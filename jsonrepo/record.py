@@ -5,7 +5,12 @@ Author:   Romary Dupuis <romary@me.com>
 Copyright (C) 2017 Romary Dupuis
 """
 from collections import OrderedDict
-import json
+import six
+from jsonrepo.codec import JSON
+
+# types of values serialized as they are
+SCALAR_TYPES = frozenset(six.string_types + six.integer_types +
+                         (float, bool, type(None)))
 
 
 def namedtuple_asdict(obj):
@@ -28,10 +33,149 @@ def namedtuple_asdict(obj):
     return obj
 
 
+def compile_serializer(fields):
+    """
+    Builds the serializer of records with the given fields into a Python
+    dict. Scalar values are taken as they are, only nested values of other
+    types go through namedtuple_asdict.
+    """
+    fields = tuple(fields)
+
+    def serialize(record):
+        document = {}
+        for field, value in zip(fields, record):
+            if type(value) not in SCALAR_TYPES:
+                value = namedtuple_asdict(value)
+            document[field] = value
+        return document
+    return serialize
+
+
+def compile_deserializer(cls, fields):
+    """
+    Builds the deserializer of slots records of cls with the given fields
+    from a Python dict, slots being set at once and missing fields being
+    None. Documents with other fields go through the constructor for its
+    errors.
+    """
+    fields = tuple(fields)
+    names = frozenset(fields)
+    new = cls.__new__
+
+    def deserialize(document):
+        if not names.issuperset(document):
+            return cls(**document)
+        record = new(cls)
+        for field in fields:
+            setattr(record, field, document.get(field))
+        return record
+    return deserialize
+
+
+def slots_fields(cls):
+    """ fields of a slots record class, its slots in definition order """
+    fields = cls.__dict__.get('_slots_fields')
+    if fields is None:
+        fields = tuple(
+            field
+            for klass in reversed(cls.__mro__)
+            for field in klass.__dict__.get('__slots__', ())
+            if field not in ('__dict__', '__weakref__'))
+        setattr(cls, '_slots_fields', fields)
+    return fields
+
+
+def serialize_changes(changes):
+    """
+    Changes of fields of a record serialized as records serialize them
+    """
+    return dict((field, value if type(value) in SCALAR_TYPES
+                 else namedtuple_asdict(value))
+                for field, value in changes.items())
+
+
+def record_serializer(cls, fields):
+    """
+    Serializer of a record class, compiled once from its fields
+    """
+    serializer = cls.__dict__.get('_serializer')
+    if serializer is None:
+        serializer = compile_serializer(fields)
+        setattr(cls, '_serializer', serializer)
+    return serializer
+
+
+def record_deserializer(cls):
+    """
+    Deserializer of a slots record class, compiled once from its fields.
+    Classes with their own constructor are built by it.
+    """
+    deserializer = cls.__dict__.get('_deserializer')
+    if deserializer is None:
+        if cls.__init__ is SlotsRecord.__init__:
+            deserializer = compile_deserializer(cls, slots_fields(cls))
+        else:
+            def deserializer(document):
+                return cls(**document)
+        setattr(cls, '_deserializer', deserializer)
+    return deserializer
+
+
+# marks a lazy record not decoded yet
+NOT_DECODED = object()
+
+
+class LazyRecord(object):
+    """
+    Proxy of a record decoded on first access to one of its attributes or
+    items. The stored value is available as raw without any decoding.
+    """
+    __slots__ = ('raw', '_klass', '_record')
+
+    def __init__(self, klass, raw):
+        self.raw = raw
+        self._klass = klass
+        self._record = NOT_DECODED
+
+    @property
+    def record(self):
+        """ the decoded record """
+        if self._record is NOT_DECODED:
+            self._record = self._klass.from_json(self.raw)
+        return self._record
+
+    def __getattr__(self, name):
+        return getattr(self.record, name)
+
+    def __getitem__(self, item):
+        return self.record[item]
+
+    def __iter__(self):
+        return iter(self.record)
+
+    def __len__(self):
+        return len(self.record)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyRecord):
+            other = other.record
+        return self.record == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LazyRecord({!r})'.format(self.raw)
+
+
 class Record(object):
     """
     Definition of a JSON serializable record for a repository
     """
+    __slots__ = ()
+    # serialization codec, values written with other codecs are read too
+    codec = JSON
+
     @classmethod
     def from_json(cls, json_dump):
         """
@@ -45,6 +189,13 @@ class Record(object):
         """
         raise NotImplementedError
 
+    def encode(self):
+        """
+        Serialization along with the serialized document when available,
+        so that backends read secondary indexes without decoding the value
+        """
+        return self.to_json(), None
+
 
 class DictRecord(Record):
     """
@@ -58,7 +209,7 @@ class DictRecord(Record):
         context = cls()
         if json_dump is None:
             return None
-        ctxt = json.loads(json_dump)
+        ctxt = cls.codec.loads(json_dump)
         for k in ctxt:
             context[k] = ctxt[k]
         return context
@@ -67,7 +218,11 @@ class DictRecord(Record):
         """
         JSON serialization
         """
-        return json.dumps(self.copy())
+        return self.encode()[0]
+
+    def encode(self):
+        document = self.copy()
+        return self.codec.dumps(document), document
 
 
 class NamedtupleRecord(Record):
@@ -78,8 +233,63 @@ class NamedtupleRecord(Record):
     def from_json(cls, json_dump):
         if json_dump is None:
             return None
-        kwargs = json.loads(json_dump)
+        kwargs = cls.codec.loads(json_dump)
         return cls(**kwargs)
 
     def to_json(self):
-        return json.dumps(namedtuple_asdict(self))
+        return self.encode()[0]
+
+    def encode(self):
+        document = record_serializer(type(self), self._fields)(self)
+        return self.codec.dumps(document), document
+
+
+class SlotsRecord(Record):
+    """
+    Specific implementation of a compact record storing its fields in
+    __slots__, declared by subclasses. Missing fields are None.
+    """
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for field in self._fields:
+            setattr(self, field, kwargs.pop(field, None))
+        if kwargs:
+            raise TypeError('Unexpected fields {}'.format(
+                ', '.join(sorted(kwargs))))
+
+    @property
+    def _fields(self):
+        """ fields of the record, slots of its classes in definition order """
+        return slots_fields(type(self))
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self._fields)
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                tuple(self) == tuple(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(field, value)
+            for field, value in zip(self._fields, self)))
+
+    def _asdict(self):
+        return OrderedDict(zip(self._fields, self))
+
+    @classmethod
+    def from_json(cls, json_dump):
+        if json_dump is None:
+            return None
+        return record_deserializer(cls)(cls.codec.loads(json_dump))
+
+    def to_json(self):
+        return self.encode()[0]
+
+    def encode(self):
+        document = record_serializer(type(self), self._fields)(self)
+        return self.codec.dumps(document), document
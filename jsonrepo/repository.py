@@ -8,7 +8,7 @@ from six import add_metaclass
 from singleton import Singleton
 from loggingmixin import LoggingMixin
 from jsonrepo.mixin import StorageMixin
-from jsonrepo.record import Record
+from jsonrepo.record import Record, LazyRecord, serialize_changes
 
 
 @add_metaclass(Singleton)
@@ -20,6 +20,8 @@ class Repository(StorageMixin, LoggingMixin):
     key = 'key'
     sort_key = 'date'
     secondary_indexes = []
+    # indexes kept in order for find_range, instead of secondary_indexes
+    ordered_indexes = []
 
     def __init__(self, backend, prefix):
         self.prefix = prefix
@@ -39,11 +41,23 @@ class Repository(StorageMixin, LoggingMixin):
             return klass(**args)
         return klass.from_json(record)
 
-    def save(self, key, sort_key, _object):
+    def save(self, key, sort_key, _object, ttl=None):
         """
-        Saves a context object
+        Saves a context object, expiring after ttl seconds or the ttl of the
+        repository
         """
-        return self.storage.set(key, sort_key, _object.to_json())
+        value, document = _object.encode()
+        return self.storage.set(key, sort_key, value, document,
+                                **self.ttl_options(ttl))
+
+    def update(self, key, sort_key, **changes):
+        """
+        Sets fields of a stored record without saving it whole, indexes
+        being updated for changed fields only. Returns whether the record
+        exists.
+        """
+        return self.storage.update(key, sort_key,
+                                   serialize_changes(changes))
 
     def delete(self, key, sort_key):
         """
@@ -51,26 +65,108 @@ class Repository(StorageMixin, LoggingMixin):
         """
         return self.storage.delete(key, sort_key)
 
-    def history(self, key, _from='-', _to='+', _desc=True):
+    def get_many(self, keys, klass=None, **args):
+        """
+        Retrieves context objects for a list of (key, sort_key) pairs
+        """
+        if klass is None:
+            klass = self.klass
+        return [klass(**args) if record is None else klass.from_json(record)
+                for record in self.storage.get_many(keys)]
+
+    def save_many(self, items, ttl=None):
+        """
+        Saves context objects from a list of (key, sort_key, object) triples
+        """
+        encoded = [_object.encode() for _, _, _object in items]
+        return self.storage.set_many(
+            [(key, sort_key, value)
+             for (key, sort_key, _), (value, _) in zip(items, encoded)],
+            documents=[document for _, document in encoded],
+            **self.ttl_options(ttl))
+
+    def delete_many(self, keys):
+        """
+        Deletes context objects for a list of (key, sort_key) pairs
+        """
+        return self.storage.delete_many(keys)
+
+    def decode(self, value, lazy=False):
+        """
+        Decodes a stored value into a record, or into a lazy proxy decoding
+        it on first access
+        """
+        if lazy:
+            return LazyRecord(self.klass, value)
+        return self.klass.from_json(value)
+
+    def history(self, key, _from='-', _to='+', _desc=True, lazy=False):
         """
-        Retrives a list of records according to a datetime range
+        Retrives the list of every record of a datetime range, read page by
+        page by backends; iter_history does not hold them all at once
         """
-        return [self.klass.from_json(_object)
+        return [self.decode(_object, lazy)
                 for _object in self.storage.history(key, _from, _to, _desc)]
 
+    def history_page(self, key, _from='-', _to='+', desc=True, page_size=100,
+                     cursor=None):
+        """
+        Retrieves a page of records according to a datetime range and the
+        opaque cursor of the next page, None after the last page
+        """
+        values, cursor = self.storage.history_page(key, _from, _to, desc,
+                                                   page_size, cursor)
+        return [self.klass.from_json(_object) for _object in values], cursor
+
+    def iter_history(self, key, _from='-', _to='+', desc=True, page_size=100,
+                     cursor=None):
+        """
+        Iterates over records according to a datetime range, fetching pages
+        of page_size records from the backend and decoding them one by one
+        """
+        while True:
+            values, cursor = self.storage.history_page(key, _from, _to, desc,
+                                                       page_size, cursor)
+            for _object in values:
+                yield self.klass.from_json(_object)
+            if cursor is None:
+                return
+
+    def scan(self, page_size=100, concurrency=1, lazy=False):
+        """
+        Iterates over every record of the repository, in no particular
+        order, decoding records as pages of page_size records arrive from
+        up to concurrency parallel scans
+        """
+        for values in self.storage.scan(page_size, concurrency):
+            for _object in values:
+                yield self.decode(_object, lazy)
+
     def latest(self, key):
         """
         Get the most recent record for a specific key
         """
         return self.klass.from_json(self.storage.latest(key))
 
-    def find(self, index, value):
+    def find(self, index, value, lazy=False):
         """
         Find record according to the value of a secondary index
         """
         res = self.storage.find(index, value)
         return {
             'count': res['count'],
-            'items': [self.klass.from_json(_object)
+            'items': [self.decode(_object, lazy)
+                      for _object in res['items']]
+        }
+
+    def find_range(self, index, lo=None, hi=None, limit=None, lazy=False):
+        """
+        Find records according to a range of an ordered index, lo and hi
+        being included and None meaning unbounded, in index order
+        """
+        res = self.storage.find_range(index, lo, hi, limit)
+        return {
+            'count': res['count'],
+            'items': [self.decode(_object, lazy)
                       for _object in res['items']]
         }
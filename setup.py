@@ -38,13 +38,14 @@ AUTHOR = 'Romary Dupuis'
 AUTHOR_EMAIL = 'romary@me.com'
 URL = 'https://github.com/romaryd/python-jsonrepo'
 LICENSE = text_of('LICENSE')
-PACKAGES = find_packages(exclude=['tests', 'tests.*'])
+PACKAGES = find_packages(exclude=['tests', 'tests.*',
+                                    'benchmarks', 'benchmarks.*'])
 
 INSTALL_REQUIRES = ['python-awesome-decorators',
                     'python-logging-mixin',
                     'python-singleton',
                     'six',
-                    'redis',
+                    'redis>=4.2',
                     'boto3']
 TEST_SUITE = 'tests'
 TESTS_REQUIRE = ['pytest']
@@ -4,11 +4,20 @@ Author: Romary Dupuis <romary@me.comn>
 """
 import os
 import unittest
+import tempfile
 from collections import namedtuple
 import datetime
 import time
+import threading
+import asyncio
 from jsonrepo.repository import Repository
-from jsonrepo.record import NamedtupleRecord
+from jsonrepo.aiorepository import AsyncRepository
+from jsonrepo.record import NamedtupleRecord, SlotsRecord
+from jsonrepo import codec, compression, connections
+from jsonrepo.backends import register_backend, get_backend
+from jsonrepo.backends.memory import DictBackend
+from jsonrepo.backends.buffered import BufferedBackend
+from jsonrepo.backends.cached import CachedBackend
 
 
 try:
@@ -16,9 +25,22 @@ try:
 except ImportError:
     import mock
 
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
 fields = ['title', 'content', 'date', 'ttl']
 
 os.environ['AWS_DEFAULT_REGION'] = 'eu-west-1'
+os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(), 'tests.sqlite3')
+os.environ['LOGFILE_PATH'] = tempfile.mkdtemp()
 
 
 class Message(namedtuple('Message', fields),
@@ -37,6 +59,20 @@ class Message(namedtuple('Message', fields),
         return super(Message, cls).__new__(cls, **default)
 
 
+class MsgpackMessage(Message):
+    """
+    Example of record serialized with MessagePack
+    """
+    codec = codec.MsgpackCodec() if codec.msgpack is not None else None
+
+
+class SlotsMessage(SlotsRecord):
+    """
+    Example of slots based record
+    """
+    __slots__ = fields
+
+
 class MyRepository(Repository):
     klass = Message
     secondary_indexes = ['title', 'ttl']
@@ -44,6 +80,56 @@ class MyRepository(Repository):
     sort_key = 'date'
 
 
+class MySlotsRepository(MyRepository):
+    klass = SlotsMessage
+
+
+class MyRegisteredRepository(MyRepository):
+    pass
+
+
+class MyCachedRepository(MyRepository):
+    cache_size = 2
+
+
+class MyScanRepository(MyRepository):
+    pass
+
+
+class MyBufferedRepository(MyRepository):
+    buffer_size = 3
+    buffer_interval = 60
+    buffer_batch_size = 10
+
+
+class MyExpiringRepository(MyRepository):
+    ttl = 60
+
+
+class MyOrderedRepository(MyRepository):
+    secondary_indexes = ['title']
+    ordered_indexes = ['ttl', 'date']
+
+
+class MySQLiteRepository(MyOrderedRepository):
+    pass
+
+
+class MyLogFileRepository(MyOrderedRepository):
+    pass
+
+
+class MyAsyncRepository(AsyncRepository):
+    klass = Message
+    secondary_indexes = ['title', 'ttl']
+    key = 'key'
+    sort_key = 'date'
+
+
+class MyAsyncSQLiteRepository(MyAsyncRepository):
+    ordered_indexes = ['date']
+
+
 class RepositoryDictTests(unittest.TestCase):
     """
     Tests Repository class based on in memory process dictionary
@@ -158,3 +244,1211 @@ class RepositoryDictTests(unittest.TestCase):
         self.assertEqual(record.title, msg2.title)
         my_repository.delete('test_history', now1)
         my_repository.delete('test_history', now2)
+
+    def test_bulk_records(self):
+        """
+        Assert bulk save, get and delete of records
+        """
+        my_repository = MyRepository('dict', 'example')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        keys = [('test_bulk_records_{}'.format(i), now) for i in range(3)]
+        res = my_repository.save_many([
+            (key, sort_key, Message(title='Bulk', content=key))
+            for key, sort_key in keys])
+        self.assertEqual(len(res), 3)
+        records = my_repository.get_many(keys)
+        self.assertEqual([record.content for record in records],
+                         [key for key, _ in keys])
+        self.assertEqual(my_repository.find('title', 'Bulk')['count'], 3)
+        my_repository.delete_many(keys)
+        self.assertEqual(my_repository.find('title', 'Bulk')['count'], 0)
+
+    def test_history_range(self):
+        """
+        Assert history of records within a range of sort keys
+        """
+        my_repository = MyRepository('dict', 'example')
+        dates = ['2017-01-0{}T00:00:00.000'.format(i) for i in range(1, 6)]
+        for date in reversed(dates):
+            my_repository.save('test_history_range', date,
+                               Message(title=date, date=date))
+        records = my_repository.history('test_history_range')
+        self.assertEqual([record.title for record in records],
+                         dates[::-1])
+        records = my_repository.history('test_history_range',
+                                        _from=dates[1], _to=dates[3],
+                                        _desc=False)
+        self.assertEqual([record.title for record in records],
+                         dates[2:4])
+        self.assertEqual(
+            my_repository.latest('test_history_range').title, dates[-1])
+        my_repository.delete_many([('test_history_range', date)
+                                   for date in dates])
+        self.assertEqual(my_repository.history('test_history_range'), [])
+
+    def test_update_index(self):
+        """
+        Assert secondary indexes follow an overwritten record
+        """
+        my_repository = MyRepository('dict', 'example')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        my_repository.save('test_update_index', now,
+                           Message(title='Before', date=now))
+        my_repository.save('test_update_index', now,
+                           Message(title='After', date=now))
+        self.assertEqual(my_repository.find('title', 'Before')['count'], 0)
+        self.assertEqual(my_repository.find('title', 'After')['count'], 1)
+        my_repository.delete('test_update_index', now)
+        self.assertEqual(my_repository.find('title', 'After')['count'], 0)
+
+    def test_cached_records(self):
+        """
+        Assert records are cached, invalidated and evicted
+        """
+        my_repository = MyCachedRepository('dict', 'example_cached')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        self.assertIsNone(my_repository.get('test_cached_records', now).title)
+        my_repository.get('test_cached_records', now)
+        self.assertEqual(my_repository.storage.stats()['hits'], 1)
+        my_repository.save('test_cached_records', now,
+                           Message(title='Cached', date=now))
+        record = my_repository.get('test_cached_records', now)
+        self.assertEqual(record.title, 'Cached')
+        self.assertEqual(my_repository.latest('test_cached_records').title,
+                         'Cached')
+        my_repository.get('test_cached_records', 'other')
+        self.assertEqual(my_repository.storage.stats()['evictions'], 1)
+        my_repository.delete('test_cached_records', now)
+        self.assertIsNone(my_repository.latest('test_cached_records'))
+
+    def test_iter_history(self):
+        """
+        Assert history is iterated page by page
+        """
+        my_repository = MyRepository('dict', 'example')
+        dates = ['2017-02-{:02d}T00:00:00.000'.format(i) for i in range(1, 8)]
+        my_repository.save_many([('test_iter_history', date,
+                                  Message(title=date, date=date))
+                                 for date in dates])
+        records = list(my_repository.iter_history('test_iter_history',
+                                                  page_size=3))
+        self.assertEqual([record.title for record in records], dates[::-1])
+        records = list(my_repository.iter_history('test_iter_history',
+                                                  _from=dates[0],
+                                                  desc=False, page_size=2))
+        self.assertEqual([record.title for record in records], dates[1:])
+        records, cursor = my_repository.history_page('test_iter_history',
+                                                     page_size=4)
+        self.assertEqual(len(records), 4)
+        records, cursor = my_repository.history_page('test_iter_history',
+                                                     page_size=4,
+                                                     cursor=cursor)
+        self.assertEqual([record.title for record in records],
+                         dates[2::-1])
+        self.assertIsNone(cursor)
+        my_repository.delete_many([('test_iter_history', date)
+                                   for date in dates])
+
+    @unittest.skipIf(codec.msgpack is None, 'msgpack is not installed')
+    def test_codec_records(self):
+        """
+        Assert records serialized with different codecs are read together
+        """
+        my_repository = MyRepository('dict', 'example')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        my_repository.save('test_codec_records', now,
+                           MsgpackMessage(title='Packed', date=now))
+        self.assertTrue(my_repository.storage.get('test_codec_records', now)
+                        .startswith('#msgpack:'))
+        self.assertEqual(my_repository.get('test_codec_records', now).title,
+                         'Packed')
+        self.assertEqual(my_repository.find('title', 'Packed')['count'], 1)
+        my_repository.save('test_codec_records', now,
+                           Message(title='Plain', date=now))
+        self.assertEqual(my_repository.find('title', 'Packed')['count'], 0)
+        my_repository.delete('test_codec_records', now)
+
+    def test_lazy_records(self):
+        """
+        Assert lazy records are decoded on first access only
+        """
+        my_repository = MyRepository('dict', 'example')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        msg = Message(title='Lazy', content='decoded on access', date=now)
+        my_repository.save('test_lazy_records', now, msg)
+        result = my_repository.find('title', 'Lazy', lazy=True)
+        self.assertEqual(result['count'], 1)
+        record = result['items'][0]
+        self.assertEqual(record.raw, msg.to_json())
+        self.assertEqual(record.content, msg.content)
+        self.assertEqual(record, msg)
+        records = my_repository.history('test_lazy_records', lazy=True)
+        self.assertEqual(records[0].title, 'Lazy')
+        my_repository.delete('test_lazy_records', now)
+
+    def test_slots_records(self):
+        """
+        Assert slots based records are saved and retrieved
+        """
+        my_repository = MySlotsRepository('dict', 'example_slots')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        msg = SlotsMessage(title='Slots', content='compact', date=now)
+        self.assertFalse(hasattr(msg, '__dict__'))
+        my_repository.save('test_slots_records', now, msg)
+        self.assertEqual(my_repository.get('test_slots_records', now), msg)
+        self.assertEqual(my_repository.find('title', 'Slots')['count'], 1)
+        my_repository.delete('test_slots_records', now)
+        self.assertEqual(SlotsMessage.from_json('{"title": "Slots"}'),
+                         SlotsMessage(title='Slots'))
+        with self.assertRaises(TypeError):
+            SlotsMessage.from_json('{"title": "Slots", "unknown": 1}')
+
+    def test_measure_operations(self):
+        """
+        Assert storage operations are measured
+        """
+        my_repository = MyRepository('dict', 'example')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        msg = Message(title='Measured', date=now)
+        with my_repository.measure() as operations:
+            my_repository.save('test_measure_operations', now, msg)
+            my_repository.get('test_measure_operations', now)
+            my_repository.find('title', 'Measured')
+            my_repository.delete('test_measure_operations', now)
+        self.assertEqual([operation.name for operation in operations],
+                         ['set', 'get', 'find', 'delete'])
+        self.assertEqual(operations[0].payload_size, len(msg.to_json()))
+        self.assertEqual(operations[2].result_size, 1)
+        self.assertTrue(all(operation.latency >= 0
+                            for operation in operations))
+        self.assertEqual(my_repository.storage.hooks, [])
+
+    def test_registered_backend(self):
+        """
+        Assert backends are registered and imported on first use
+        """
+        register_backend('test_registered_backend',
+                         'jsonrepo.backends.memory:DictBackend')
+        my_repository = MyRegisteredRepository('test_registered_backend',
+                                               'example_registered')
+        self.assertIsInstance(my_repository.storage, DictBackend)
+        self.assertIs(get_backend('test_registered_backend'), DictBackend)
+        self.assertRaises(KeyError, get_backend, 'unknown')
+
+    def test_concurrent_records(self):
+        """
+        Assert concurrent writers keep history and indexes consistent
+        """
+        my_repository = MyRepository('dict', 'example')
+        dates = ['2017-03-01T00:00:{:02d}.000'.format(i) for i in range(20)]
+
+        def writer(number):
+            key = 'test_concurrent_records_{}'.format(number % 2)
+            for date in dates:
+                my_repository.save(key, date,
+                                   Message(title='Concurrent{}'.format(
+                                       number), date=date))
+                my_repository.history(key)
+                my_repository.find('title', 'Concurrent0')
+
+        threads = [threading.Thread(target=writer, args=(number,))
+                   for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for key in ['test_concurrent_records_0', 'test_concurrent_records_1']:
+            records = my_repository.history(key)
+            self.assertEqual([record.date for record in records],
+                             dates[::-1])
+        found = sum(my_repository.find('title', 'Concurrent{}'.format(
+            number))['count'] for number in range(8))
+        self.assertEqual(found, 40)
+        for key in ['test_concurrent_records_0', 'test_concurrent_records_1']:
+            my_repository.delete_many([(key, date) for date in dates])
+        self.assertEqual(
+            my_repository.find('title', 'Concurrent0')['count'], 0)
+
+    def test_scan_records(self):
+        """
+        Assert every record of a repository is scanned page by page
+        """
+        my_repository = MyScanRepository('dict', 'example_scan')
+        dates = ['2017-06-{:02d}T00:00:00.000'.format(i) for i in range(1, 6)]
+        my_repository.save_many([('test_scan_records_{}'.format(i % 2), date,
+                                  Message(title='Scan', date=date))
+                                 for i, date in enumerate(dates)])
+        self.assertEqual(sorted(record.date for record in
+                                my_repository.scan(page_size=2)), dates)
+        my_repository.delete_many([('test_scan_records_{}'.format(i % 2),
+                                    date) for i, date in enumerate(dates)])
+        self.assertEqual(list(my_repository.scan()), [])
+
+    def test_scan_cached_records(self):
+        """
+        Assert wrapped backends scan records
+        """
+        my_repository = MyCachedRepository('dict', 'example_cached')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        my_repository.save('test_scan_cached_records', now,
+                           Message(title='Scan', date=now))
+        with my_repository.measure() as operations:
+            records = list(my_repository.scan())
+        self.assertIn(now, [record.date for record in records])
+        self.assertEqual([operation.name for operation in operations],
+                         ['scan'] * len(operations))
+        # pages only, the end of the scan is not reported
+        self.assertTrue(all(operation.result_size
+                            for operation in operations))
+        self.assertEqual(sum(operation.result_size
+                             for operation in operations), len(records))
+        my_repository.delete('test_scan_cached_records', now)
+
+    def test_find_range(self):
+        """
+        Assert records are found by a range of an ordered index
+        """
+        my_repository = MyOrderedRepository('dict', 'example_ordered')
+        ttls = [30, 10, 20, 40]
+        my_repository.save_many([('test_find_range', str(ttl),
+                                  Message(title='Range', ttl=ttl))
+                                 for ttl in ttls])
+        result = my_repository.find_range('ttl', 15, 35)
+        self.assertEqual([record.ttl for record in result['items']],
+                         [20, 30])
+        result = my_repository.find_range('ttl', lo=20, limit=1)
+        self.assertEqual([record.ttl for record in result['items']], [20])
+        self.assertEqual(my_repository.find('ttl', 40)['count'], 1)
+        my_repository.save('test_find_range', '40',
+                           Message(title='Range', ttl=5))
+        result = my_repository.find_range('ttl', hi=10)
+        self.assertEqual([record.ttl for record in result['items']],
+                         [5, 10])
+        my_repository.delete_many([('test_find_range', str(ttl))
+                                   for ttl in ttls])
+        self.assertEqual(my_repository.find_range('ttl')['count'], 0)
+
+    def test_buffered_records(self):
+        """
+        Assert buffered saves coalesce, are read back and flushed
+        """
+        my_repository = MyBufferedRepository('dict', 'example_buffered')
+        backend = my_repository.storage._backend
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        for title in ['First', 'Second', 'Buffered']:
+            my_repository.save('test_buffered_records', now,
+                               Message(title=title, date=now))
+        self.assertEqual(my_repository.get('test_buffered_records',
+                                           now).title, 'Buffered')
+        self.assertIsNone(backend.get('test_buffered_records', now))
+        self.assertEqual(my_repository.find('title', 'Buffered')['count'], 1)
+        self.assertEqual(my_repository.find('title', 'First')['count'], 0)
+        # writers wait for a full buffer to be flushed in the background
+        dates = ['2017-07-{:02d}T00:00:00.000'.format(i) for i in range(1, 6)]
+        my_repository.save_many([('test_buffered_records', date,
+                                  Message(title='Full', date=date))
+                                 for date in dates])
+        my_repository.delete('test_buffered_records', now)
+        self.assertIsNone(my_repository.get('test_buffered_records',
+                                            now).title)
+        my_repository.flush()
+        self.assertIsNone(backend.get('test_buffered_records', now))
+        self.assertEqual(len(my_repository.history('test_buffered_records')),
+                         5)
+        my_repository.delete_many([('test_buffered_records', date)
+                                   for date in dates])
+        my_repository.flush()
+        self.assertEqual(my_repository.find('title', 'Full')['count'], 0)
+
+    def test_expiring_records(self):
+        """
+        Assert records expire after the ttl of the repository or of a save
+        and are evicted by later writes
+        """
+        my_repository = MyExpiringRepository('dict', 'expiring')
+        dates = ['2017-04-0{}T00:00:00.000'.format(i) for i in range(1, 4)]
+        now = time.time()
+        my_repository.save('test_expiring_records', dates[0],
+                           Message(title='Expiring', date=dates[0]))
+        my_repository.save('test_expiring_records', dates[1],
+                           Message(title='Expiring', date=dates[1]),
+                           ttl=120)
+        my_repository.save_many([('test_expiring_records', dates[2],
+                                  Message(title='Expiring', date=dates[2]))])
+        with mock.patch('time.time', return_value=now + 90):
+            self.assertIsNone(my_repository.get('test_expiring_records',
+                                                dates[0]).title)
+            self.assertEqual(my_repository.latest(
+                'test_expiring_records').date, dates[1])
+            self.assertEqual(my_repository.find('title',
+                                                'Expiring')['count'], 1)
+            self.assertEqual(len(my_repository.history(
+                'test_expiring_records')), 1)
+            my_repository.save('test_expiring_records_other', dates[0],
+                               Message(title='Other', date=dates[0]))
+            self.assertNotIn(
+                my_repository.storage.prefixed(
+                    'test_expiring_records:{}'.format(dates[0])),
+                my_repository.storage.cache)
+        with mock.patch('time.time', return_value=now + 150):
+            my_repository.delete('test_expiring_records_other', dates[0])
+            self.assertIsNone(my_repository.latest('test_expiring_records'))
+            self.assertNotIn(
+                my_repository.storage.prefixed('test_expiring_records'),
+                my_repository.storage.cache)
+
+    def test_update_records(self):
+        """
+        Assert updates set fields of a stored record and indexes of its
+        changed fields
+        """
+        my_repository = MyRepository('dict', 'example')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        my_repository.save('test_update_records', now,
+                           Message(title='Draft', content='Text', date=now))
+        self.assertTrue(my_repository.update('test_update_records', now,
+                                             title='Published'))
+        record = my_repository.get('test_update_records', now)
+        self.assertEqual(record.title, 'Published')
+        self.assertEqual(record.content, 'Text')
+        self.assertEqual(my_repository.find('title', 'Draft')['count'], 0)
+        self.assertEqual(my_repository.find('title', 'Published')['count'],
+                         1)
+        self.assertEqual(my_repository.find('ttl', record.ttl)['count'], 1)
+        self.assertFalse(my_repository.update('test_update_records',
+                                              'missing', title='Published'))
+        my_repository.delete('test_update_records', now)
+
+    def test_compressed_records(self):
+        """
+        Assert records compressed with a trained dictionary are read back
+        transparently and reported
+        """
+        my_repository = MyRepository('dict', 'compressed')
+        messages = [Message(title='Compressed',
+                            content='and this is the content',
+                            date='2017-04-01T00:00:{:02d}.000'.format(i))
+                    for i in range(10)]
+        zlib_codec = codec.ZlibCodec(
+            dictionary=compression.train_dictionary(
+                [message.to_json() for message in messages]),
+            threshold=16)
+        with mock.patch.object(Message, 'codec', zlib_codec):
+            my_repository.save_many([('test_compressed_records',
+                                      message.date, message)
+                                     for message in messages])
+        self.assertTrue(my_repository.storage.get(
+            'test_compressed_records', messages[0].date).startswith(
+                '#zlib:{}:'.format(zlib_codec.dictionary_id)))
+        self.assertEqual(my_repository.latest(
+            'test_compressed_records').date, messages[-1].date)
+        self.assertEqual(my_repository.find('title',
+                                            'Compressed')['count'], 10)
+        my_repository.update('test_compressed_records', messages[0].date,
+                             content='updated')
+        self.assertEqual(my_repository.get('test_compressed_records',
+                                           messages[0].date).content,
+                         'updated')
+        report = compression.report(compression.sample(my_repository),
+                                    zlib_codec)
+        self.assertEqual(report['compressed'], 10)
+        self.assertGreater(report['ratio'], 1)
+
+    def test_bulk_documents(self):
+        """
+        Assert bulk saves hand documents to the backend instead of values
+        being decoded again for secondary indexes
+        """
+        my_repository = MyRepository('dict', 'example')
+        dates = ['2017-04-0{}T00:00:00.000'.format(i) for i in range(1, 4)]
+        with mock.patch('jsonrepo.codec.loads',
+                        wraps=codec.loads) as loads:
+            my_repository.save_many([('test_bulk_documents', date,
+                                      Message(title='Documents', date=date))
+                                     for date in dates])
+        self.assertEqual(loads.call_count, 0)
+        self.assertEqual(my_repository.find('title', 'Documents')['count'],
+                         3)
+        my_repository.delete_many([('test_bulk_documents', date)
+                                   for date in dates])
+
+    def test_buffered_failures(self):
+        """
+        Assert failed flushes are retried after the buffer interval and
+        waiting writers go on once the backend recovers
+        """
+        backend = DictBackend('example_buffered_failures', ['title'])
+        storage = BufferedBackend(backend, size=2, interval=0.05,
+                                  batch_size=2)
+        set_many = backend.set_many
+        calls = []
+
+        def failing_set_many(items, **options):
+            calls.append(items)
+            raise IOError('backend unavailable')
+
+        backend.set_many = failing_set_many
+        storage.set('test_buffered_failures', '1', '{"title": "One"}',
+                    {'title': 'One'})
+        storage.set('test_buffered_failures', '2', '{"title": "Two"}')
+        writer = threading.Thread(target=storage.set, args=(
+            'test_buffered_failures', '3', '{"title": "Three"}'))
+        writer.daemon = True
+        writer.start()
+        time.sleep(0.3)
+        self.assertLess(len(calls), 10)
+        self.assertTrue(writer.is_alive())
+        backend.set_many = set_many
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        storage.close()
+        self.assertEqual(backend.find('title', 'One')['count'], 1)
+        self.assertEqual(len(backend.history('test_buffered_failures')), 3)
+
+    def test_cached_stale_reads(self):
+        """
+        Assert values read before a concurrent write are not cached
+        """
+        backend = DictBackend('example_cached_stale', ['title'])
+        storage = CachedBackend(backend)
+        storage.set('test_cached_stale', '1', '{"title": "Old"}')
+        get = backend.get
+        read = threading.Event()
+        written = threading.Event()
+
+        def slow_get(key, sort_key):
+            value = get(key, sort_key)
+            read.set()
+            written.wait(5)
+            return value
+
+        backend.get = slow_get
+        reader = threading.Thread(target=storage.get, args=(
+            'test_cached_stale', '1'))
+        reader.start()
+        read.wait(5)
+        storage.set('test_cached_stale', '1', '{"title": "New"}')
+        written.set()
+        reader.join(5)
+        backend.get = get
+        self.assertEqual(storage.get('test_cached_stale', '1'),
+                         '{"title": "New"}')
+
+    def test_cached_expiring_latest(self):
+        """
+        Assert latest values of keys written with a time to live are not
+        served from the cache once expired
+        """
+        backend = DictBackend('example_cached_latest', ['title'])
+        storage = CachedBackend(backend)
+        now = time.time()
+        storage.set('test_cached_latest', '1', '{"title": "LatestKept"}')
+        self.assertEqual(storage.latest('test_cached_latest'),
+                         '{"title": "LatestKept"}')
+        self.assertEqual(storage.latest('test_cached_latest'),
+                         '{"title": "LatestKept"}')
+        self.assertEqual(storage.stats()['hits'], 1)
+        storage.set('test_cached_latest', '2', '{"title": "LatestExpiring"}',
+                    ttl=60)
+        self.assertEqual(storage.latest('test_cached_latest'),
+                         '{"title": "LatestExpiring"}')
+        with mock.patch('time.time', return_value=now + 90):
+            self.assertEqual(storage.latest('test_cached_latest'),
+                             '{"title": "LatestKept"}')
+            self.assertEqual(storage.latest('test_cached_latest'),
+                             '{"title": "LatestKept"}')
+            self.assertEqual(storage.stats()['hits'], 2)
+        storage.delete_many([('test_cached_latest', '1'),
+                             ('test_cached_latest', '2')])
+
+
+class AsyncRepositoryDictTests(unittest.TestCase):
+    """
+    Tests AsyncRepository class based on in memory process dictionary
+    implementation.
+    """
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_async_records(self):
+        """
+        Assert records are saved, retrieved and deleted concurrently
+        """
+        my_repository = MyAsyncRepository('dict', 'example_async')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        keys = ['test_async_records_{}'.format(i) for i in range(3)]
+
+        async def scenario():
+            await asyncio.gather(*[
+                my_repository.save(key, now, Message(title='Async',
+                                                     content=key))
+                for key in keys])
+            records = await asyncio.gather(*[
+                my_repository.get(key, now) for key in keys])
+            found = await my_repository.find('title', 'Async')
+            latest = await my_repository.latest(keys[0])
+            await asyncio.gather(*[
+                my_repository.delete(key, now) for key in keys])
+            return records, found, latest
+
+        records, found, latest = self.run_async(scenario())
+        self.assertEqual([record.content for record in records], keys)
+        self.assertEqual(found['count'], 3)
+        self.assertEqual(latest.content, keys[0])
+
+    def test_async_blocking_records(self):
+        """
+        Assert calls of blocking backends run in the thread pool
+        """
+        my_repository = MyAsyncSQLiteRepository('sqlite', 'example_async')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        threads = set()
+        storage = my_repository.storage._backend
+        get = storage.get
+
+        def tracked_get(key, sort_key):
+            threads.add(threading.current_thread())
+            return get(key, sort_key)
+
+        async def scenario():
+            await my_repository.save('test_async_blocking_records', now,
+                                     Message(title='Blocking', date=now))
+            with mock.patch.object(storage, 'get', tracked_get):
+                record = await my_repository.get(
+                    'test_async_blocking_records', now)
+            await my_repository.delete('test_async_blocking_records', now)
+            return record
+
+        self.assertEqual(self.run_async(scenario()).title, 'Blocking')
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_async_measure_operations(self):
+        """
+        Assert awaited storage operations are measured
+        """
+        my_repository = MyAsyncRepository('dict', 'example_async')
+        now = datetime.datetime.utcnow().isoformat()[:-3]
+        msg = Message(title='AsyncMeasured', date=now)
+
+        async def scenario():
+            with my_repository.measure() as operations:
+                await my_repository.save('test_async_measure_operations',
+                                         now, msg)
+                await my_repository.get('test_async_measure_operations',
+                                        now)
+                await my_repository.find('title', 'AsyncMeasured')
+                await my_repository.delete('test_async_measure_operations',
+                                           now)
+            return operations
+
+        operations = self.run_async(scenario())
+        self.assertEqual([operation.name for operation in operations],
+                         ['set', 'get', 'find', 'delete'])
+        self.assertEqual(operations[0].payload_size, len(msg.to_json()))
+        self.assertEqual(operations[2].result_size, 1)
+        self.assertEqual(my_repository.storage.hooks, [])
+
+
+class RepositorySQLiteTests(unittest.TestCase):
+    """
+    Tests Repository class based on SQLite implementation.
+    """
+
+    def test_sqlite_records(self):
+        """
+        Assert records are saved, found, paginated and deleted
+        """
+        my_repository = MySQLiteRepository('sqlite', 'example')
+        dates = ['2017-04-{:02d}T00:00:00.000'.format(i) for i in range(1, 6)]
+        my_repository.save_many([('test_sqlite_records', date,
+                                  Message(title='SQLite', date=date))
+                                 for date in dates])
+        my_repository.save('test_sqlite_records', dates[0],
+                           Message(title='SQLite0', date=dates[0]))
+        self.assertEqual(my_repository.get('test_sqlite_records',
+                                           dates[0]).title, 'SQLite0')
+        self.assertEqual(my_repository.latest('test_sqlite_records').date,
+                         dates[-1])
+        self.assertEqual(my_repository.find('title', 'SQLite')['count'], 4)
+        self.assertEqual(my_repository.find('title', 'SQLite0')['count'], 1)
+        records = my_repository.history('test_sqlite_records',
+                                        _from=dates[0], _to=dates[3])
+        self.assertEqual([record.date for record in records],
+                         dates[3:0:-1])
+        records = list(my_repository.iter_history('test_sqlite_records',
+                                                  desc=False, page_size=2))
+        self.assertEqual([record.date for record in records], dates)
+        records = my_repository.get_many([('test_sqlite_records', dates[1]),
+                                          ('test_sqlite_records', 'none')])
+        self.assertEqual([record.title for record in records],
+                         ['SQLite', None])
+        records = list(my_repository.scan(page_size=2))
+        self.assertEqual(sorted(record.date for record in records), dates)
+        records = my_repository.find_range('date', dates[1], dates[3],
+                                           limit=2)['items']
+        self.assertEqual([record.date for record in records], dates[1:3])
+        my_repository.delete_many([('test_sqlite_records', date)
+                                   for date in dates])
+        self.assertEqual(my_repository.find('title', 'SQLite')['count'], 0)
+        self.assertIsNone(my_repository.latest('test_sqlite_records'))
+
+    def test_sqlite_expiring_records(self):
+        """
+        Assert records expire and are deleted by later writes
+        """
+        my_repository = MySQLiteRepository('sqlite', 'example')
+        dates = ['2017-04-0{}T00:00:00.000'.format(i) for i in range(1, 3)]
+        now = time.time()
+        my_repository.save('test_sqlite_expiring_records', dates[0],
+                           Message(title='SQLiteExpiring', date=dates[0]))
+        my_repository.save('test_sqlite_expiring_records', dates[1],
+                           Message(title='SQLiteExpiring', date=dates[1]),
+                           ttl=60)
+        with mock.patch('time.time', return_value=now + 90):
+            self.assertIsNone(my_repository.get(
+                'test_sqlite_expiring_records', dates[1]).title)
+            self.assertEqual(my_repository.latest(
+                'test_sqlite_expiring_records').date, dates[0])
+            self.assertEqual(my_repository.find(
+                'title', 'SQLiteExpiring')['count'], 1)
+            self.assertEqual(my_repository.storage.evict(), 1)
+        my_repository.delete('test_sqlite_expiring_records', dates[0])
+
+    def test_sqlite_concurrent_updates(self):
+        """
+        Assert concurrent updates of different fields are not lost and
+        keep the expiry time of records
+        """
+        my_repository = MySQLiteRepository('sqlite', 'example')
+        date = '2017-04-01T00:00:00.000'
+        now = time.time()
+        my_repository.save('test_sqlite_concurrent_updates', date,
+                           Message(title='SQLiteUpdated', date=date),
+                           ttl=60)
+
+        def update(field):
+            for i in range(50):
+                my_repository.update('test_sqlite_concurrent_updates',
+                                     date, **{field: '{}{}'.format(field, i)})
+
+        threads = [threading.Thread(target=update, args=(field,))
+                   for field in ['title', 'content']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        record = my_repository.get('test_sqlite_concurrent_updates', date)
+        self.assertEqual((record.title, record.content),
+                         ('title49', 'content49'))
+        with mock.patch('time.time', return_value=now + 90):
+            self.assertIsNone(my_repository.get(
+                'test_sqlite_concurrent_updates', date).title)
+        my_repository.delete('test_sqlite_concurrent_updates', date)
+
+    def test_sqlite_boolean_indexes(self):
+        """
+        Assert booleans match neither 1 nor 0 and are not ordered
+        """
+        from jsonrepo.backends.sqlite import SQLiteBackend
+        backend = SQLiteBackend('example_booleans', ['flag'],
+                                ordered_indexes=['n'])
+        backend.set_many([('key', '1', '{"flag": true, "n": true}'),
+                          ('key', '2', '{"flag": 1, "n": 1}')])
+        self.assertEqual(backend.find('flag', 1)['items'],
+                         ['{"flag": 1, "n": 1}'])
+        self.assertEqual(backend.find('flag', True)['items'],
+                         ['{"flag": true, "n": true}'])
+        self.assertEqual(backend.find('n', 1)['count'], 1)
+        self.assertEqual(backend.find_range('n', 1, 1)['count'], 1)
+        self.assertEqual(backend.find_range('n')['count'], 1)
+        backend.delete_many([('key', '1'), ('key', '2')])
+
+
+class RepositoryLogFileTests(unittest.TestCase):
+    """
+    Tests Repository class based on log-structured files implementation.
+    """
+
+    def test_logfile_records(self):
+        """
+        Assert records survive compaction and restarts
+        """
+        my_repository = MyLogFileRepository('logfile', 'example')
+        store = my_repository.storage.store
+        dates = ['2017-05-{:02d}T00:00:00.000'.format(i) for i in range(1, 6)]
+        for title in ['Before', 'LogFile']:
+            my_repository.save_many([('test_logfile_records', date,
+                                      Message(title=title, date=date))
+                                     for date in dates])
+        my_repository.delete('test_logfile_records', dates[0])
+        with mock.patch.object(store, 'segment_size', 0):
+            my_repository.save('test_logfile_records', dates[1],
+                               Message(title='LogFile1', date=dates[1]))
+        self.assertGreater(store.garbage(), 0.5)
+        self.assertTrue(store.compact())
+        self.assertEqual(store.garbage(), 0.0)
+        for restarted in [False, True]:
+            if restarted:
+                # the store is loaded again from its index snapshot
+                store.close()
+                connections.reset()
+                self.assertIsNot(my_repository.storage.store, store)
+            records = my_repository.history('test_logfile_records')
+            self.assertEqual([record.date for record in records],
+                             dates[:0:-1])
+            self.assertEqual(
+                my_repository.find('title', 'LogFile')['count'], 3)
+            self.assertEqual(
+                my_repository.find('title', 'Before')['count'], 0)
+            self.assertEqual(my_repository.get('test_logfile_records',
+                                               dates[1]).title, 'LogFile1')
+        records = list(my_repository.scan(page_size=3))
+        self.assertEqual(sorted(record.date for record in records),
+                         dates[1:])
+        records = my_repository.find_range('date', hi=dates[2])['items']
+        self.assertEqual([record.date for record in records], dates[1:3])
+        my_repository.delete_many([('test_logfile_records', date)
+                                   for date in dates[1:]])
+        self.assertIsNone(my_repository.latest('test_logfile_records'))
+
+    def test_logfile_expiring_records(self):
+        """
+        Assert records expire and are evicted by later writes
+        """
+        my_repository = MyLogFileRepository('logfile', 'example')
+        dates = ['2017-04-0{}T00:00:00.000'.format(i) for i in range(1, 3)]
+        now = time.time()
+        my_repository.save('test_logfile_expiring_records', dates[0],
+                           Message(title='LogFileExpiring', date=dates[0]))
+        my_repository.save('test_logfile_expiring_records', dates[1],
+                           Message(title='LogFileExpiring', date=dates[1]),
+                           ttl=60)
+        store = my_repository.storage.store
+        with mock.patch('time.time', return_value=now + 90):
+            self.assertIsNone(my_repository.get(
+                'test_logfile_expiring_records', dates[1]).title)
+            self.assertEqual(my_repository.latest(
+                'test_logfile_expiring_records').date, dates[0])
+            self.assertEqual(my_repository.find(
+                'title', 'LogFileExpiring')['count'], 1)
+            my_repository.delete('test_logfile_expiring_records', dates[0])
+        self.assertNotIn(('test_logfile_expiring_records', dates[1]),
+                         store.index)
+        self.assertNotIn('test_logfile_expiring_records', store.sort_keys)
+
+    def test_logfile_concurrent_updates(self):
+        """
+        Assert concurrent updates of different fields are not lost and
+        keep the expiry time of records
+        """
+        my_repository = MyLogFileRepository('logfile', 'example')
+        date = '2017-04-01T00:00:00.000'
+        now = time.time()
+        my_repository.save('test_logfile_concurrent_updates', date,
+                           Message(title='LogFileUpdated', date=date),
+                           ttl=60)
+
+        def update(field):
+            for i in range(50):
+                my_repository.update('test_logfile_concurrent_updates',
+                                     date, **{field: '{}{}'.format(field, i)})
+
+        threads = [threading.Thread(target=update, args=(field,))
+                   for field in ['title', 'content']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        record = my_repository.get('test_logfile_concurrent_updates', date)
+        self.assertEqual((record.title, record.content),
+                         ('title49', 'content49'))
+        with mock.patch('time.time', return_value=now + 90):
+            self.assertIsNone(my_repository.get(
+                'test_logfile_concurrent_updates', date).title)
+        my_repository.delete('test_logfile_concurrent_updates', date)
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisBackendTests(unittest.TestCase):
+    """
+    Tests RedisBackend against an in process fake Redis server, Lua
+    scripts requiring lupa.
+    """
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        patcher = mock.patch(
+            'redis.StrictRedis',
+            lambda connection_pool: fakeredis.FakeStrictRedis(server=server))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = fakeredis.FakeStrictRedis(server=server)
+
+    def backend(self, prefix):
+        from jsonrepo.backends.redis import RedisBackend
+        return RedisBackend(prefix, ['title'], ordered_indexes=['rank'])
+
+    def test_redis_update(self):
+        """
+        Assert values are patched where they are stored, other members
+        being left as they are
+        """
+        backend = self.backend('redis_update')
+        backend.set('key', '1', '{"title": "One", "tags": ["a", "}"], '
+                                '"nested": {"x": "\\""}}')
+        self.assertTrue(backend.update('key', '1', {'tags': [],
+                                                    'content': 'c'}))
+        self.assertFalse(backend.update('key', '2', {'content': 'c'}))
+        self.assertEqual(codec.loads(backend.get('key', '1')), {
+            'title': 'One', 'tags': [], 'nested': {'x': '"'},
+            'content': 'c'})
+        self.assertEqual(backend.find('title', 'One')['count'], 1)
+
+    def test_redis_indexed_update(self):
+        """
+        Assert patches of indexed fields move their index entries and keep
+        the time to live of values
+        """
+        backend = self.backend('redis_indexed_update')
+        backend.set('key', '1', '{"title": "One", "rank": 1}')
+        backend.set('key', '2', '{"title": "Two", "rank": 2}', ttl=100)
+        self.assertTrue(backend.update('key', '1', {'title': 'First',
+                                                    'rank': 'a'}))
+        self.assertTrue(backend.update('key', '2', {'title': 'Second'}))
+        self.assertEqual(backend.find('title', 'One')['count'], 0)
+        self.assertEqual(backend.find('title', 'First')['count'], 1)
+        self.assertEqual(backend.find('title', 'Second')['count'], 1)
+        self.assertEqual(backend.find_range('rank', 'a')['count'], 1)
+        self.assertEqual(backend.find_range('rank', 1, 1)['count'], 0)
+        self.assertTrue(
+            90000 < self.client.pttl('redis_indexed_update:key:2') <= 100000)
+        self.assertEqual(codec.loads(self.client.get(
+            backend.shadow_key('key', '2')).decode('utf-8')),
+            {'title': 'Second', 'rank': 2})
+
+    def test_redis_tagged_update(self):
+        """
+        Assert values of tagged codecs are read and written back in their
+        codec, their time to live being kept
+        """
+        backend = self.backend('redis_tagged_update')
+        zlib_codec = codec.ZlibCodec(threshold=16)
+        backend.set('key', '1', zlib_codec.dumps({
+            'title': 'One', 'rank': 1, 'content': 'content ' * 40}), ttl=100)
+        self.assertTrue(backend.update('key', '1', {'title': 'First'}))
+        value = backend.get('key', '1')
+        self.assertTrue(value.startswith('#zlib:'))
+        self.assertEqual(codec.loads(value)['title'], 'First')
+        self.assertEqual(backend.find('title', 'One')['count'], 0)
+        self.assertEqual(backend.find('title', 'First')['count'], 1)
+        self.assertTrue(
+            90000 < self.client.pttl('redis_tagged_update:key:1') <= 100000)
+
+    def test_redis_writes(self):
+        """
+        Assert writes keep sort keys, secondary and ordered indexes in step
+        with values
+        """
+        backend = self.backend('redis_writes')
+        backend.set('key', '1', '{"title": "One", "rank": 1}')
+        backend.set('key', '1', '{"title": "First", "rank": "a"}')
+        backend.set_many([('key', '2', '{"title": "Two", "rank": 2}'),
+                          ('key', '3', '{"title": "Three"}'),
+                          ('key', '3', '{"title": "Two", "rank": 3}')])
+        self.assertEqual(self.client.zrange('redis_writes:key', 0, -1),
+                         [b'1', b'2', b'3'])
+        self.assertEqual(
+            self.client.smembers('redis_writes:secondary_indexes:title:One'),
+            set())
+        self.assertEqual(
+            self.client.smembers('redis_writes:secondary_indexes:title:Two'),
+            set([b'redis_writes:key:2', b'redis_writes:key:3']))
+        self.assertEqual(backend.find('title', 'Three')['count'], 0)
+        self.assertEqual(
+            [codec.loads(item)['rank']
+             for item in backend.find_range('rank', 0)['items']],
+            [2, 3, 'a'])
+        self.assertEqual(backend.delete_many([('key', '1'), ('key', '4')]),
+                         [1, 0])
+        backend.delete('key', '2')
+        self.assertEqual(self.client.zrange('redis_writes:key', 0, -1),
+                         [b'3'])
+        self.assertEqual(backend.find('title', 'First')['count'], 0)
+        self.assertEqual(backend.find('title', 'Two')['count'], 1)
+        self.assertEqual(backend.find_range('rank')['count'], 1)
+
+    def test_redis_get_many(self):
+        """
+        Assert values are read with a single MGET in order, missing ones
+        being None
+        """
+        backend = self.backend('redis_get_many')
+        backend.set_many([('key', str(i), '{{"title": "{}"}}'.format(i))
+                          for i in range(3)])
+        self.assertEqual(backend.get_many([]), [])
+        with mock.patch.object(backend.redis_server, 'mget',
+                               wraps=backend.redis_server.mget) as mget:
+            values = backend.get_many([('key', '2'), ('key', '9'),
+                                       ('key', '0')])
+        self.assertEqual(mget.call_count, 1)
+        self.assertEqual(values, ['{"title": "2"}', None,
+                                  '{"title": "0"}'])
+        self.assertEqual(backend.latest('key'), '{"title": "2"}')
+        self.assertEqual(backend.history_page('key', limit=2)[0],
+                         ['{"title": "2"}', '{"title": "1"}'])
+
+    def test_redis_scan(self):
+        """
+        Assert scans read every value once and skip pages of index keys
+        """
+        backend = self.backend('redis_scan')
+        backend.set_many([('key', str(i), '{{"title": "{}"}}'.format(i % 2))
+                          for i in range(10)])
+        pages = list(backend.scan(page_size=1))
+        self.assertTrue(all(pages))
+        self.assertEqual(sorted(value for page in pages for value in page),
+                         sorted('{{"title": "{}"}}'.format(i % 2)
+                                for i in range(10)))
+
+    def test_redis_history(self):
+        """
+        Assert histories are read page by page to their end
+        """
+        backend = self.backend('redis_history')
+        backend.history_page_size = 2
+        backend.set_many([('key', str(i), '{{"rank": {}}}'.format(i))
+                          for i in range(5)])
+        self.assertEqual(backend.history('key'),
+                         ['{{"rank": {}}}'.format(i)
+                          for i in range(4, -1, -1)])
+        self.assertEqual(backend.history('key', '0', '4', _desc=False),
+                         ['{{"rank": {}}}'.format(i) for i in range(1, 4)])
+
+    def test_redis_sharded_rebalance(self):
+        """
+        Assert rebalances move records to their owner and count records
+        moved only, sort keys of expired values being dropped
+        """
+        from jsonrepo.backends.sharded import ShardedBackend
+        servers = {}
+
+        def fake_redis(connection_pool):
+            port = connection_pool.connection_kwargs['port']
+            return fakeredis.FakeStrictRedis(
+                server=servers.setdefault(port, fakeredis.FakeServer()))
+
+        with mock.patch('redis.StrictRedis', fake_redis):
+            backend = ShardedBackend('redis_rebalance', ['title'],
+                                     nodes=['node:1', 'node:2'])
+            keys = ['key{}'.format(i) for i in range(40)]
+            backend.set_many([(key, '1', '{"title": "Moved"}')
+                              for key in keys])
+            expired = keys[::4]
+            for key in expired:
+                shard = backend.route(key)
+                shard.redis_server.delete(shard.prefixed('{}:1'.format(key)))
+            backend.shards['node:3'] = backend.shard('node:3')
+            backend.build_ring()
+            owned = [key for key in keys if backend.node(key) == 'node:3']
+            self.assertEqual(backend.rebalance(),
+                             len([key for key in owned
+                                  if key not in expired]))
+            self.assertEqual(backend.rebalance(), 0)
+            self.assertEqual(backend.get_many([(key, '1') for key in keys]),
+                             [None if key in expired
+                              else '{"title": "Moved"}' for key in keys])
+            for node, shard in backend.shards.items():
+                self.assertTrue(all(backend.node(key) == node for key, _
+                                    in backend.primary_keys(shard)))
+
+
+@unittest.skipIf(mock_aws is None, 'moto is not installed')
+class DynamoDBBackendTests(unittest.TestCase):
+    """
+    Tests DynamoDBBackend against DynamoDB mocked by moto
+    """
+
+    def setUp(self):
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        attributes = [('key', 'S'), ('date', 'S'), ('title', 'S'),
+                      ('partition', 'S'), ('rank', 'N')]
+        boto3.client('dynamodb').create_table(
+            TableName='dynamodb',
+            KeySchema=[{'AttributeName': 'key', 'KeyType': 'HASH'},
+                       {'AttributeName': 'date', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': name,
+                                   'AttributeType': kind}
+                                  for name, kind in attributes],
+            GlobalSecondaryIndexes=[
+                {'IndexName': 'title-index',
+                 'KeySchema': [{'AttributeName': 'title',
+                                'KeyType': 'HASH'}],
+                 'Projection': {'ProjectionType': 'ALL'}},
+                {'IndexName': 'rank-range-index',
+                 'KeySchema': [{'AttributeName': 'partition',
+                                'KeyType': 'HASH'},
+                               {'AttributeName': 'rank',
+                                'KeyType': 'RANGE'}],
+                 'Projection': {'ProjectionType': 'ALL'}}],
+            BillingMode='PAY_PER_REQUEST')
+        from jsonrepo.backends.dynamodb import DynamoDBBackend
+        self.backend = DynamoDBBackend('dynamodb', 'key', 'date', ['title'],
+                                       ordered_indexes=['rank'])
+
+    @staticmethod
+    def value(i):
+        return '{{"title": "{}", "rank": {}}}'.format(i % 2, i)
+
+    def test_dynamodb_get_many(self):
+        """
+        Assert duplicate keys are written and read once, in batches whose
+        unprocessed keys are retried
+        """
+        backend = self.backend
+        backend.batch_get_size = 2
+        backend.set_many([('key', '1', self.value(0)),
+                          ('key', '2', self.value(2)),
+                          ('key', '1', self.value(1))])
+        batch_get_item = backend.dynamodb_resource.batch_get_item
+        requests = []
+
+        def unprocessed(RequestItems):
+            requests.append(RequestItems)
+            if len(requests) > 1:
+                return batch_get_item(RequestItems=RequestItems)
+            return {'Responses': {}, 'UnprocessedKeys': RequestItems}
+
+        with mock.patch.object(backend.dynamodb_resource, 'batch_get_item',
+                               unprocessed), \
+                mock.patch('time.sleep'):
+            values = backend.get_many([('key', '1'), ('key', '3'),
+                                       ('key', '1'), ('key', '2')])
+        self.assertEqual(values, [self.value(1), None, self.value(1),
+                                  self.value(2)])
+        self.assertEqual([len(request['dynamodb']['Keys'])
+                          for request in requests], [2, 2, 1])
+
+    def test_dynamodb_history_page(self):
+        """
+        Assert histories are paged across cursors within exclusive bounds
+        """
+        backend = self.backend
+        backend.set_many([('key', str(i), self.value(i)) for i in range(5)])
+        values, cursor = [], None
+        while True:
+            page, cursor = backend.history_page('key', limit=2,
+                                                cursor=cursor)
+            values.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(values, [self.value(i) for i in range(4, -1, -1)])
+        self.assertEqual(backend.history('key', '0', '3', _desc=False),
+                         [self.value(1), self.value(2)])
+        backend.history_page_size = 2
+        self.assertEqual(backend.history('key'), values)
+        self.assertEqual(backend.latest('key'), self.value(4))
+
+    def test_dynamodb_scan(self):
+        """
+        Assert parallel scans read every value once
+        """
+        backend = self.backend
+        backend.set_many([('key{}'.format(i), '1', self.value(i))
+                          for i in range(20)])
+        pages = list(backend.scan(page_size=3, concurrency=3))
+        self.assertTrue(all(pages))
+        self.assertEqual(sorted(value for page in pages for value in page),
+                         sorted(self.value(i) for i in range(20)))
+
+    def test_dynamodb_find_range(self):
+        """
+        Assert ranges of ordered indexes include their bounds
+        """
+        backend = self.backend
+        backend.set_many([('key', str(i), self.value(i)) for i in range(5)])
+
+        def ranks(*args):
+            return [codec.loads(value)['rank']
+                    for value in backend.find_range('rank', *args)['items']]
+
+        self.assertEqual(ranks(), [0, 1, 2, 3, 4])
+        self.assertEqual(ranks(1, 3), [1, 2, 3])
+        self.assertEqual(ranks(None, 1), [0, 1])
+        self.assertEqual(ranks(3), [3, 4])
+        self.assertEqual(ranks(None, None, 2), [0, 1])
+        self.assertEqual(backend.find('rank', 2)['count'], 1)
+        self.assertEqual(backend.find('title', '1')['count'], 2)
+
+    def test_dynamodb_expiring_records(self):
+        """
+        Assert expired items are skipped until DynamoDB deletes them
+        """
+        backend = self.backend
+        now = time.time()
+        backend.set('key', '1', self.value(1))
+        backend.set('key', '2', self.value(2), ttl=60)
+        self.assertEqual(backend.get('key', '2'), self.value(2))
+        with mock.patch('time.time', return_value=now + 90):
+            self.assertIsNone(backend.get('key', '2'))
+            self.assertEqual(backend.get_many([('key', '2')]), [None])
+            self.assertEqual(backend.latest('key'), self.value(1))
+            self.assertEqual(backend.find_range('rank')['count'], 1)
+            self.assertFalse(backend.update('key', '2', {'title': 'x'}))
+
+    def test_dynamodb_update(self):
+        """
+        Assert updates move index entries and keep the expiry time, missing
+        items being left alone
+        """
+        backend = self.backend
+        backend.set('key', '1', self.value(1), ttl=60)
+        expires = backend.dynamodb_server.get_item(
+            Key={'key': 'dynamodb:key', 'date': '1'})['Item']['expires']
+        self.assertTrue(backend.update('key', '1', {'title': 'First',
+                                                    'rank': 10}))
+        self.assertFalse(backend.update('key', '2', {'title': 'Second'}))
+        self.assertEqual(codec.loads(backend.get('key', '1')),
+                         {'title': 'First', 'rank': 10})
+        self.assertIsNone(backend.get('key', '2'))
+        self.assertEqual(backend.find('title', '1')['count'], 0)
+        self.assertEqual(backend.find('title', 'First')['count'], 1)
+        self.assertEqual(backend.find_range('rank', 10)['count'], 1)
+        self.assertEqual(backend.dynamodb_server.get_item(
+            Key={'key': 'dynamodb:key', 'date': '1'})['Item']['expires'],
+            expires)
+
+
+class ShardedBackendTests(unittest.TestCase):
+    """
+    Tests the consistent hash ring of ShardedBackend, no node is contacted.
+    """
+
+    def test_sharded_ring(self):
+        """
+        Assert primary keys are spread over nodes and adding a node only
+        moves keys to it
+        """
+        from jsonrepo.backends.sharded import ShardedBackend
+        backend = ShardedBackend('sharded', [], nodes=['a:6379', 'b:6379',
+                                                       'c:6379/1'])
+        keys = ['key{}'.format(i) for i in range(1000)]
+        owners = dict((key, backend.node(key)) for key in keys)
+        self.assertEqual(set(owners.values()),
+                         set(['a:6379', 'b:6379', 'c:6379/1']))
+        self.assertEqual(backend.shards['c:6379/1']._endpoint,
+                         ('tcp', 'c', 6379, 1))
+        backend.shards['d:6379'] = backend.shard('d:6379')
+        backend.build_ring()
+        moved = [key for key in keys if backend.node(key) != owners[key]]
+        self.assertTrue(0 < len(moved) < 500)
+        self.assertEqual(set(backend.node(key) for key in moved),
+                         set(['d:6379']))